@@ -1,6 +1,7 @@
 from enum import Enum
+from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
 
 # Request(BaseModel):
 # Response(BaseModel):
@@ -56,6 +57,29 @@ class ResultUser(BaseModel):
     score: int
 
 
+class LeaderboardEntry(BaseModel):
+    rank: int
+    user_id: int
+    # スコアを出した時点の名前/リーダーカード
+    name: str
+    leader_card_id: int
+    score: int
+
+
+class LiveStats(BaseModel):
+    select_difficulty: LiveDifficulty
+    play_count: int
+    score_mean: float
+    # "p25", "p50", "p75", "p90", "p99"
+    score_percentiles: dict[str, float]
+    # 全判定に占める perfect, great, good, bad, miss の割合
+    judge_distribution: list[float]
+    # score がクリアスコア以上の割合
+    clear_rate: float
+    # bad も miss もない割合
+    full_combo_rate: float
+
+
 class UserCreateRequest(BaseModel):
     user_name: str
     leader_card_id: int
@@ -65,6 +89,10 @@ class UserCreateResponse(BaseModel):
     user_token: str
 
 
+class Empty(BaseModel):
+    pass
+
+
 class RoomCreateRequest(BaseModel):
     live_id: int
     select_difficulty: LiveDifficulty
@@ -76,10 +104,21 @@ class RoomCreateResponse(BaseModel):
 
 class RoomListRequest(BaseModel):
     live_id: int
+    # 前ページの next_cursor. 0 なら先頭から
+    cursor: int = 0
+    # 省略時は config.ROOM_LIST_DEFAULT_LIMIT. config.ROOM_LIST_MAX_LIMIT で頭打ち
+    limit: Optional[int] = None
+    # 同じページで前回受け取った version. 送った時だけレスポンスに version/unchanged が入る
+    version: Optional[int] = None
 
 
 class RoomListResponse(BaseModel):
     room_info_list: list[RoomInfo]
+    # 続きがある時だけ入る. 次のリクエストの cursor に使う
+    next_cursor: Optional[int] = None
+    version: Optional[int] = None
+    # True なら前回から変わっていない (room_info_list は空)
+    unchanged: Optional[bool] = None
 
 
 class RoomJoinRequest(BaseModel):
@@ -91,13 +130,53 @@ class RoomJoinResponse(BaseModel):
     join_room_result: JoinRoomResult
 
 
+class RoomQuickJoinRequest(BaseModel):
+    live_id: int
+    select_difficulty: LiveDifficulty
+
+
+class RoomQuickJoinResponse(BaseModel):
+    room_id: int
+    # 入れるルームがなく新しく作った (自分がホスト)
+    created: bool
+
+
 class RoomWaitRequest(BaseModel):
     room_id: int
+    # 前回受け取った version (最初は 0). 送った時だけレスポンスに version/unchanged が入る
+    version: Optional[int] = None
 
 
 class RoomWaitResponse(BaseModel):
     status: WaitRoomStatus
     room_user_list: list[RoomUser]
+    version: Optional[int] = None
+    # True なら前回からメンバーが変わっていない (room_user_list は空)
+    unchanged: Optional[bool] = None
+
+
+class RoomWaitPollRequest(BaseModel):
+    room_id: int
+    # 前回受け取った version. 省略すると待たずに今の状態を返す
+    version: Optional[int] = None
+    # 変化がなければ最大この秒数待つ (config.LONG_POLL_MAX_TIMEOUT で頭打ち)
+    timeout: float = 20.0
+
+
+class RoomWaitPollResponse(BaseModel):
+    version: int
+    status: WaitRoomStatus
+    room_user_list: list[RoomUser]
+
+
+class RoomWaitDelta(BaseModel):
+    """/room/wait/ws で送る差分. 最初のメッセージは全員分が updated_user_list に入る"""
+
+    version: int
+    status: WaitRoomStatus
+    # 新しく入ったか, is_host などが変わったユーザー
+    updated_user_list: list[RoomUser]
+    left_user_id_list: list[int]
 
 
 class RoomStartRequest(BaseModel):
@@ -111,7 +190,7 @@ class RoomStartResponse(BaseModel):
 class RoomEndRequest(BaseModel):
     room_id: int
     # paefect, great, good, bad, missの順
-    judge_count_list: list[int]
+    judge_count_list: conlist(int, min_items=5, max_items=5)
     score: int
 
 
@@ -133,3 +212,26 @@ class RoomLeaveRequest(BaseModel):
 
 class RoomLeaveResponse(BaseModel):
     pass
+
+
+class LiveLeaderboardRequest(BaseModel):
+    live_id: int
+    select_difficulty: LiveDifficulty
+    # 省略時や config.LEADERBOARD_SIZE より大きい時は LEADERBOARD_SIZE 件
+    limit: Optional[int] = None
+
+
+class LiveLeaderboardResponse(BaseModel):
+    ranking: list[LeaderboardEntry]
+
+
+class LiveStatsRequest(BaseModel):
+    live_id: int
+    # 省略時は全難易度
+    select_difficulty: Optional[LiveDifficulty] = None
+    # 省略時は config.LIVE_CLEAR_SCORE
+    clear_score: Optional[int] = None
+
+
+class LiveStatsResponse(BaseModel):
+    stats: list[LiveStats]
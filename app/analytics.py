@@ -0,0 +1,193 @@
+"""ライブ・難易度ごとのスコア/判定の集計 (/live/stats)
+
+結果 (member と member_archive の score, judge_*) を LIVE_STATS_CHUNK_SIZE 行ずつ NumPy の配列にして,
+(live_id, 難易度) ごとの件数, 判定数の合計, フルコンボ数をまとめて足す. スコアは
+パーセンタイルとクリア率を出すためにソート済みの配列で持つ.
+
+集計済みの範囲は scored_at (スコアを記録した UNIX 秒) で覚えておき, 次回は
+それ以降に記録された結果だけを読む. 同じ秒の commit の遅れを取りこぼさないよう,
+直近 LIVE_STATS_LAG 秒の結果は次回に回す.
+/room/end が出し直されると同じ (room_id, member_id) の結果が新しい scored_at でもう一度読まれるので,
+LIVE_STATS_DEDUP_WINDOW 秒以内に数えた結果は (room_id, member_id) ごとに覚えておき, 前の分を引いてから足す.
+アプリの起動時に全履歴を1回読んでおく (最初の /live/stats で読まないように).
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+import numpy as np
+
+from . import config
+from .ResReqModel import LiveDifficulty, LiveStats
+
+PERCENTILES = (25, 50, 75, 90, 99)
+
+
+class _Stats:
+    __slots__ = ("scores", "judges", "full_combo")
+
+    def __init__(self):
+        # ソート済み
+        self.scores = np.empty(0, dtype=np.int64)
+        # perfect, great, good, bad, miss の合計
+        self.judges = np.zeros(5, dtype=np.int64)
+        # bad も miss もない回数
+        self.full_combo = 0
+
+
+def _scored_at(row: tuple) -> int:
+    return row[10]
+
+
+class LiveStatsAggregator:
+    def __init__(self, chunk_size: int = config.LIVE_STATS_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._stats: dict[tuple[int, int], _Stats] = {}
+        # (room_id, member_id) -> 数えた行. 出し直されうる (新しい) 分だけを scored_at 順に
+        self._counted: OrderedDict[tuple[int, int], tuple] = OrderedDict()
+        # scored_at がこれより前の結果は集計済み
+        self.scored_before = 0
+        self.refreshed_at = 0.0
+        self.rows = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def add(self, rows: Iterable[tuple], scored_before: int) -> int:
+        """self.scored_before から scored_before までに記録された結果を足す. 足した行数を返す"""
+        pending: dict[tuple[int, int], list[np.ndarray]] = {}
+        judges: dict[tuple[int, int], np.ndarray] = {}
+        full_combo: dict[tuple[int, int], int] = {}
+        # これより前に記録された結果のルームはもう片付いていて, 出し直されない
+        forget_before = scored_before - config.LIVE_STATS_DEDUP_WINDOW
+        recent: list[tuple] = []
+        count = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            count += len(chunk)
+            recent += [row for row in chunk if row[10] >= forget_before]
+            # (room_id, member_id, live_id, 難易度, score,
+            #  perfect, great, good, bad, miss, scored_at)
+            array = np.array(chunk, dtype=np.int64)
+            keys, inverse = np.unique(array[:, 2:4], axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            judge_sums = np.zeros((len(keys), 5), dtype=np.int64)
+            np.add.at(judge_sums, inverse, array[:, 5:10])
+            full_combos = np.bincount(
+                inverse, weights=(array[:, 8] + array[:, 9]) == 0, minlength=len(keys)
+            )
+            # キーごとのスコアを連続した区間にして切り分ける
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.searchsorted(inverse[order], np.arange(1, len(keys)))
+            groups = np.split(array[order, 4], bounds)
+            for i, (live_id, difficulty) in enumerate(keys.tolist()):
+                key = (live_id, difficulty)
+                pending.setdefault(key, []).append(groups[i])
+                judges[key] = judges.get(key, 0) + judge_sums[i]
+                full_combo[key] = full_combo.get(key, 0) + int(full_combos[i])
+
+        with self._lock:
+            for key, arrays in pending.items():
+                stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = _Stats()
+                stats.scores = np.sort(np.concatenate([stats.scores, *arrays]))
+                stats.judges = stats.judges + judges[key]
+                stats.full_combo += full_combo[key]
+            recent.sort(key=_scored_at)
+            for row in recent:
+                ident = (row[0], row[1])
+                old = self._counted.pop(ident, None)
+                if old is not None:
+                    self._remove(old)
+                self._counted[ident] = row
+            while self._counted:
+                ident, row = next(iter(self._counted.items()))
+                if row[10] >= forget_before:
+                    break
+                del self._counted[ident]
+            self.scored_before = scored_before
+            self.refreshed_at = time.monotonic()
+            self.rows += count
+        return count
+
+    def _remove(self, row: tuple) -> None:
+        """前に数えた行を集計から引く. self._lock を取った状態で呼ぶ"""
+        stats = self._stats[(row[2], row[3])]
+        i = int(np.searchsorted(stats.scores, row[4]))
+        stats.scores = np.delete(stats.scores, i)
+        stats.judges = stats.judges - np.array(row[5:10], dtype=np.int64)
+        if row[8] + row[9] == 0:
+            stats.full_combo -= 1
+
+    def refresh(self, storage, force: bool = False) -> Optional[int]:
+        """前回から LIVE_STATS_REFRESH_INTERVAL 秒経っていれば新しい結果を読み足す
+
+        他のスレッドが読み足している間は待たずに None を返す (今ある集計で答える).
+        """
+        if (
+            not force
+            and time.monotonic() - self.refreshed_at
+            < config.LIVE_STATS_REFRESH_INTERVAL
+        ):
+            return None
+        if not self._refresh_lock.acquire(blocking=False):
+            return None
+        try:
+            scored_before = int(time.time()) - config.LIVE_STATS_LAG
+            if scored_before <= self.scored_before:
+                return 0
+            rows = storage.iter_results(self.scored_before, scored_before)
+            return self.add(rows, scored_before)
+        finally:
+            self._refresh_lock.release()
+
+    def get(
+        self,
+        live_id: int,
+        difficulty: LiveDifficulty,
+        clear_score: Optional[int] = None,
+    ) -> LiveStats:
+        if clear_score is None:
+            clear_score = config.LIVE_CLEAR_SCORE
+        with self._lock:
+            stats = self._stats.get((live_id, difficulty.value))
+            if stats is None:
+                stats = _Stats()
+            scores, judges, full_combo = stats.scores, stats.judges, stats.full_combo
+        play_count = len(scores)
+        if play_count == 0:
+            return LiveStats(
+                select_difficulty=difficulty,
+                play_count=0,
+                score_mean=0.0,
+                score_percentiles={f"p{p}": 0.0 for p in PERCENTILES},
+                judge_distribution=[0.0] * 5,
+                clear_rate=0.0,
+                full_combo_rate=0.0,
+            )
+        total_judges = int(judges.sum())
+        # scores はソート済みなので, クリア数は二分探索で数える
+        cleared = play_count - int(np.searchsorted(scores, clear_score, side="left"))
+        return LiveStats(
+            select_difficulty=difficulty,
+            play_count=play_count,
+            score_mean=float(scores.mean()),
+            score_percentiles={
+                f"p{p}": float(v)
+                for p, v in zip(PERCENTILES, np.percentile(scores, PERCENTILES))
+            },
+            judge_distribution=(
+                (judges / total_judges).tolist() if total_judges else [0.0] * 5
+            ),
+            clear_rate=cleared / play_count,
+            full_combo_rate=full_combo / play_count,
+        )
+
+
+live_stats = LiveStatsAggregator()
@@ -1,14 +1,21 @@
-import stat
-from enum import Enum
-from select import select
-
-from fastapi import Depends, FastAPI, HTTPException
-from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
-from pydantic import BaseModel
-
-from . import model
-from .model import SafeUser
+from typing import Callable, Optional
+
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from . import config, export, fastjson, metrics, model, profiling, wait_api
+from .auth import get_auth_token
+from .caller import get_caller, get_caller_or_none
+from .leaderboard import leaderboard
+from .model import Caller, InvalidToken, SafeUser
+from .reaper import room_reaper
+from .registry import RegistryWriteError, room_registry
 from .ResReqModel import (
+    Empty,
+    LiveLeaderboardRequest,
+    LiveLeaderboardResponse,
+    LiveStatsRequest,
+    LiveStatsResponse,
     RoomCreateRequest,
     RoomCreateResponse,
     RoomEndRequest,
@@ -19,6 +26,8 @@ from .ResReqModel import (
     RoomLeaveResponse,
     RoomListRequest,
     RoomListResponse,
+    RoomQuickJoinRequest,
+    RoomQuickJoinResponse,
     RoomResultRequest,
     RoomResultResponse,
     RoomStartRequest,
@@ -28,8 +37,81 @@ from .ResReqModel import (
     UserCreateRequest,
     UserCreateResponse,
 )
+from .score_writer import ScoreWriterError, score_writer
+from .shared_cache import shared_cache
 
 app = FastAPI()
+app.router.route_class = profiling.ProfiledRoute
+# 後に登録した方が外側になる. プロファイルの経過時間に metrics の処理を含めない
+app.middleware("http")(profiling.middleware)
+app.middleware("http")(metrics.middleware)
+metrics.cache_stats["user_cache"] = model.user_cache.stats
+metrics.cache_stats["result_cache"] = model.result_cache.stats
+if shared_cache is not None:
+    metrics.cache_stats["shared_cache"] = shared_cache.stats
+if score_writer is not None:
+    metrics.cache_stats["score_writer"] = score_writer.stats
+# user/room API (ASYNC_MODE でも同じハンドラ. 下の room_io を参照)
+router = APIRouter(route_class=profiling.ProfiledRoute)
+
+
+@app.exception_handler(InvalidToken)
+async def invalid_token_handler(request: Request, exc: InvalidToken):
+    return JSONResponse(status_code=401, content={"detail": "invalid token"})
+
+
+@app.exception_handler(RegistryWriteError)
+@app.exception_handler(ScoreWriterError)
+async def write_error_handler(request: Request, exc: Exception):
+    # 書き込みを待てなかっただけなので, クライアントは再送してよい
+    return JSONResponse(status_code=503, content={"detail": "write failed"})
+
+
+@app.on_event("startup")
+def rebuild_leaderboard():
+    model.rebuild_leaderboard()
+
+
+@app.on_event("startup")
+def warm_live_stats():
+    model.warm_live_stats()
+
+
+@app.on_event("startup")
+def start_room_registry():
+    if room_registry is not None:
+        room_registry.start()
+
+
+@app.on_event("startup")
+def start_score_writer():
+    if score_writer is not None:
+        score_writer.start()
+
+
+@app.on_event("startup")
+def start_room_reaper():
+    if room_reaper is not None:
+        room_reaper.start()
+
+
+@app.on_event("shutdown")
+def stop_room_reaper():
+    if room_reaper is not None:
+        room_reaper.stop()
+
+
+@app.on_event("shutdown")
+def stop_score_writer():
+    if score_writer is not None:
+        score_writer.stop()
+
+
+@app.on_event("shutdown")
+def stop_room_registry():
+    if room_registry is not None:
+        room_registry.stop()
+
 
 # Sample APIs
 
@@ -39,89 +121,224 @@ async def root():
     return {"message": "Hello World"}
 
 
-# User APIs
-@app.post("/user/create", response_model=UserCreateResponse)
-def user_create(req: UserCreateRequest):
-    """新規ユーザー作成"""
-    token = model.create_user(req.user_name, req.leader_card_id)
-    return UserCreateResponse(user_token=token)
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus text format"""
+    return metrics.render()
 
 
-bearer = HTTPBearer()
+@app.get("/admin/profiles")
+def admin_profiles(
+    limit: int = 10, key: Optional[str] = Header(None, alias=profiling.HEADER)
+):
+    """プロファイルを取ったリクエストの, route ごとに遅い順の一覧 (全 worker 分)"""
+    _require_profile_key(key)
+    return {"routes": profiling.summary(limit)}
 
 
-def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
-    assert cred is not None
-    if not cred.credentials:
-        raise HTTPException(status_code=401, detail="invalid credential")
-    return cred.credentials
+@app.get("/admin/profiles/{profile_id}")
+def admin_profile(
+    profile_id: str, key: Optional[str] = Header(None, alias=profiling.HEADER)
+):
+    """1リクエスト分の SQL タイムラインと cProfile の上位の関数"""
+    _require_profile_key(key)
+    record = profiling.load(profile_id)
+    if record is None:
+        raise HTTPException(status_code=404)
+    return record
+
+
+def _require_profile_key(key: Optional[str]) -> None:
+    if not config.PROFILE_KEY:
+        raise HTTPException(status_code=404)
+    if not profiling.is_admin(key):
+        raise HTTPException(status_code=403)
+
 
+@app.get("/admin/export")
+def admin_export(
+    format: export.ExportFormat = export.ExportFormat.ndjson,
+    live_id: Optional[int] = None,
+    min_room_id: Optional[int] = None,
+    max_room_id: Optional[int] = None,
+    after: Optional[str] = None,
+    key: Optional[str] = Header(None, alias=profiling.HEADER),
+):
+    """ライブが終わったルームのスコアを (room_id, member_id) 順に NDJSON / CSV で流す
 
-@app.get("/user/me", response_model=SafeUser)
-def user_me(token: str = Depends(get_auth_token)):
-    user = model.get_user_by_token(token)
+    途中で切れたら, 受け取った最終行の room_id, member_id を after=<room_id>:<member_id> で渡して続きから.
+    """
+    _require_profile_key(key)
+    try:
+        start = export.START if after is None else export.parse_checkpoint(after)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="after must be <room_id>:<member_id>"
+        )
+    chunks = export.stream(
+        model.storage, format, live_id, min_room_id, max_room_id, start
+    )
+    return StreamingResponse(chunks, media_type=export.MEDIA_TYPES[format])
+
+
+class _ThreadedModel:
+    """model の関数を async_model と同じく await で呼べるようにする (スレッドプールで実行する)"""
+
+    def __getattr__(self, name: str) -> Callable:
+        func = getattr(model, name)
+
+        async def call(*args):
+            return await profiling.run_in_thread(func, *args)
+
+        return call
+
+
+# user/room API のハンドラは1つで, I/O の層だけを替える.
+# ASYNC_MODE ではイベントループ上で async_model を await し, そうでなければ model をスレッドプールで
+if config.ASYNC_MODE:
+    from . import async_model as room_io
+else:
+    room_io = _ThreadedModel()
+
+
+# User APIs
+@router.post("/user/create", response_model=UserCreateResponse)
+async def user_create(req: UserCreateRequest):
+    """新規ユーザー作成"""
+    token = await room_io.create_user(req.user_name, req.leader_card_id)
+    return UserCreateResponse(user_token=token)
+
+
+@router.get("/user/me", response_model=SafeUser)
+async def user_me(token: str = Depends(get_auth_token)):
+    user = await room_io.get_user_by_token(token)
     if user is None:
         raise HTTPException(status_code=404)
     # print(f"user_me({token=}, {user=})")
     return user
 
 
-class Empty(BaseModel):
-    pass
-
-
-@app.post("/user/update", response_model=Empty)
-def update(req: UserCreateRequest, token: str = Depends(get_auth_token)):
+@router.post("/user/update", response_model=Empty)
+async def update(req: UserCreateRequest, caller: Caller = Depends(get_caller)):
     """Update user attributes"""
     # print(req)
-    model.update_user(token, req.user_name, req.leader_card_id)
+    await room_io.update_user(caller, req.user_name, req.leader_card_id)
     return {}
 
 
-@app.post("/room/create", response_model=RoomCreateResponse)
-def room_create(req: RoomCreateRequest, token: str = Depends(get_auth_token)):
-    room_id = model.create_room(token, req.live_id, req.select_difficulty)
-    return RoomCreateResponse(room_id=room_id)
+@router.post("/user/token/refresh", response_model=UserCreateResponse)
+async def user_token_refresh(caller: Caller = Depends(get_caller)):
+    """今の鍵で署名した token を発行し直す. 署名付き token が無効な設定では同じ token を返す"""
+    return UserCreateResponse(user_token=await room_io.refresh_token(caller))
 
 
-@app.post("/room/list", response_model=RoomListResponse)
-def room_list(req: RoomListRequest):
-    room_info_list = model.list_room(req.live_id)
-    return RoomListResponse(room_info_list=room_info_list)
+@router.post("/room/create", response_model=RoomCreateResponse)
+async def room_create(req: RoomCreateRequest, caller: Caller = Depends(get_caller)):
+    room_id = await room_io.create_room(caller, req.live_id, req.select_difficulty)
+    return RoomCreateResponse(room_id=room_id)
 
 
-@app.post("/room/join", response_model=RoomJoinResponse)
-def room_join(req: RoomJoinRequest, token: str = Depends(get_auth_token)):
-    join_room_result = model.join_room(req.room_id, req.select_difficulty, token)
+# version/unchanged は version を送ってきた時だけ返す
+@router.post(
+    "/room/list", response_model=RoomListResponse, response_model_exclude_unset=True
+)
+async def room_list(req: RoomListRequest):
+    if req.version is None:
+        room_info_list, next_cursor = await room_io.list_room(
+            req.live_id, req.cursor, req.limit
+        )
+        return fastjson.room_list_response(room_info_list, next_cursor)
+    version, page = await room_io.list_room_since(
+        req.live_id, req.cursor, req.limit, req.version
+    )
+    if page is None:
+        # ページを読んでいないので next_cursor もわからない (前回のものを使ってもらう)
+        return fastjson.room_list_response([], None, version, unchanged=True)
+    return fastjson.room_list_response(*page, version)
+
+
+@router.post("/room/join", response_model=RoomJoinResponse)
+async def room_join(
+    req: RoomJoinRequest, caller: Optional[Caller] = Depends(get_caller_or_none)
+):
+    join_room_result = await room_io.join_room(
+        req.room_id, req.select_difficulty, caller
+    )
     return RoomJoinResponse(join_room_result=join_room_result)
 
 
-@app.post("/room/wait", response_model=RoomWaitResponse)
-def room_wait(req: RoomWaitRequest, token: str = Depends(get_auth_token)):
-    status, room_user_list = model.wait_room(req.room_id, token)
-    return RoomWaitResponse(status=status, room_user_list=room_user_list)
+@router.post("/room/quickjoin", response_model=RoomQuickJoinResponse)
+async def room_quickjoin(
+    req: RoomQuickJoinRequest, caller: Caller = Depends(get_caller)
+):
+    """一番埋まっている入場可能なルームに入る. なければ作る"""
+    room_id, created = await room_io.quick_join(
+        req.live_id, req.select_difficulty, caller
+    )
+    return RoomQuickJoinResponse(room_id=room_id, created=created)
 
 
-@app.post("/room/start", response_model=RoomStartResponse)
-def room_start(req: RoomStartRequest, token: str = Depends(get_auth_token)):
-    model.start_room(req.room_id, token)
+@router.post(
+    "/room/wait", response_model=RoomWaitResponse, response_model_exclude_unset=True
+)
+async def room_wait(req: RoomWaitRequest, caller: Caller = Depends(get_caller)):
+    if req.version is None:
+        status, room_user_list = await room_io.wait_room(req.room_id, caller)
+        return fastjson.room_wait_response(status, room_user_list)
+    version, status, room_user_list = await room_io.wait_room_since(
+        req.room_id, caller, req.version
+    )
+    if room_user_list is None:
+        return fastjson.room_wait_response(status, [], version, unchanged=True)
+    return fastjson.room_wait_response(status, room_user_list, version)
+
+
+@router.post("/room/start", response_model=RoomStartResponse)
+async def room_start(req: RoomStartRequest, caller: Caller = Depends(get_caller)):
+    await room_io.start_room(req.room_id, caller)
     return RoomStartResponse()
 
 
-@app.post("/room/end", response_model=RoomEndResponse)
-def room_end(req: RoomEndRequest, token: str = Depends(get_auth_token)):
-    model.end_room(req.room_id, req.score, req.judge_count_list, token)
+@router.post("/room/end", response_model=RoomEndResponse)
+async def room_end(req: RoomEndRequest, caller: Caller = Depends(get_caller)):
+    await room_io.end_room(req.room_id, req.score, req.judge_count_list, caller)
     return RoomEndResponse()
 
 
-@app.post("/room/result", response_model=RoomResultResponse)
-def room_result(req: RoomResultRequest):
-    print(req.room_id)
-    result_user_list = model.result_room(req.room_id)
-    return RoomResultResponse(result_user_list=result_user_list)
+@router.post("/room/result", response_model=RoomResultResponse)
+async def room_result(req: RoomResultRequest):
+    result_user_list = await room_io.result_room(req.room_id)
+    return fastjson.room_result_response(result_user_list)
 
 
-@app.post("/room/leave", response_model=RoomLeaveResponse)
-def room_leave(req: RoomLeaveRequest, token: str = Depends(get_auth_token)):
-    model.leave_room(req.room_id, token)
-    return RoomEndResponse()
+@router.post("/room/leave", response_model=RoomLeaveResponse)
+async def room_leave(req: RoomLeaveRequest, caller: Caller = Depends(get_caller)):
+    await room_io.leave_room(req.room_id, caller)
+    return RoomLeaveResponse()
+
+
+# Live APIs
+
+
+# メモリ上のランキングを切り出すだけで I/O しないので, ASYNC_MODE に関係なく async def
+@app.post("/live/leaderboard", response_model=LiveLeaderboardResponse)
+async def live_leaderboard(req: LiveLeaderboardRequest):
+    """ライブ・難易度ごとのスコア上位 (1ユーザー1件, 自己ベスト)
+
+    ランキングは worker ごとのメモリにあり, 起動後にその worker が受けた /room/end と
+    /user/update だけが反映される. 複数 worker では worker によって結果が違いうる (再起動で揃う).
+    """
+    ranking = leaderboard.top(req.live_id, req.select_difficulty, req.limit)
+    return LiveLeaderboardResponse(ranking=ranking)
+
+
+# 読み足す時に DB を読むので sync def (スレッドプール)
+@app.post("/live/stats", response_model=LiveStatsResponse)
+def live_stats(req: LiveStatsRequest):
+    """ライブ・難易度ごとのスコア分布, 判定の割合, クリア率/フルコンボ率"""
+    stats = model.get_live_stats(req.live_id, req.select_difficulty, req.clear_score)
+    return LiveStatsResponse(stats=stats)
+
+
+app.include_router(wait_api.router)
+app.include_router(router)
@@ -0,0 +1,310 @@
+"""model.py の async 版 (STORAGE=mysql の時のみ). api.py の room_io として model と差し替えるので関数名と引数は揃える
+
+SQL は sql_storage.py の `_xxx(conn, ...)` をそのまま使い, AsyncConnection.run_sync で
+greenlet 上の同期Connectionとして実行する. ここではトランザクション境界だけを持つ.
+shared_cache (SQLite のファイル) の読み書きは asyncio.to_thread でイベントループの外で行う.
+"""
+
+import asyncio
+from typing import Optional, Tuple
+
+from . import config, model, sql_storage
+from .auth import InvalidToken, token_signer
+from .db import async_engine
+from .model import Caller, SafeUser
+from .registry import RegistryWriteError, room_registry
+from .ResReqModel import (
+    JoinRoomResult,
+    LiveDifficulty,
+    ResultUser,
+    RoomInfo,
+    RoomUser,
+    WaitRoomStatus,
+)
+from .score_writer import ScoreWriterError, score_writer
+from .shared_cache import shared_cache
+
+readcommitted_engine = async_engine.execution_options(isolation_level="READ COMMITTED")
+
+
+async def create_user(name: str, leader_card_id: int) -> str:
+    async with async_engine.connect() as conn:
+        async with conn.begin():
+            token, user = await conn.run_sync(
+                sql_storage._create_user, name, leader_card_id
+            )
+    if token_signer.enabled:
+        token = token_signer.sign(user.id)
+        model.user_cache.set(user.id, user)
+    else:
+        model.user_cache.set(token, user)
+    return token
+
+
+async def _get_user_by_id(user_id: int) -> Optional[SafeUser]:
+    user = model.user_cache.get(user_id)
+    if user is not None:
+        return user
+    async with async_engine.connect() as conn:
+        async with conn.begin():
+            user = await conn.run_sync(sql_storage._get_user_by_id, user_id)
+    if user is not None:
+        model.user_cache.set(user_id, user)
+    return user
+
+
+async def get_user_by_token(token: str) -> Optional[SafeUser]:
+    try:
+        user_id = token_signer.user_id(token)
+    except InvalidToken:
+        return None
+    if user_id is not None:
+        return await _get_user_by_id(user_id)
+    user = model.user_cache.get(token)
+    if user is not None:
+        return user
+    async with async_engine.connect() as conn:
+        async with conn.begin():
+            user = await conn.run_sync(sql_storage._get_user_by_token, token)
+    if user is not None:
+        model.user_cache.set(token, user)
+    return user
+
+
+async def resolve_caller(token: str) -> Caller:
+    caller = model.peek_caller(token)
+    if caller is not None:
+        return caller
+    async with async_engine.connect() as conn:
+        async with conn.begin():
+            user = await conn.run_sync(sql_storage._get_user_by_token, token)
+    if user is None:
+        raise InvalidToken
+    model.user_cache.set(token, user)
+    return Caller(token, user.id, user)
+
+
+async def caller_user(caller: Caller) -> SafeUser:
+    if caller.user is None:
+        user = await _get_user_by_id(caller.user_id)
+        if user is None:
+            raise InvalidToken
+        caller.user = user
+    return caller.user
+
+
+async def refresh_token(caller: Caller) -> str:
+    return model.refresh_token(caller)
+
+
+async def update_user(caller: Caller, name: str, leader_card_id: int) -> None:
+    async with async_engine.connect() as conn:
+        async with conn.begin():
+            await conn.run_sync(
+                sql_storage._update_user, caller.user_id, name, leader_card_id
+            )
+    model._after_update_user(
+        caller.token,
+        SafeUser(id=caller.user_id, name=name, leader_card_id=leader_card_id),
+    )
+
+
+async def create_room(
+    host: Caller, live_id: int, select_difficulty: LiveDifficulty
+) -> int:
+    async with async_engine.connect() as conn:
+        async with conn.begin():
+            room_id = await conn.run_sync(
+                sql_storage._create_room, host.user_id, live_id, select_difficulty
+            )
+    if room_registry is not None:
+        room_registry.add_room(
+            room_id, live_id, await caller_user(host), select_difficulty
+        )
+    model._room_changed(None)
+    return room_id
+
+
+async def list_room(
+    live_id: int, cursor: int = 0, limit: Optional[int] = None
+) -> Tuple[list[RoomInfo], Optional[int]]:
+    limit = model._room_list_limit(limit)
+    if room_registry is not None:
+        return room_registry.list_room(live_id, cursor, limit)
+    if shared_cache is None:
+        async with readcommitted_engine.connect() as conn:
+            async with conn.begin():
+                return await conn.run_sync(
+                    sql_storage._list_room, live_id, cursor, limit
+                )
+    cached_version, cached = await asyncio.to_thread(
+        shared_cache.get_list, live_id, cursor, limit
+    )
+    version, page = await list_room_since(live_id, cursor, limit, cached_version)
+    if page is None:
+        return cached
+    await asyncio.to_thread(
+        shared_cache.set_list, live_id, cursor, limit, version, *page
+    )
+    return page
+
+
+async def list_room_since(
+    live_id: int, cursor: int, limit: Optional[int], known_version: int
+) -> Tuple[int, Optional[Tuple[list[RoomInfo], Optional[int]]]]:
+    limit = model._room_list_limit(limit)
+    if room_registry is not None:
+        return room_registry.list_room_since(live_id, cursor, limit, known_version)
+    async with readcommitted_engine.connect() as conn:
+        async with conn.begin():
+            return await conn.run_sync(
+                sql_storage._list_room_since, live_id, cursor, limit, known_version
+            )
+
+
+async def join_room(
+    room_id: int, select_difficulty: LiveDifficulty, caller: Optional[Caller]
+) -> JoinRoomResult:
+    if caller is None:
+        return JoinRoomResult.OtherError
+    if room_registry is not None:
+        try:
+            user = await caller_user(caller)
+        except InvalidToken:
+            return JoinRoomResult.OtherError
+        status = room_registry.join_room(room_id, user, select_difficulty)
+    else:
+        async with readcommitted_engine.connect() as conn:
+            async with conn.begin():
+                status = await conn.run_sync(
+                    sql_storage._join_room, room_id, caller.user_id, select_difficulty
+                )
+    if status == JoinRoomResult.Ok:
+        model._room_changed(room_id)
+    return status
+
+
+async def quick_join(
+    live_id: int, select_difficulty: LiveDifficulty, caller: Caller
+) -> Tuple[int, bool]:
+    if room_registry is not None:
+        user = await caller_user(caller)
+        room_id = room_registry.quick_join(live_id, user, select_difficulty)
+        created = room_id is None
+        if created:
+            async with async_engine.connect() as conn:
+                async with conn.begin():
+                    room_id = await conn.run_sync(
+                        sql_storage._create_room, user.id, live_id, select_difficulty
+                    )
+            room_registry.add_room(room_id, live_id, user, select_difficulty)
+    else:
+        async with readcommitted_engine.connect() as conn:
+            async with conn.begin():
+                room_id, created = await conn.run_sync(
+                    sql_storage._quick_join, caller.user_id, live_id, select_difficulty
+                )
+    model._room_changed(None if created else room_id)
+    return room_id, created
+
+
+async def wait_room(
+    room_id: int, caller: Caller
+) -> Tuple[WaitRoomStatus, list[RoomUser]]:
+    user_id = caller.user_id
+    if room_registry is not None:
+        return room_registry.wait_room(room_id, user_id)
+    if shared_cache is None:
+        async with async_engine.connect() as conn:
+            async with conn.begin():
+                return await conn.run_sync(sql_storage._wait_room, room_id, user_id)
+    cached_version, cached = await asyncio.to_thread(
+        shared_cache.get_wait, room_id, user_id
+    )
+    version, status, room_user_list = await wait_room_since(
+        room_id, caller, cached_version
+    )
+    if room_user_list is None:
+        return cached
+    await asyncio.to_thread(
+        shared_cache.set_wait, room_id, version, status, room_user_list
+    )
+    return status, room_user_list
+
+
+async def wait_room_since(
+    room_id: int, caller: Caller, known_version: int
+) -> Tuple[int, WaitRoomStatus, Optional[list[RoomUser]]]:
+    user_id = caller.user_id
+    if room_registry is not None:
+        return room_registry.wait_room_since(room_id, user_id, known_version)
+    async with async_engine.connect() as conn:
+        async with conn.begin():
+            return await conn.run_sync(
+                sql_storage._wait_room_since, room_id, user_id, known_version
+            )
+
+
+async def start_room(room_id: int, caller: Caller) -> None:
+    user_id = caller.user_id
+    if room_registry is not None:
+        room_registry.start_room(room_id, user_id)
+    else:
+        async with async_engine.connect() as conn:
+            async with conn.begin():
+                await conn.run_sync(sql_storage._start_room, room_id, user_id)
+    model._room_changed(room_id)
+
+
+async def end_room(
+    room_id: int, score: int, judge_count_list: list[int], caller: Caller
+) -> None:
+    user_id = caller.user_id
+    if room_registry is not None:
+        flushed = await asyncio.to_thread(
+            room_registry.flush, config.ROOM_REGISTRY_FLUSH_TIMEOUT
+        )
+        if not flushed:
+            raise RegistryWriteError("room registry flush timed out")
+    if score_writer is not None:
+        future = score_writer.submit(room_id, user_id, score, judge_count_list)
+        try:
+            # 待つのをやめても書き込みは取り消さない
+            played = await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)),
+                config.SCORE_BATCH_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            raise ScoreWriterError("score write timed out")
+    else:
+        async with async_engine.connect() as conn:
+            async with conn.begin():
+                played = await conn.run_sync(
+                    sql_storage._end_room, room_id, user_id, score, judge_count_list
+                )
+    model.result_cache.pop(room_id)
+    if played is not None:
+        model._record_score(played, score)
+
+
+async def result_room(room_id: int) -> list[ResultUser]:
+    result_user_list = model.result_cache.get(room_id)
+    if result_user_list is not None:
+        return result_user_list
+    async with async_engine.connect() as conn:
+        async with conn.begin():
+            result_user_list = await conn.run_sync(sql_storage._result_room, room_id)
+    if result_user_list:
+        model.result_cache.set(room_id, result_user_list)
+    return result_user_list
+
+
+async def leave_room(room_id: int, caller: Caller) -> None:
+    user_id = caller.user_id
+    if room_registry is not None:
+        room_registry.leave_room(room_id, user_id)
+    else:
+        async with readcommitted_engine.connect() as conn:
+            async with conn.begin():
+                await conn.run_sync(sql_storage._leave_room, room_id, user_id)
+    model._room_changed(room_id)
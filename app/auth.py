@@ -0,0 +1,98 @@
+import base64
+import hashlib
+import hmac
+import time
+from typing import Optional
+
+from fastapi import Depends, HTTPException
+from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
+
+from . import config
+
+bearer = HTTPBearer()
+
+
+class InvalidToken(Exception):
+    """指定されたtokenが不正だったときに投げる"""
+
+
+class TokenSigner:
+    """HMAC 署名付きの token
+
+    形式は "v1.<kid>.<user_id>.<issued_at>.<署名>". 署名は HMAC-SHA256 を base64url にしたもの.
+    user_id が token に入っているので, 検証だけで (DBを引かずに) 誰のリクエストかわかる.
+
+    keys は "kid:secret" のカンマ区切り. 先頭の鍵で署名し, 並んでいる全部の鍵で検証する.
+    鍵を替える時は新しい鍵を先頭に足し, 古い鍵で署名した token が使われなくなってから
+    (クライアントが /user/token/refresh で取り直してから) 古い鍵を消す.
+    """
+
+    VERSION = "v1"
+
+    def __init__(self, keys: str, max_age: float = 0):
+        self._keys: dict[str, bytes] = {}
+        self._signing_kid: Optional[str] = None
+        for item in keys.split(","):
+            kid, sep, secret = item.strip().partition(":")
+            if not kid and not secret:
+                continue
+            if not sep or not kid or not secret or "." in kid:
+                raise ValueError("token keys must be 'kid:secret,...'")
+            self._keys[kid] = secret.encode()
+            if self._signing_kid is None:
+                self._signing_kid = kid
+        # 0 なら無期限
+        self.max_age = max_age
+
+    @property
+    def enabled(self) -> bool:
+        return self._signing_kid is not None
+
+    def _signature(self, kid: str, payload: str) -> str:
+        digest = hmac.new(self._keys[kid], payload.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def sign(self, user_id: int, issued_at: Optional[int] = None) -> str:
+        if issued_at is None:
+            issued_at = int(time.time())
+        payload = f"{self.VERSION}.{self._signing_kid}.{user_id}.{issued_at}"
+        return f"{payload}.{self._signature(self._signing_kid, payload)}"
+
+    def user_id(self, token: str, now: Optional[float] = None) -> Optional[int]:
+        """署名付きの token なら検証して user_id を返す. 従来の uuid の token なら None
+
+        署名付きの形式なのに検証に失敗した (鍵が消された, 改ざん, 期限切れ) 時は InvalidToken.
+        """
+        if not token.startswith(self.VERSION + "."):
+            return None
+        parts = token.split(".")
+        if len(parts) != 5 or parts[1] not in self._keys:
+            raise InvalidToken
+        payload, signature = token.rsplit(".", 1)
+        # str 同士だと ASCII 以外を含む時に TypeError になるので bytes で比べる
+        expected = self._signature(parts[1], payload)
+        if not hmac.compare_digest(signature.encode(), expected.encode()):
+            raise InvalidToken
+        try:
+            user_id, issued_at = int(parts[2]), int(parts[3])
+        except ValueError:
+            raise InvalidToken
+        if self.max_age:
+            if now is None:
+                now = time.time()
+            if now - issued_at > self.max_age:
+                raise InvalidToken
+        return user_id
+
+
+token_signer = TokenSigner(config.TOKEN_KEYS, config.TOKEN_MAX_AGE)
+
+
+# I/Oしないので async def にしておく (sync def の依存はスレッドプールに回されるため)
+async def get_auth_token(
+    cred: HTTPAuthorizationCredentials = Depends(bearer),
+) -> str:
+    assert cred is not None
+    if not cred.credentials:
+        raise HTTPException(status_code=401, detail="invalid credential")
+    return cred.credentials
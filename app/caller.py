@@ -0,0 +1,43 @@
+"""token から model.Caller を作る FastAPI の依存
+
+ルートは token の代わりに Caller を受け取って model/async_model に渡す. token の検証とユーザーの
+解決はリクエストごとに1回だけで, model の中や long-poll の読み直しのたびにはやらない.
+署名付き token とキャッシュに当たった uuid の token は I/O なしでイベントループ上で作り,
+ユーザーを引く時だけスレッドプール (ASYNC_MODE では async engine) に回す.
+"""
+
+from typing import Optional
+
+from fastapi import Depends
+from fastapi.concurrency import run_in_threadpool
+
+from . import config, model
+from .auth import InvalidToken, get_auth_token
+from .model import Caller
+
+if config.ASYNC_MODE:
+    from . import async_model
+
+
+async def resolve_caller(token: str) -> Caller:
+    """token が不正なら InvalidToken (api で 401 になる)"""
+    caller = model.peek_caller(token)
+    if caller is not None:
+        return caller
+    if config.ASYNC_MODE:
+        return await async_model.resolve_caller(token)
+    return await run_in_threadpool(model.resolve_caller, token)
+
+
+async def get_caller(token: str = Depends(get_auth_token)) -> Caller:
+    return await resolve_caller(token)
+
+
+async def get_caller_or_none(
+    token: str = Depends(get_auth_token),
+) -> Optional[Caller]:
+    """/room/join 用. token が不正でも 401 にせず OtherError を返すため"""
+    try:
+        return await resolve_caller(token)
+    except InvalidToken:
+        return None
@@ -1,5 +1,177 @@
-from sqlalchemy import create_engine
+import itertools
+import threading
+import time
+from typing import Hashable
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
 
 from . import config
+from .metrics import TimedAsyncQueuePool, TimedQueuePool, instrument_engine
+
+
+class _LockedStaticPool(StaticPool):
+    """1本の接続をスレッド間で共有するので, チェックアウトからチェックインまで排他にする"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def _do_get(self):
+        self._lock.acquire()
+        return super()._do_get()
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self._lock.release()
+
+
+def _create_sqlite_engine(uri: str, read_only: bool = False):
+    """SQLite 用の engine
+
+    pysqlite の暗黙のトランザクション制御を切り, トランザクションは常に BEGIN IMMEDIATE で始める.
+    書き込みロックを最初に取るので, join の「数えて+1」が他の書き込みと交互にならず,
+    読み取り→書き込みの昇格で SQLITE_BUSY になることもない.
+    read_only (レプリカ) の時は書かないので, ロックを取らない BEGIN にする.
+    https://docs.sqlalchemy.org/en/14/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+    """
+    in_memory = uri in ("sqlite://", "sqlite:///:memory:")
+    kwargs = {}
+    if in_memory:
+        # :memory: は接続ごとに別DBになるので1本の接続を使い回す
+        kwargs["poolclass"] = _LockedStaticPool
+    else:
+        kwargs["poolclass"] = TimedQueuePool
+    engine = create_engine(
+        uri,
+        future=True,
+        echo=config.SQL_ECHO,
+        connect_args={
+            "check_same_thread": False,
+            "timeout": config.SQLITE_BUSY_TIMEOUT,
+        },
+        **kwargs,
+    )
+
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        if not in_memory:
+            dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+    begin = "BEGIN" if read_only else "BEGIN IMMEDIATE"
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql(begin)
+
+    return engine
+
+
+engine = None
+readcommitted_engine = None
+if config.STORAGE == "mysql":
+    engine = create_engine(
+        config.DATABASE_URI,
+        future=True,
+        echo=config.SQL_ECHO,
+        poolclass=TimedQueuePool,
+    )
+    # https://docs.sqlalchemy.org/en/14/core/connections.html#setting-transaction-isolation-levels-including-dbapi-autocommit
+    readcommitted_engine = engine.execution_options(isolation_level="READ COMMITTED")
+elif config.STORAGE == "sqlite":
+    engine = _create_sqlite_engine(config.DATABASE_URI)
+    # SQLite は書き込みが直列なので分離レベルは変えない
+    readcommitted_engine = engine
+if engine is not None:
+    instrument_engine(engine)
+
+
+class ReadRouter:
+    """読み取り専用のクエリ (list/wait/result) の行き先を primary とレプリカから選ぶ
+
+    レプリカは順番に使う. レプリカは遅れるので, 書き込んだ直後の本人の読み取りは
+    pin() で pin_seconds 秒 primary に固定する (read-your-writes).
+    pin はプロセス内だけなので, 複数 worker では同じ worker に来た読み取りにしか効かない.
+    そのため worker 間で共有する shared_cache には, レプリカから読んだ内容は入れない
+    (from_replica() で確かめる).
+    """
+
+    # pin がこれだけ溜まったら期限切れを掃除する
+    PURGE_THRESHOLD = 10000
+
+    def __init__(self, primary, replicas: list, pin_seconds: float):
+        """primary/replicas は (engine, READ COMMITTED の engine) の組"""
+        self.primary = primary
+        self.replicas = replicas
+        self.pin_seconds = pin_seconds
+        self._cycle = itertools.cycle(replicas) if replicas else None
+        self._pins: dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def pin(self, *keys: Hashable) -> None:
+        if not self.replicas:
+            return
+        deadline = time.monotonic() + self.pin_seconds
+        with self._lock:
+            for key in keys:
+                self._pins[key] = deadline
+            if len(self._pins) > self.PURGE_THRESHOLD:
+                now = time.monotonic()
+                self._pins = {k: d for k, d in self._pins.items() if d > now}
+
+    def engine(self, *keys: Hashable, read_committed: bool = False):
+        """keys のどれかが pin されていれば primary, そうでなければ次のレプリカ"""
+        target = self.primary
+        if self.replicas:
+            now = time.monotonic()
+            with self._lock:
+                pinned = False
+                for key in keys:
+                    deadline = self._pins.get(key)
+                    if deadline is None:
+                        continue
+                    if deadline > now:
+                        pinned = True
+                        break
+                    del self._pins[key]
+                if not pinned:
+                    target = next(self._cycle)
+        self._local.replica = target is not self.primary
+        return target[1] if read_committed else target[0]
+
+    def from_replica(self) -> bool:
+        """このスレッドで最後に engine() が選んだのがレプリカか"""
+        return getattr(self._local, "replica", False)
+
+
+replica_engines = []
+if config.REPLICA_DATABASE_URIS and engine is not None:
+    for uri in config.REPLICA_DATABASE_URIS:
+        if config.STORAGE == "mysql":
+            replica = create_engine(
+                uri, future=True, echo=config.SQL_ECHO, poolclass=TimedQueuePool
+            )
+            replica_rc = replica.execution_options(isolation_level="READ COMMITTED")
+        else:
+            replica = replica_rc = _create_sqlite_engine(uri, read_only=True)
+        instrument_engine(replica)
+        replica_engines.append((replica, replica_rc))
+read_router = ReadRouter(
+    (engine, readcommitted_engine), replica_engines, config.REPLICA_PIN_SECONDS
+)
+
+# aiomysql はasyncモードの時だけ必要なので, その時だけ作る
+async_engine = None
+if config.ASYNC_MODE:
+    from sqlalchemy.ext.asyncio import create_async_engine
 
-engine = create_engine(config.DATABASE_URI, future=True, echo=True)
+    if config.STORAGE != "mysql":
+        raise ValueError("GAMESERVER_ASYNC_MODE=1 requires GAMESERVER_STORAGE=mysql")
+    async_engine = create_async_engine(
+        config.ASYNC_DATABASE_URI,
+        echo=config.SQL_ECHO,
+        poolclass=TimedAsyncQueuePool,
+    )
+    instrument_engine(async_engine.sync_engine)
@@ -0,0 +1,269 @@
+"""ライブが終わったルームのスコアを NDJSON / CSV で書き出す (データ分析用の全件ダンプ)
+
+    python -m app.export --format csv --live-id 1001 --output results.csv --checkpoint results.ckpt
+
+storage.iter_export を (room_id, member_id) のキーで EXPORT_PAGE_SIZE 行ずつ読み
+(1ページ1文, サーバーサイドカーソルで流す), 行 → 1行分の bytes → 送る塊 とジェネレーターを
+つないで書くので, 全件でもメモリは一定. 1ページずつ別の文にするのは, 全履歴の ORDER BY を
+DB に抱えさせないためと, reaper がアーカイブへ移す途中でも各ページが1文で一貫するため.
+
+再開は最後に書いた行の (room_id, member_id) から (after). /admin/export では最終行の
+room_id, member_id を after=<room_id>:<member_id> に渡す. CLI は --checkpoint のファイルに
+ページごとの位置と出力のバイト数を書き, 次回はそこまで出力を切り詰めてから続きを書く.
+書き出し中にまだプレイ中だったルームは, 後から再開しても after より前なら含まれない.
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from enum import Enum
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+import orjson
+
+from . import config
+from .storage import Storage, create_storage
+
+COLUMNS = (
+    "room_id",
+    "member_id",
+    "live_id",
+    "select_difficulty",
+    "score",
+    "judge_perfect",
+    "judge_great",
+    "judge_good",
+    "judge_bad",
+    "judge_miss",
+    "scored_at",
+)
+
+Checkpoint = Tuple[int, int]
+START: Checkpoint = (0, 0)
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+}
+
+
+def parse_checkpoint(value: str) -> Checkpoint:
+    """<room_id>:<member_id> を読む. 形式が違えば ValueError"""
+    room_id, member_id = value.split(":")
+    return int(room_id), int(member_id)
+
+
+def iter_rows(
+    storage: Storage,
+    live_id: Optional[int] = None,
+    min_room_id: Optional[int] = None,
+    max_room_id: Optional[int] = None,
+    after: Checkpoint = START,
+    page_size: int = config.EXPORT_PAGE_SIZE,
+) -> Iterator[tuple]:
+    while True:
+        count = 0
+        rows = storage.iter_export(after, live_id, min_room_id, max_room_id, page_size)
+        for row in rows:
+            count += 1
+            yield row
+        if count < page_size:
+            return
+        after = (row[0], row[1])
+
+
+def _ndjson_line(row: tuple) -> bytes:
+    return (
+        orjson.dumps(
+            {
+                "room_id": row[0],
+                "member_id": row[1],
+                "live_id": row[2],
+                "select_difficulty": row[3],
+                "score": row[4],
+                "judge_count_list": list(row[5:10]),
+                "scored_at": row[10],
+            }
+        )
+        + b"\n"
+    )
+
+
+def line_encoder(format: ExportFormat) -> Callable[[tuple], bytes]:
+    """1行を bytes にする関数を返す"""
+    if format == ExportFormat.ndjson:
+        return _ndjson_line
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+
+    def line(row: tuple) -> bytes:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        return buffer.getvalue().encode()
+
+    return line
+
+
+def encode(
+    rows: Iterable[tuple], format: ExportFormat, header: bool = True
+) -> Iterator[bytes]:
+    """CSV は header=True なら先頭に列名を付ける"""
+    line = line_encoder(format)
+    if header and format == ExportFormat.csv:
+        yield line(COLUMNS)
+    for row in rows:
+        yield line(row)
+
+
+def chunked(
+    lines: Iterable[bytes], size: int = config.EXPORT_CHUNK_BYTES
+) -> Iterator[bytes]:
+    """size bytes くらいずつまとめる (1行ずつ送ると write の数が行数だけになる)"""
+    chunk: list[bytes] = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield b"".join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def stream(
+    storage: Storage,
+    format: ExportFormat,
+    live_id: Optional[int] = None,
+    min_room_id: Optional[int] = None,
+    max_room_id: Optional[int] = None,
+    after: Checkpoint = START,
+) -> Iterator[bytes]:
+    """/admin/export のレスポンス本体. 再開した時 (after あり) は CSV の列名を付けない"""
+    rows = iter_rows(storage, live_id, min_room_id, max_room_id, after)
+    return chunked(encode(rows, format, header=after == START))
+
+
+def _load_checkpoint(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _sync_checkpoint(path: str, out, row: tuple, rows: int) -> None:
+    """out を fsync してから, row までを書いたことを path に記録する"""
+    out.flush()
+    os.fsync(out.fileno())
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"after": [row[0], row[1]], "offset": out.tell(), "rows": rows}, f)
+    os.replace(tmp, path)
+
+
+def export_to_file(
+    storage: Storage,
+    path: str,
+    format: ExportFormat,
+    live_id: Optional[int] = None,
+    min_room_id: Optional[int] = None,
+    max_room_id: Optional[int] = None,
+    after: Checkpoint = START,
+    checkpoint: Optional[str] = None,
+    page_size: int = config.EXPORT_PAGE_SIZE,
+) -> int:
+    """path に書き出して, 今回書いた行数を返す
+
+    checkpoint のファイルがあれば, after の代わりにそこに記録した位置から, path をその時の
+    大きさまで切り詰めて続きを書く. page_size 行ごとに path を fsync してから checkpoint を
+    書き換えるので, 途中で落ちても checkpoint より後に書きかけた分は次回に捨てて書き直す (重複しない).
+    path が消えたか checkpoint の位置より短ければ, checkpoint は使わずに最初から書く.
+    """
+    state = _load_checkpoint(checkpoint) if checkpoint else None
+    if state is not None and (
+        not os.path.exists(path) or os.path.getsize(path) < state["offset"]
+    ):
+        state = None
+    if state is None:
+        offset, total, mode = 0, 0, "wb"
+        header = after == START
+    else:
+        after, offset, total = tuple(state["after"]), state["offset"], state["rows"]
+        mode, header = "r+b", False
+    line = line_encoder(format)
+    written = 0
+    with open(path, mode) as out:
+        out.truncate(offset)
+        out.seek(offset)
+        if header and format == ExportFormat.csv:
+            out.write(line(COLUMNS))
+        rows = iter_rows(storage, live_id, min_room_id, max_room_id, after, page_size)
+        for row in rows:
+            out.write(line(row))
+            written += 1
+            if checkpoint and written % page_size == 0:
+                _sync_checkpoint(checkpoint, out, row, total + written)
+        if checkpoint and written:
+            _sync_checkpoint(checkpoint, out, row, total + written)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--format", choices=[f.value for f in ExportFormat], default="ndjson"
+    )
+    parser.add_argument("--live-id", type=int)
+    parser.add_argument("--min-room-id", type=int)
+    parser.add_argument("--max-room-id", type=int)
+    parser.add_argument(
+        "--after", type=parse_checkpoint, default=START, help="<room_id>:<member_id>"
+    )
+    parser.add_argument("--output", help="省略すると stdout (--checkpoint は使えない)")
+    parser.add_argument("--checkpoint", help="途中から再開するための位置を書くファイル")
+    args = parser.parse_args()
+
+    format = ExportFormat(args.format)
+    storage = create_storage()
+    if args.output is None:
+        if args.checkpoint:
+            parser.error("--checkpoint requires --output")
+        chunks = stream(
+            storage,
+            format,
+            args.live_id,
+            args.min_room_id,
+            args.max_room_id,
+            args.after,
+        )
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        return
+    written = export_to_file(
+        storage,
+        args.output,
+        format,
+        args.live_id,
+        args.min_room_id,
+        args.max_room_id,
+        args.after,
+        args.checkpoint,
+    )
+    print(f"exported {written} rows to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
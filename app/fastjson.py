@@ -0,0 +1,144 @@
+"""ホットなエンドポイント (/room/list, /room/wait, /room/result) のレスポンスを直接 JSON にする
+
+FastAPI は response_model があると, 返した値を一度 dict にしてから response_model で
+検証し直し, jsonable_encoder を通してから json.dumps する. model が作った RoomUser などは
+検証済みなので, ここでは属性から dict を組んで orjson で bytes にし, Response をそのまま返す.
+(Response を返すと FastAPI は response_model での検証/変換を飛ばす. OpenAPI の定義には残る)
+
+キーの順序と値は response_model を通した場合と同じにする (docs/api.md の形式).
+config.FAST_JSON=False の時は response_model のオブジェクトを返して従来の経路に戻す.
+"""
+
+from typing import Optional
+
+import orjson
+from fastapi.responses import Response
+
+from . import config
+from .ResReqModel import (
+    ResultUser,
+    RoomInfo,
+    RoomListResponse,
+    RoomResultResponse,
+    RoomUser,
+    RoomWaitPollResponse,
+    RoomWaitResponse,
+    WaitRoomStatus,
+)
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+def _room_info(room: RoomInfo) -> dict:
+    return {
+        "room_id": room.room_id,
+        "live_id": room.live_id,
+        "joined_user_count": room.joined_user_count,
+        "max_user_count": room.max_user_count,
+    }
+
+
+def _room_user(user: RoomUser) -> dict:
+    return {
+        "user_id": user.user_id,
+        "name": user.name,
+        "leader_card_id": user.leader_card_id,
+        "select_difficulty": user.select_difficulty.value,
+        "is_me": user.is_me,
+        "is_host": user.is_host,
+    }
+
+
+def _result_user(user: ResultUser) -> dict:
+    return {
+        "user_id": user.user_id,
+        "judge_count_list": user.judge_count_list,
+        "score": user.score,
+    }
+
+
+def _versioned(body: dict, version: Optional[int], unchanged: bool) -> dict:
+    # version を送ってきたクライアントにだけ返す (従来のレスポンスの形は変えない)
+    if version is not None:
+        body["version"] = version
+        body["unchanged"] = unchanged
+    return body
+
+
+def room_list_response(
+    room_info_list: list[RoomInfo],
+    next_cursor: Optional[int],
+    version: Optional[int] = None,
+    unchanged: bool = False,
+):
+    if not config.FAST_JSON:
+        versioned = (
+            {} if version is None else {"version": version, "unchanged": unchanged}
+        )
+        return RoomListResponse(
+            room_info_list=room_info_list, next_cursor=next_cursor, **versioned
+        )
+    return FastJSONResponse(
+        _versioned(
+            {
+                "room_info_list": [_room_info(room) for room in room_info_list],
+                "next_cursor": next_cursor,
+            },
+            version,
+            unchanged,
+        )
+    )
+
+
+def room_wait_response(
+    status: WaitRoomStatus,
+    room_user_list: list[RoomUser],
+    version: Optional[int] = None,
+    unchanged: bool = False,
+):
+    if not config.FAST_JSON:
+        versioned = (
+            {} if version is None else {"version": version, "unchanged": unchanged}
+        )
+        return RoomWaitResponse(
+            status=status, room_user_list=room_user_list, **versioned
+        )
+    return FastJSONResponse(
+        _versioned(
+            {
+                "status": status.value,
+                "room_user_list": [_room_user(user) for user in room_user_list],
+            },
+            version,
+            unchanged,
+        )
+    )
+
+
+def room_wait_poll_response(
+    version: int, status: WaitRoomStatus, room_user_list: list[RoomUser]
+):
+    if not config.FAST_JSON:
+        return RoomWaitPollResponse(
+            version=version, status=status, room_user_list=room_user_list
+        )
+    return FastJSONResponse(
+        {
+            "version": version,
+            "status": status.value,
+            "room_user_list": [_room_user(user) for user in room_user_list],
+        }
+    )
+
+
+def room_result_response(result_user_list: list[ResultUser]):
+    if not config.FAST_JSON:
+        return RoomResultResponse(result_user_list=result_user_list)
+    return FastJSONResponse(
+        {"result_user_list": [_result_user(user) for user in result_user_list]}
+    )
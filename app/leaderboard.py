@@ -0,0 +1,141 @@
+"""ライブ (live_id, 難易度) ごとのスコアランキング
+
+end_room のたびに上位 LEADERBOARD_SIZE 件だけをメモリ上のソート済みリストで更新し,
+/live/leaderboard はそこから先頭 k 件を切り出すだけにする (member を ORDER BY しない).
+1ユーザー1件 (自己ベスト) で, 同点なら先に出した方が上.
+
+起動時に storage の全スコア (アーカイブ済みを含む) を1回なめて作り直す.
+/user/update の名前/アバターの変更もその worker のランキングに反映する.
+更新はプロセス内だけなので, 複数worker構成では各workerが起動後に自分で受けた end_room と
+/user/update しか反映しない (再起動で揃う).
+"""
+
+import bisect
+import itertools
+import logging
+import threading
+from typing import Iterable, Optional, Tuple
+
+from . import config
+from .ResReqModel import LeaderboardEntry, LiveDifficulty
+
+logger = logging.getLogger(__name__)
+
+
+class _Board:
+    """上位 size 件のソート済みリスト
+
+    要素は (-score, seq, user_id, name, leader_card_id). 昇順に並べると上位から並ぶ.
+    位置は bisect で O(log n) で探す.
+    """
+
+    __slots__ = ("size", "entries", "by_user")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: list[tuple] = []
+        # user_id -> entries に入っている要素
+        self.by_user: dict[int, tuple] = {}
+
+    def add(self, entry: tuple) -> bool:
+        user_id = entry[2]
+        old = self.by_user.get(user_id)
+        if old is not None:
+            if old[0] <= entry[0]:
+                # 自己ベストを更新していない
+                return False
+            del self.entries[bisect.bisect_left(self.entries, old)]
+        elif len(self.entries) >= self.size and self.entries[-1] < entry:
+            # 圏外
+            return False
+        bisect.insort(self.entries, entry)
+        self.by_user[user_id] = entry
+        if len(self.entries) > self.size:
+            dropped = self.entries.pop()
+            del self.by_user[dropped[2]]
+        return True
+
+    def update_user(self, user_id: int, name: str, leader_card_id: int) -> None:
+        old = self.by_user.get(user_id)
+        if old is None:
+            return
+        # 名前とアバターは並びに関係しないので同じ位置で置き換える
+        entry = old[:3] + (name, leader_card_id)
+        self.entries[bisect.bisect_left(self.entries, old)] = entry
+        self.by_user[user_id] = entry
+
+
+class Leaderboard:
+    def __init__(self, size: int = config.LEADERBOARD_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._boards: dict[Tuple[int, LiveDifficulty], _Board] = {}
+
+    def record(
+        self,
+        live_id: int,
+        difficulty: LiveDifficulty,
+        user_id: int,
+        name: str,
+        leader_card_id: int,
+        score: int,
+    ) -> bool:
+        """スコアを反映する. ランキングが変わったら True"""
+        key = (live_id, LiveDifficulty(difficulty))
+        with self._lock:
+            board = self._boards.get(key)
+            if board is None:
+                board = self._boards[key] = _Board(self.size)
+            entry = (-score, next(self._seq), user_id, name, leader_card_id)
+            return board.add(entry)
+
+    def update_user(self, user_id: int, name: str, leader_card_id: int) -> None:
+        """名前/アバターの変更を, そのユーザーが載っている全ランキングに反映する"""
+        with self._lock:
+            for board in self._boards.values():
+                board.update_user(user_id, name, leader_card_id)
+
+    def top(
+        self, live_id: int, difficulty: LiveDifficulty, limit: Optional[int] = None
+    ) -> list[LeaderboardEntry]:
+        if limit is None or limit <= 0 or limit > self.size:
+            limit = self.size
+        with self._lock:
+            board = self._boards.get((live_id, LiveDifficulty(difficulty)))
+            entries = [] if board is None else board.entries[:limit]
+        return [
+            LeaderboardEntry(
+                rank=rank,
+                user_id=user_id,
+                name=name,
+                leader_card_id=leader_card_id,
+                score=-neg_score,
+            )
+            for rank, (neg_score, _, user_id, name, leader_card_id) in enumerate(
+                entries, 1
+            )
+        ]
+
+    def rebuild(self, rows: Iterable[tuple]) -> int:
+        """(live_id, difficulty, user_id, name, leader_card_id, score) の列から作り直す
+
+        rows は storage.iter_scores() のように全件を流すだけでよく, 並んでいる必要はない.
+        """
+        boards: dict[Tuple[int, LiveDifficulty], _Board] = {}
+        count = 0
+        for live_id, difficulty, user_id, name, leader_card_id, score in rows:
+            key = (live_id, LiveDifficulty(difficulty))
+            board = boards.get(key)
+            if board is None:
+                board = boards[key] = _Board(self.size)
+            # 読み込み中の seq は end_room の順ではないが, 同点の順は再起動をまたいで保証しない
+            board.add((-score, next(self._seq), user_id, name, leader_card_id))
+            count += 1
+        with self._lock:
+            self._boards = boards
+        logger.info("leaderboard rebuilt from %d scores", count)
+        return count
+
+
+leaderboard = Leaderboard()
@@ -0,0 +1,400 @@
+"""DB を使わずプロセス内の dict だけで持つ Storage
+
+単一ノードでの低レイテンシ運用や, MySQL なしで動かすテスト/ベンチマーク用.
+全操作を1つのロックで直列にするので, SQL 版と同じく定員を超えた join は起きない.
+プロセスが落ちると全部消える. 状態はプロセス内にしかないので uvicorn は worker 1つで動かすこと.
+reaper が片付けたルームはアーカイブせずに捨てる.
+"""
+
+import itertools
+import threading
+import time
+import uuid
+from typing import Iterator, Optional, Tuple
+
+from .config import MAX_USER_COUNT
+from .ResReqModel import (
+    JoinRoomResult,
+    LiveDifficulty,
+    ResultUser,
+    RoomInfo,
+    RoomUser,
+    WaitRoomStatus,
+)
+from .storage import SafeUser, Storage, listing_version_base
+
+
+class _Member:
+    __slots__ = ("user_id", "difficulty", "score", "judge_count_list", "scored_at")
+
+    def __init__(self, user_id: int, difficulty: LiveDifficulty):
+        self.user_id = user_id
+        self.difficulty = difficulty
+        self.score: Optional[int] = None
+        self.judge_count_list: Optional[list[int]] = None
+        self.scored_at = 0
+
+
+class _Room:
+    __slots__ = (
+        "room_id",
+        "live_id",
+        "status",
+        "owner",
+        "members",
+        "left",
+        "updated_at",
+        "version",
+    )
+
+    def __init__(self, room_id: int, live_id: int, owner: int):
+        self.room_id = room_id
+        self.live_id = live_id
+        self.status = WaitRoomStatus.Waiting
+        self.owner = owner
+        self.updated_at = time.time()
+        # メンバー/オーナー/状態が変わるたびに +1 (wait_room_since 用)
+        self.version = 1
+        # user_id -> _Member (入室順)
+        self.members: dict[int, _Member] = {}
+        # 結果を出した後に抜けたメンバー. ランキング/集計/書き出し用に残す
+        self.left: dict[int, _Member] = {}
+
+    def all_members(self) -> dict[int, _Member]:
+        """抜けたメンバーも含めた user_id -> _Member"""
+        return {**self.members, **self.left}
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_ids = itertools.count(1)
+        self._room_ids = itertools.count(1)
+        self._users: dict[int, SafeUser] = {}
+        self._tokens: dict[str, int] = {}
+        # room_id 昇順 (挿入順) に並ぶ
+        self._rooms: dict[int, _Room] = {}
+        # live_id -> /room/list の version. 0 は全体
+        self._listing_base = listing_version_base()
+        self._listing_versions: dict[int, int] = {}
+
+    def _listing_changed(self, live_id: int) -> None:
+        """self._lock を取った状態で呼ぶ"""
+        for key in (live_id, 0):
+            self._listing_versions[key] = self._listing_versions.get(key, 0) + 1
+
+    def create_user(self, name: str, leader_card_id: int) -> Tuple[str, SafeUser]:
+        token = str(uuid.uuid4())
+        with self._lock:
+            user = SafeUser(
+                id=next(self._user_ids), name=name, leader_card_id=leader_card_id
+            )
+            self._users[user.id] = user
+            self._tokens[token] = user.id
+        return token, user
+
+    def get_user_by_token(self, token: str) -> Optional[SafeUser]:
+        with self._lock:
+            user_id = self._tokens.get(token)
+            return None if user_id is None else self._users[user_id]
+
+    def get_user_by_id(self, user_id: int) -> Optional[SafeUser]:
+        with self._lock:
+            return self._users.get(user_id)
+
+    def update_user(self, user_id: int, name: str, leader_card_id: int) -> None:
+        with self._lock:
+            if user_id in self._users:
+                self._users[user_id] = SafeUser(
+                    id=user_id, name=name, leader_card_id=leader_card_id
+                )
+
+    def _create_room(
+        self, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+    ) -> int:
+        room = _Room(next(self._room_ids), live_id, user_id)
+        room.members[user_id] = _Member(user_id, select_difficulty)
+        self._rooms[room.room_id] = room
+        self._listing_changed(live_id)
+        return room.room_id
+
+    def create_room(
+        self, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+    ) -> int:
+        with self._lock:
+            return self._create_room(user_id, live_id, select_difficulty)
+
+    def list_room(
+        self, live_id: int, cursor: int, limit: int
+    ) -> Tuple[list[RoomInfo], Optional[int]]:
+        with self._lock:
+            page = []
+            for room in self._rooms.values():
+                if (
+                    room.room_id <= cursor
+                    or room.status != WaitRoomStatus.Waiting
+                    or (live_id != 0 and room.live_id != live_id)
+                    or len(room.members) >= MAX_USER_COUNT
+                ):
+                    continue
+                page.append(
+                    RoomInfo(
+                        room_id=room.room_id,
+                        live_id=room.live_id,
+                        joined_user_count=len(room.members),
+                        max_user_count=MAX_USER_COUNT,
+                    )
+                )
+                if len(page) > limit:
+                    break
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = page[-1].room_id
+        return page, next_cursor
+
+    def list_room_since(
+        self, live_id: int, cursor: int, limit: int, known_version: int
+    ) -> Tuple[int, Optional[Tuple[list[RoomInfo], Optional[int]]]]:
+        with self._lock:
+            version = self._listing_base + self._listing_versions.get(live_id, 0)
+        if known_version != 0 and version == known_version:
+            return version, None
+        # version を先に読むので, 間に変わってもページの方が新しいだけ
+        return version, self.list_room(live_id, cursor, limit)
+
+    def join_room(
+        self, room_id: int, user_id: int, select_difficulty: LiveDifficulty
+    ) -> JoinRoomResult:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if (
+                room is None
+                or room.status == WaitRoomStatus.Dissolution
+                # ライブ後に全員抜けたルーム (LiveStart のまま)
+                or not room.members
+            ):
+                return JoinRoomResult.Disbanded
+            if user_id in room.members:
+                return JoinRoomResult.Ok
+            if room.status != WaitRoomStatus.Waiting:
+                return JoinRoomResult.OtherError
+            if len(room.members) >= MAX_USER_COUNT:
+                return JoinRoomResult.RoomFull
+            room.members[user_id] = _Member(user_id, select_difficulty)
+            room.updated_at = time.time()
+            room.version += 1
+            self._listing_changed(room.live_id)
+            return JoinRoomResult.Ok
+
+    def quick_join(
+        self, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+    ) -> Tuple[int, bool]:
+        with self._lock:
+            best = None
+            for room in self._rooms.values():
+                if (
+                    room.status != WaitRoomStatus.Waiting
+                    or room.live_id != live_id
+                    or len(room.members) >= MAX_USER_COUNT
+                ):
+                    continue
+                if user_id in room.members:
+                    return room.room_id, False
+                # 同数なら room_id が小さい方 (先に見た方)
+                if best is None or len(room.members) > len(best.members):
+                    best = room
+            if best is not None:
+                best.members[user_id] = _Member(user_id, select_difficulty)
+                best.updated_at = time.time()
+                best.version += 1
+                self._listing_changed(live_id)
+                return best.room_id, False
+            return self._create_room(user_id, live_id, select_difficulty), True
+
+    def wait_room(
+        self, room_id: int, user_id: int
+    ) -> Tuple[WaitRoomStatus, list[RoomUser]]:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None or not room.members:
+                return WaitRoomStatus.Dissolution, []
+            return room.status, self._room_user_list(room, user_id)
+
+    def wait_room_since(
+        self, room_id: int, user_id: int, known_version: int
+    ) -> Tuple[int, WaitRoomStatus, Optional[list[RoomUser]]]:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return 0, WaitRoomStatus.Dissolution, []
+            if room.version == known_version:
+                return room.version, room.status, None
+            if not room.members:
+                return room.version, WaitRoomStatus.Dissolution, []
+            return room.version, room.status, self._room_user_list(room, user_id)
+
+    def _room_user_list(self, room: _Room, user_id: int) -> list[RoomUser]:
+        """self._lock を取った状態で呼ぶ"""
+        room_user_list = []
+        for member in room.members.values():
+            user = self._users[member.user_id]
+            room_user_list.append(
+                RoomUser(
+                    user_id=user.id,
+                    name=user.name,
+                    leader_card_id=user.leader_card_id,
+                    select_difficulty=member.difficulty,
+                    is_me=user.id == user_id,
+                    is_host=user.id == room.owner,
+                )
+            )
+        return room_user_list
+
+    def start_room(self, room_id: int, user_id: int) -> None:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is not None and room.owner == user_id:
+                room.status = WaitRoomStatus.LiveStart
+                room.updated_at = time.time()
+                room.version += 1
+                self._listing_changed(room.live_id)
+
+    def end_room(
+        self, room_id: int, user_id: int, score: int, judge_count_list: list[int]
+    ) -> Optional[Tuple[int, LiveDifficulty, SafeUser]]:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            member = None if room is None else room.all_members().get(user_id)
+            if member is None:
+                return None
+            member.score = score
+            member.judge_count_list = list(judge_count_list)
+            member.scored_at = int(time.time())
+            return room.live_id, member.difficulty, self._users[user_id]
+
+    def result_room(self, room_id: int) -> list[ResultUser]:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return []
+            members = list(room.all_members().values())
+        if any(member.score is None for member in members):
+            return []
+        return [
+            ResultUser(
+                user_id=member.user_id,
+                judge_count_list=member.judge_count_list,
+                score=member.score,
+            )
+            for member in members
+        ]
+
+    def leave_room(self, room_id: int, user_id: int) -> None:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None or user_id not in room.members:
+                return None
+            member = room.members.pop(user_id)
+            if member.score is not None:
+                room.left[user_id] = member
+            room.updated_at = time.time()
+            room.version += 1
+            self._listing_changed(room.live_id)
+            if room.owner == user_id:
+                if room.members:
+                    # sql_storage と同じく user_id が一番小さいメンバー
+                    room.owner = min(room.members)
+                elif room.status == WaitRoomStatus.Waiting:
+                    # ライブ後に全員抜けたルームは LiveStart のまま (sql_storage と同じ)
+                    room.status = WaitRoomStatus.Dissolution
+
+    def archive_rooms(
+        self, finished_before: int, idle_before: int, limit: int
+    ) -> list[int]:
+        with self._lock:
+            room_ids = []
+            for room in self._rooms.values():
+                finished = room.status == WaitRoomStatus.Dissolution or (
+                    room.status == WaitRoomStatus.LiveStart
+                    and all(
+                        m.score is not None and m.scored_at < finished_before
+                        for m in room.all_members().values()
+                    )
+                )
+                if (finished and room.updated_at < finished_before) or (
+                    room.updated_at < idle_before
+                ):
+                    room_ids.append(room.room_id)
+                    if len(room_ids) >= limit:
+                        break
+            for room_id in room_ids:
+                self._listing_changed(self._rooms.pop(room_id).live_id)
+        return room_ids
+
+    def iter_scores(self) -> Iterator[tuple]:
+        with self._lock:
+            rows = [
+                (room.live_id, member.difficulty, member.user_id, member.score)
+                for room in self._rooms.values()
+                for member in room.all_members().values()
+                if member.score is not None
+            ]
+            users = dict(self._users)
+        for live_id, difficulty, user_id, score in rows:
+            user = users[user_id]
+            yield live_id, difficulty, user_id, user.name, user.leader_card_id, score
+
+    def iter_results(self, scored_from: int, scored_before: int) -> Iterator[tuple]:
+        with self._lock:
+            rows = [
+                (
+                    room.room_id,
+                    user_id,
+                    room.live_id,
+                    member.difficulty.value,
+                    member.score,
+                    *member.judge_count_list,
+                    member.scored_at,
+                )
+                for room in self._rooms.values()
+                for user_id, member in room.all_members().items()
+                if member.score is not None
+                and scored_from <= member.scored_at < scored_before
+            ]
+        return iter(rows)
+
+    def iter_export(
+        self,
+        after: Tuple[int, int],
+        live_id: Optional[int],
+        min_room_id: Optional[int],
+        max_room_id: Optional[int],
+        limit: int,
+    ) -> Iterator[tuple]:
+        rows = []
+        with self._lock:
+            # _rooms は room_id 昇順
+            for room in self._rooms.values():
+                if (
+                    room.room_id < after[0]
+                    or room.status != WaitRoomStatus.LiveStart
+                    or (live_id is not None and room.live_id != live_id)
+                    or (min_room_id is not None and room.room_id < min_room_id)
+                    or any(m.score is None for m in room.members.values())
+                ):
+                    continue
+                if max_room_id is not None and room.room_id > max_room_id:
+                    break
+                members = room.all_members()
+                for user_id in sorted(members):
+                    if (room.room_id, user_id) <= after:
+                        continue
+                    member = members[user_id]
+                    rows.append(
+                        (room.room_id, user_id, room.live_id, member.difficulty.value)
+                        + (member.score, *member.judge_count_list, member.scored_at)
+                    )
+                if len(rows) >= limit:
+                    break
+        return iter(rows[:limit])
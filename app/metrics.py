@@ -0,0 +1,276 @@
+"""リクエスト/SQL の計測と /metrics 用の出力
+
+- エンドポイント別のレイテンシのヒストグラム
+- リクエストあたりのSQL文の数と実行時間 (engine の cursor イベントで数える)
+- コネクションプールのチェックアウト待ち時間
+"""
+
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50)
+
+
+class Histogram:
+    """Prometheus と同じ累積バケットのヒストグラム"""
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> tuple[list[tuple[str, int]], float, int]:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        acc = 0
+        for bound, n in zip(self.buckets, counts):
+            acc += n
+            cumulative.append((repr(float(bound)), acc))
+        cumulative.append(("+Inf", count))
+        return cumulative, total, count
+
+
+class LabeledHistogram:
+    """ラベル (endpoint) ごとに Histogram を持つ"""
+
+    def __init__(self, name: str, help: str, buckets: Iterable[float]):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._children: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, endpoint: str) -> Histogram:
+        child = self._children.get(endpoint)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(endpoint, Histogram(self.buckets))
+        return child
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for endpoint, child in children:
+            cumulative, total, count = child.snapshot()
+            for le, n in cumulative:
+                lines.append(
+                    f'{self.name}_bucket{{endpoint="{endpoint}",le="{le}"}} {n}'
+                )
+            lines.append(f'{self.name}_sum{{endpoint="{endpoint}"}} {total}')
+            lines.append(f'{self.name}_count{{endpoint="{endpoint}"}} {count}')
+        return lines
+
+
+request_duration = LabeledHistogram(
+    "gameserver_request_duration_seconds",
+    "Request latency per endpoint",
+    LATENCY_BUCKETS,
+)
+request_sql_statements = LabeledHistogram(
+    "gameserver_request_sql_statements",
+    "SQL statements executed per request",
+    COUNT_BUCKETS,
+)
+request_sql_duration = LabeledHistogram(
+    "gameserver_request_sql_duration_seconds",
+    "Time spent executing SQL per request",
+    LATENCY_BUCKETS,
+)
+pool_checkout_wait = Histogram(LATENCY_BUCKETS)
+
+
+class RequestStats:
+    """1リクエスト分の計測値. contextvar 経由で engine のイベントから加算される"""
+
+    __slots__ = ("statements", "sql_time", "pool_wait")
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_time = 0.0
+        self.pool_wait = 0.0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar(
+    "current_request", default=None
+)
+# プロファイル中のリクエストの SQL/プール待ちの記録 (app/profiling.py).
+# (種類, 開始時刻 perf_counter, 所要秒, SQL文) を足していく
+current_timeline: ContextVar[Optional[list[tuple]]] = ContextVar(
+    "current_timeline", default=None
+)
+
+
+_TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+def is_transaction_control(statement: str) -> bool:
+    """SQLite の begin イベントで流す BEGIN IMMEDIATE など. SQL 文の数には入れない"""
+    return statement.lstrip().upper().startswith(_TRANSACTION_CONTROL)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start_time"].pop()
+    elapsed = time.perf_counter() - started
+    stats = current_request.get()
+    if stats is not None:
+        # tests/test_query_budget.py の上限と同じ数え方にする (時間の方には入れる)
+        if not is_transaction_control(statement):
+            stats.statements += 1
+        stats.sql_time += elapsed
+    timeline = current_timeline.get()
+    if timeline is not None:
+        timeline.append(("sql", started, elapsed, statement))
+
+
+def instrument_engine(engine) -> None:
+    """engine (AsyncEngine の場合は .sync_engine) にSQL計測用のイベントを付ける"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class _TimedPoolMixin:
+    """チェックアウトにかかった時間 (空きコネクション待ち + 新規接続) を記録する"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.perf_counter() - started
+            pool_checkout_wait.observe(elapsed)
+            stats = current_request.get()
+            if stats is not None:
+                stats.pool_wait += elapsed
+            timeline = current_timeline.get()
+            if timeline is not None:
+                timeline.append(("pool_wait", started, elapsed, None))
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def endpoint_label(request) -> str:
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    # 古い Starlette は scope に route を入れないが, ルートがマッチすれば endpoint は入る
+    if "endpoint" in request.scope:
+        return request.url.path
+    return "<unmatched>"
+
+
+async def middleware(request, call_next: Callable):
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    stats = RequestStats()
+    token = current_request.set(stats)
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        current_request.reset(token)
+        elapsed = time.perf_counter() - started
+        endpoint = endpoint_label(request)
+        request_duration.labels(endpoint).observe(elapsed)
+        request_sql_statements.labels(endpoint).observe(stats.statements)
+        request_sql_duration.labels(endpoint).observe(stats.sql_time)
+        if config.LOG_SAMPLE_RATE > 0 and random.random() < config.LOG_SAMPLE_RATE:
+            logger.info(
+                "%s %s status=%d elapsed=%.2fms sql=%d sql_time=%.2fms pool_wait=%.2fms",
+                request.method,
+                endpoint,
+                status_code,
+                elapsed * 1000,
+                stats.statements,
+                stats.sql_time * 1000,
+                stats.pool_wait * 1000,
+            )
+
+
+def _render_histogram(name: str, help: str, histogram: Histogram) -> list[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    cumulative, total, count = histogram.snapshot()
+    for le, n in cumulative:
+        lines.append(f'{name}_bucket{{le="{le}"}} {n}')
+    lines.append(f"{name}_sum {total}")
+    lines.append(f"{name}_count {count}")
+    return lines
+
+
+def _render_cache(name: str, stats: dict[str, int]) -> list[str]:
+    lines = []
+    for key, value in stats.items():
+        metric = f"gameserver_{name}_{key}"
+        kind = "gauge" if key in ("size", "maxsize") else "counter"
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.append(f"{metric} {value}")
+    return lines
+
+
+# /metrics に載せる追加のキャッシュ統計. name -> stats() を返す関数
+cache_stats: dict[str, Callable[[], dict[str, int]]] = {}
+
+
+def render() -> str:
+    lines: list[str] = []
+    lines += request_duration.render()
+    lines += request_sql_statements.render()
+    lines += request_sql_duration.render()
+    lines += _render_histogram(
+        "gameserver_pool_checkout_wait_seconds",
+        "Time waiting to check out a DB connection",
+        pool_checkout_wait,
+    )
+    for name, stats in sorted(cache_stats.items()):
+        lines += _render_cache(name, stats())
+    return "\n".join(lines) + "\n"
@@ -1,459 +1,358 @@
-import json
-import uuid
-from enum import Enum, IntEnum
-from typing import Optional, Tuple
+"""user/room の操作
+
+永続化は storage (config.STORAGE で MySQL / SQLite / メモリを選ぶ) に任せ,
+ここでは token の解決 (キャッシュ), ルームレジストリへの振り分け, 変更通知を行う.
+"""
 
-from fastapi import HTTPException
-from pydantic import BaseModel
-from pyparsing import Opt
-from sqlalchemy import text
-from sqlalchemy.exc import NoResultFound
-from urllib3 import Retry
+import concurrent.futures
+import logging
+from typing import Optional, Tuple
 
-from .config import MAX_USER_COUNT
-from .db import engine
+from .analytics import live_stats
+from .auth import InvalidToken, token_signer
+from .cache import LRUCache
+from .config import (
+    RESULT_CACHE_SIZE,
+    RESULT_CACHE_TTL,
+    ROOM_LIST_DEFAULT_LIMIT,
+    ROOM_LIST_MAX_LIMIT,
+    ROOM_REGISTRY_FLUSH_TIMEOUT,
+    SCORE_BATCH_TIMEOUT,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+)
+from .db import read_router
+from .leaderboard import leaderboard
+from .notify import room_notifier
+from .registry import RegistryWriteError, room_registry
 from .ResReqModel import (
     JoinRoomResult,
     LiveDifficulty,
+    LiveStats,
     ResultUser,
     RoomInfo,
     RoomUser,
     WaitRoomStatus,
 )
+from .score_writer import ScoreWriterError, score_writer
+from .shared_cache import shared_cache
+from .storage import SafeUser, create_storage
 
+logger = logging.getLogger(__name__)
 
-class InvalidToken(Exception):
-    """指定されたtokenが不正だったときに投げる"""
-
+storage = create_storage()
 
-class SafeUser(BaseModel):
-    """token を含まないUser"""
-
-    id: int
-    name: str
-    leader_card_id: int
-
-    class Config:
-        orm_mode = True
+# token (署名付き token の場合は user_id) -> SafeUser. 認証のたびに user テーブルを引かないためのキャッシュ
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# room_id -> list[ResultUser]. 全員のスコアが揃って以降は変わらないので, 揃った時点で入れる
+result_cache = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
 
 
 def create_user(name: str, leader_card_id: int) -> str:
     """Create new user and returns their token"""
-    token = str(uuid.uuid4())
-    # NOTE: tokenが衝突したらリトライする必要がある.
-    with engine.begin() as conn:
-        result = conn.execute(
-            text(
-                "INSERT INTO `user` (name, token, leader_card_id) VALUES (:name, :token, :leader_card_id)"
-            ),
-            {"name": name, "token": token, "leader_card_id": leader_card_id},
-        )
-        # print(result)
+    token, user = storage.create_user(name, leader_card_id)
+    if token_signer.enabled:
+        # DB に入れた uuid の token は渡さず, 署名付き token だけを使わせる
+        token = token_signer.sign(user.id)
+        user_cache.set(user.id, user)
+    else:
+        user_cache.set(token, user)
     return token
 
 
-def _get_user_by_token(conn, token: str) -> Optional[SafeUser]:
-    # TODO: 実装
-    result = conn.execute(
-        text("SELECT `id`, `name`, `leader_card_id` FROM `user` WHERE `token`=:token"),
-        {"token": token},
-    )
-    try:
-        row = result.one()
-    except NoResultFound:
-        return None
-    return SafeUser.from_orm(row)
+def _get_user_by_id(user_id: int) -> Optional[SafeUser]:
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    user = storage.get_user_by_id(user_id)
+    if user is not None:
+        user_cache.set(user_id, user)
+    return user
 
 
 def get_user_by_token(token: str) -> Optional[SafeUser]:
-    with engine.begin() as conn:
-        return _get_user_by_token(conn, token)
-
-
-def update_user(token: str, name: str, leader_card_id: int) -> None:
-    # このコードを実装してもらう
-    with engine.begin() as conn:
-        # TODO: 実装
-        try:
-            _id = _get_user_by_token(conn, token).id
-            conn.execute(
-                text(
-                    "UPDATE `user` SET name=:name, leader_card_id=:leader_card_id WHERE id=:id"
-                ),
-                {"name": name, "leader_card_id": leader_card_id, "id": _id},
-            )
-        except NoResultFound:
-            return None
-
-
-def _insert_member(conn, room_id, user_id, select_difficulty: LiveDifficulty):
     try:
-        conn.execute(
-            text(
-                "INSERT INTO `member` (room_id, member_id, difficulty) VALUES (:room_id, :user_id, :select_difficulty)"
-            ),
-            {
-                "room_id": room_id,
-                "user_id": user_id,
-                "select_difficulty": select_difficulty.value,
-            },
-        )
-    except NoResultFound:
+        user_id = token_signer.user_id(token)
+    except InvalidToken:
+        return None
+    if user_id is not None:
+        return _get_user_by_id(user_id)
+    user = user_cache.get(token)
+    if user is not None:
+        return user
+    user = storage.get_user_by_token(token)
+    if user is not None:
+        user_cache.set(token, user)
+    return user
+
+
+class Caller:
+    """1リクエストの呼び出し元. token の検証とユーザーの解決をリクエストごとに1回にする
+
+    API では依存 (app/caller.py) で作り, ルートから model の関数に渡す.
+    署名付き token なら user_id は検証だけで決まり, user は要る時 (registry など) に1回だけ引く.
+    uuid の token は user を引いて user_id を決める.
+    """
+
+    __slots__ = ("token", "user_id", "user")
+
+    def __init__(self, token: str, user_id: int, user: Optional[SafeUser] = None):
+        self.token = token
+        self.user_id = user_id
+        self.user = user
+
+
+def peek_caller(token: str) -> Optional[Caller]:
+    """I/O なしで作れる時だけ Caller を返す (署名付き token か, キャッシュに当たった uuid の token)
+
+    署名付き token の検証に失敗したら InvalidToken.
+    """
+    user_id = token_signer.user_id(token)
+    if user_id is not None:
+        return Caller(token, user_id, user_cache.get(user_id))
+    user = user_cache.get(token)
+    if user is None:
         return None
+    return Caller(token, user.id, user)
+
+
+def resolve_caller(token: str) -> Caller:
+    caller = peek_caller(token)
+    if caller is not None:
+        return caller
+    user = storage.get_user_by_token(token)
+    if user is None:
+        raise InvalidToken
+    user_cache.set(token, user)
+    return Caller(token, user.id, user)
+
+
+def caller_user(caller: Caller) -> SafeUser:
+    """caller の SafeUser. 引いたものは caller に残すので, 同じリクエストでは1回しか引かない"""
+    if caller.user is None:
+        user = _get_user_by_id(caller.user_id)
+        if user is None:
+            raise InvalidToken
+        caller.user = user
+    return caller.user
+
+
+def refresh_token(caller: Caller) -> str:
+    """今の鍵で署名した token を発行し直す (鍵の入れ替えや uuid の token からの移行用)"""
+    if not token_signer.enabled:
+        return caller.token
+    return token_signer.sign(caller.user_id)
+
+
+def _after_update_user(token: str, user: SafeUser) -> None:
+    # commit 後に消す. 先に消すと commit 前の古い値を別リクエストが入れ直しうる
+    user_cache.pop(token)
+    user_cache.pop(user.id)
+    leaderboard.update_user(user.id, user.name, user.leader_card_id)
+    if room_registry is not None:
+        room_registry.update_user(user)
+
+
+def update_user(caller: Caller, name: str, leader_card_id: int) -> None:
+    storage.update_user(caller.user_id, name, leader_card_id)
+    _after_update_user(
+        caller.token,
+        SafeUser(id=caller.user_id, name=name, leader_card_id=leader_card_id),
+    )
+
+
+def _room_changed(room_id: Optional[int]) -> None:
+    """ルームの変更を commit した後に呼ぶ. None なら新しいルームができた (/room/list だけ変わる)"""
+    # shared_cache は読む時に DB の version と比べるので, ここでは触らない
+    if room_id is not None:
+        room_notifier.notify(room_id)
 
 
-def create_room(host_token: str, live_id: int, select_difficulty: LiveDifficulty):
+def create_room(host: Caller, live_id: int, select_difficulty: LiveDifficulty):
     assert (
         select_difficulty == LiveDifficulty.Normal
         or select_difficulty == LiveDifficulty.Hard
     )
-    with engine.begin() as conn:
-        user_id = _get_user_by_token(conn, host_token).id
-        result = conn.execute(
-            text(
-                "INSERT INTO `room` (live_id, status, owner) VALUES (:live_id, :status, :owner)"
-            ),
-            {
-                "live_id": live_id,
-                "status": WaitRoomStatus.Waiting.value,
-                "owner": user_id,
-            },
-        )
-
-        room_id = result.lastrowid
-        _insert_member(conn, room_id, user_id, select_difficulty)
+    room_id = storage.create_room(host.user_id, live_id, select_difficulty)
+    if room_registry is not None:
+        room_registry.add_room(room_id, live_id, caller_user(host), select_difficulty)
+    _room_changed(None)
     return room_id
 
 
-def _get_room_member_cnt_rom_room_by_live_id(
-    conn, live_id: int
-) -> list[Optional[RoomInfo]]:
-    try:
-        where_query = "WHERE room.live_id=:live_id" if live_id != 0 else ""
-        result = conn.execute(
-            text(
-                f"""
-                SELECT room.room_id, live_id, COUNT(member_id) AS joined_user_count
-                FROM member
-                INNER JOIN room ON member.room_id=room.room_id AND room.status=:waiting
-                {where_query} GROUP BY room.room_id
-                HAVING COUNT(member_id) < 4
-                """
-            ),
-            {"live_id": live_id, "waiting": WaitRoomStatus.Waiting.value},
-        )
-        rows = result.all()
-        if len(rows) == 0:
-            return []
-
-        room_info_list = [
-            RoomInfo(
-                room_id=row["room_id"],
-                live_id=row["live_id"],
-                joined_user_count=row["joined_user_count"],
-                max_user_count=MAX_USER_COUNT,
-            )
-            for row in rows
-        ]
-        return room_info_list
-    except NoResultFound:
-        return None
-
-
-def list_room(live_id: int) -> list[RoomInfo]:
-    # https://docs.sqlalchemy.org/en/14/core/connections.html#setting-transaction-isolation-levels-including-dbapi-autocommit
-    readcommitted_engine = engine.execution_options(isolation_level="READ COMMITTED")
-    with readcommitted_engine.begin() as conn:
-        # read committed にしたい
-        room_info_list = _get_room_member_cnt_rom_room_by_live_id(conn, live_id)
-    return room_info_list
-
-
-def _join_as_room_member(
-    conn, room_id: int, select_difficulty: LiveDifficulty, token: str
-) -> int:
-    try:
-        user_id = _get_user_by_token(conn, token).id
-        result = conn.execute(
-            text(
-                """
-                SELECT member_id
-                FROM member WHERE `room_id`=:room_id
-                """
-            ),
-            {"room_id": room_id},
-        )
-        rows = result.all()
-        user_id_list = [row["member_id"] for row in rows]
-        joined_user_count = len(user_id_list)
-        if joined_user_count == 0:
-            # 解散
-            return JoinRoomResult.Disbanded
-        else:
-            joined_result = (
-                JoinRoomResult.Ok
-                if joined_user_count + 1 < MAX_USER_COUNT
-                else JoinRoomResult.RoomFull
-            )
-            if user_id not in user_id_list and joined_user_count < MAX_USER_COUNT:
-                print("join room")
-                conn.execute(
-                    text(
-                        "INSERT INTO `member` (room_id, member_id, difficulty) VALUES (:room_id, :user_id, :select_difficulty)"
-                    ),
-                    {
-                        "room_id": room_id,
-                        "user_id": user_id,
-                        "select_difficulty": select_difficulty.value,
-                    },
-                )
-            else:
-                print("already joined")
-            return joined_result
-    except NoResultFound:
+def _room_list_limit(limit: Optional[int]) -> int:
+    if limit is None or limit <= 0:
+        return ROOM_LIST_DEFAULT_LIMIT
+    return min(limit, ROOM_LIST_MAX_LIMIT)
+
+
+def list_room(
+    live_id: int, cursor: int = 0, limit: Optional[int] = None
+) -> Tuple[list[RoomInfo], Optional[int]]:
+    limit = _room_list_limit(limit)
+    if room_registry is not None:
+        return room_registry.list_room(live_id, cursor, limit)
+    if shared_cache is None:
+        return storage.list_room(live_id, cursor, limit)
+    cached_version, cached = shared_cache.get_list(live_id, cursor, limit)
+    version, page = storage.list_room_since(live_id, cursor, limit, cached_version)
+    if page is None:
+        return cached
+    # 遅れたレプリカの内容を他の worker に配らない (read-your-writes の pin はこの worker だけ)
+    if not read_router.from_replica():
+        shared_cache.set_list(live_id, cursor, limit, version, *page)
+    return page
+
+
+def list_room_since(
+    live_id: int, cursor: int, limit: Optional[int], known_version: int
+) -> Tuple[int, Optional[Tuple[list[RoomInfo], Optional[int]]]]:
+    """version 付きの list. live_id の一覧が変わっていなければページを読まずに (version, None) を返す"""
+    limit = _room_list_limit(limit)
+    if room_registry is not None:
+        return room_registry.list_room_since(live_id, cursor, limit, known_version)
+    # 変化がなければ version を1行読むだけなので shared_cache は通さない
+    return storage.list_room_since(live_id, cursor, limit, known_version)
+
+
+def join_room(
+    room_id: int, select_difficulty: LiveDifficulty, caller: Optional[Caller]
+) -> JoinRoomResult:
+    """caller が None (token が不正) なら OtherError"""
+    if caller is None:
         return JoinRoomResult.OtherError
-
-
-def join_room(room_id: int, select_difficulty: LiveDifficulty, token: str) -> int:
-    readcommitted_engine = engine.execution_options(isolation_level="READ COMMITTED")
-    with readcommitted_engine.begin() as conn:
-        # read committed にしたい
-        status = _join_as_room_member(conn, room_id, select_difficulty, token)
+    if room_registry is not None:
+        try:
+            # メンバー情報として名前なども持つのでユーザーを引く
+            user = caller_user(caller)
+        except InvalidToken:
+            return JoinRoomResult.OtherError
+        status = room_registry.join_room(room_id, user, select_difficulty)
+    else:
+        status = storage.join_room(room_id, caller.user_id, select_difficulty)
+    if status == JoinRoomResult.Ok:
+        _room_changed(room_id)
     return status
 
 
-def _get_user_info(conn, rows, req_user_id) -> Tuple[WaitRoomStatus, list[RoomUser]]:
-    user_info_list = []
-    status = WaitRoomStatus(rows[0]["status"])
-    host_user_id = rows[0]["owner"]
-    for row in rows:
-        user_info_list.append(
-            RoomUser(
-                user_id=row["member_id"],
-                name=row["name"],
-                leader_card_id=row["leader_card_id"],
-                select_difficulty=LiveDifficulty(row["difficulty"]),
-                is_me=row["member_id"] == req_user_id,
-                is_host=row["member_id"] == host_user_id,
-            )
+def quick_join(
+    live_id: int, select_difficulty: LiveDifficulty, caller: Caller
+) -> Tuple[int, bool]:
+    """入場可能なルームのうち一番埋まっているものに入り, なければ作る. (room_id, 作ったか) を返す"""
+    if room_registry is not None:
+        user = caller_user(caller)
+        room_id = room_registry.quick_join(live_id, user, select_difficulty)
+        created = room_id is None
+        if created:
+            room_id = storage.create_room(user.id, live_id, select_difficulty)
+            room_registry.add_room(room_id, live_id, user, select_difficulty)
+    else:
+        room_id, created = storage.quick_join(
+            caller.user_id, live_id, select_difficulty
         )
-    return status, user_info_list
+    _room_changed(None if created else room_id)
+    return room_id, created
+
+
+def wait_room(room_id: int, caller: Caller) -> Tuple[WaitRoomStatus, list[RoomUser]]:
+    user_id = caller.user_id
+    if room_registry is not None:
+        return room_registry.wait_room(room_id, user_id)
+    if shared_cache is None:
+        return storage.wait_room(room_id, user_id)
+    cached_version, cached = shared_cache.get_wait(room_id, user_id)
+    version, status, room_user_list = storage.wait_room_since(
+        room_id, user_id, cached_version
+    )
+    if room_user_list is None:
+        return cached
+    if not read_router.from_replica():
+        shared_cache.set_wait(room_id, version, status, room_user_list)
+    return status, room_user_list
 
 
-def _get_room_user_list(
-    conn, room_id: str, token: str
-) -> Tuple[WaitRoomStatus, list[RoomUser]]:
-    try:
-        req_user_id = _get_user_by_token(conn, token).id
-        result = conn.execute(
-            text(
-                """
-                SELECT member_id, user.name, user.leader_card_id, difficulty, room.owner, room.status
-                FROM member
-                INNER JOIN user
-                ON member.member_id=user.id
-                INNER JOIN room
-                ON member.room_id=room.room_id
-                WHERE member.room_id=:room_id
-                """
-            ),
-            {"room_id": room_id},
-        )
-        rows = result.all()
-        status, user_info_list = _get_user_info(conn, rows, req_user_id)
-        return status, user_info_list
-    except NoResultFound:
-        return None
+def wait_room_since(
+    room_id: int, caller: Caller, known_version: int
+) -> Tuple[int, WaitRoomStatus, Optional[list[RoomUser]]]:
+    """version 付きの wait. 変化がなければメンバーを読まずに room_user_list を None で返す"""
+    user_id = caller.user_id
+    if room_registry is not None:
+        return room_registry.wait_room_since(room_id, user_id, known_version)
+    # 変化がなければ room の1行を読むだけなので shared_cache は通さない
+    return storage.wait_room_since(room_id, user_id, known_version)
 
 
-def wait_room(room_id: int, token: str) -> Tuple[WaitRoomStatus, list[RoomUser]]:
-    with engine.begin() as conn:
-        status, room_user_list = _get_room_user_list(conn, room_id, token)
-    return status, room_user_list
-
-
-def start_room(room_id: int, token: str) -> None:
-    with engine.begin() as conn:
+def start_room(room_id: int, caller: Caller) -> None:
+    user_id = caller.user_id
+    if room_registry is not None:
+        room_registry.start_room(room_id, user_id)
+    else:
+        storage.start_room(room_id, user_id)
+    _room_changed(room_id)
+
+
+def end_room(
+    room_id: int, score: int, judge_count_list: list[int], caller: Caller
+) -> None:
+    user_id = caller.user_id
+    if room_registry is not None:
+        # member の INSERT がまだキューにあると UPDATE が空振りする
+        if not room_registry.flush(ROOM_REGISTRY_FLUSH_TIMEOUT):
+            raise RegistryWriteError("room registry flush timed out")
+    if score_writer is not None:
+        # 同時に来た他の /room/end とまとめて書かれ, commit 後に返る
+        future = score_writer.submit(room_id, user_id, score, judge_count_list)
         try:
-            user_id = _get_user_by_token(conn, token).id
-            result = conn.execute(
-                text("SELECT `owner` FROM `room` WHERE `room_id`=:room_id"),
-                {"room_id": room_id},
-            )
-            row = result.one()
-            if user_id == row["owner"]:
-                result = conn.execute(
-                    text("UPDATE `room` SET `status`=:status WHERE `room_id`=:room_id"),
-                    {"status": WaitRoomStatus.LiveStart.value, "room_id": room_id},
-                )
-            else:
-                print("owner is diffrent!!")
-                return None
-        except NoResultFound as e:
-            raise e
-
-
-def _update_myresult_by_user_id(
-    conn, room_id: int, user_id: int, score: int, judge_count_list: list[int]
-):
-    try:
-        judge_count_join = ", ".join(map(str, judge_count_list))
-        conn.execute(
-            text(
-                """
-                UPDATE `member`
-                SET score=:score, judge_count=:judge_count
-                WHERE room_id=:room_id AND member_id=:user_id
-                """
-            ),
-            {
-                "room_id": room_id,
-                "user_id": user_id,
-                "score": score,
-                "judge_count": judge_count_join,
-            },
-        )
-    except NoResultFound:
-        return None
+            played = future.result(SCORE_BATCH_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            raise ScoreWriterError("score write timed out")
+    else:
+        played = storage.end_room(room_id, user_id, score, judge_count_list)
+    # 揃った後に出し直された場合
+    result_cache.pop(room_id)
+    if played is not None:
+        _record_score(played, score)
 
 
-def end_room(room_id: int, score: int, judge_count_list: list[int], token) -> None:
-    with engine.begin() as conn:
-        user_id = _get_user_by_token(conn, token).id
-        _update_myresult_by_user_id(conn, room_id, user_id, score, judge_count_list)
+def _record_score(played: Tuple[int, LiveDifficulty, SafeUser], score: int) -> None:
+    live_id, difficulty, user = played
+    leaderboard.record(
+        live_id, difficulty, user.id, user.name, user.leader_card_id, score
+    )
 
 
-def check_can_return(rows):
-    for row in rows:
-        if row["score"] is None:
-            return False
-    return True
+def rebuild_leaderboard() -> int:
+    return leaderboard.rebuild(storage.iter_scores())
 
 
-def _get_result_user_list_from_row(rows) -> list[ResultUser]:
-    if not check_can_return(rows):
-        return []
-    resultuser_list = []
-    for row in rows:
-        u_id, score, judge_count_list = (
-            row["member_id"],
-            row["score"],
-            row["judge_count"],
-        )
-        judge_count_list = list(map(int, judge_count_list.split(", ")))
-        resultuser_list.append(
-            ResultUser(user_id=u_id, judge_count_list=judge_count_list, score=score)
-        )
-    return resultuser_list
+def warm_live_stats() -> Optional[int]:
+    """起動時に全履歴を集計しておく"""
+    return live_stats.refresh(storage, force=True)
 
 
-def _get_result_user_list(conn, room_id) -> list[ResultUser]:
-    try:
-        result = conn.execute(
-            text(
-                """
-                SELECT member_id, judge_count, score
-                FROM member
-                WHERE room_id=:room_id
-                """
-            ),
-            {"room_id": room_id},
-        )
-        rows = result.all()
-        return _get_result_user_list_from_row(rows)
-    except NoResultFound:
-        return None
+def get_live_stats(
+    live_id: int, difficulty: Optional[LiveDifficulty], clear_score: Optional[int]
+) -> list[LiveStats]:
+    # 前回から時間が経っていれば, その後に記録された結果だけを読み足す
+    live_stats.refresh(storage)
+    difficulties = list(LiveDifficulty) if difficulty is None else [difficulty]
+    return [live_stats.get(live_id, d, clear_score) for d in difficulties]
 
 
-def result_room(room_id: int) -> None:
-    with engine.begin() as conn:
-        result_user_list = _get_result_user_list(conn, room_id)
+def result_room(room_id: int) -> list[ResultUser]:
+    result_user_list = result_cache.get(room_id)
+    if result_user_list is not None:
+        return result_user_list
+    result_user_list = storage.result_room(room_id)
+    if result_user_list:
+        result_cache.set(room_id, result_user_list)
     return result_user_list
 
 
-def _sample_room_member_id(conn, room_id: int, leave_room_user_id: int):
-    result = conn.execute(
-        text(
-            """
-            SELECT member_id
-            FROM member
-            WHERE room_id=:room_id AND member_id!=:user_id
-            LIMIT 1
-            """
-        ),
-        {"room_id": room_id, "user_id": leave_room_user_id},
-    )
-    # rowが一つもない時はNoneを返す
-    row = result.one_or_none()
-    if row is None:
-        return "none"
+def leave_room(room_id: int, caller: Caller) -> None:
+    user_id = caller.user_id
+    if room_registry is not None:
+        room_registry.leave_room(room_id, user_id)
     else:
-        return row["member_id"]
-
-
-def _leave_room_by_user_id(conn, room_id: int, leave_room_user_id: int, is_owner: bool):
-    try:
-        if is_owner:
-            new_owner = _sample_room_member_id(conn, room_id, leave_room_user_id)
-            print(f"new_owner {new_owner}")
-            if new_owner != "none":
-                # Set new owner
-                conn.execute(
-                    text(
-                        """
-                        UPDATE room
-                        SET owner=:new_owner
-                        WHERE room_id=:room_id
-                        """
-                    ),
-                    {"room_id": room_id, "new_owner": new_owner},
-                )
-            else:
-                # status -> 解散
-                conn.execute(
-                    text(
-                        """
-                        UPDATE room
-                        SET status=:dissolution
-                        WHERE room_id=:room_id
-                        """
-                    ),
-                    {
-                        "room_id": room_id,
-                        "dissolution": WaitRoomStatus.Dissolution.value,
-                    },
-                )
-        # DELETE leave user
-        conn.execute(
-            text(
-                """
-                DELETE
-                FROM member
-                WHERE room_id=:room_id AND member_id=:user_id
-                """
-            ),
-            {"room_id": room_id, "user_id": leave_room_user_id},
-        )
-    except NoResultFound:
-        return None
-
-
-def _get_room_user_id_from_room(conn, room_id: int, token: str) -> Tuple[int, bool]:
-    try:
-        user_id = _get_user_by_token(conn, token).id
-        result = conn.execute(
-            text("SELECT owner FROM `room` WHERE `room_id`=:room_id"),
-            {"room_id": room_id},
-        )
-        row = result.one()
-        return user_id, user_id == row["owner"]
-    except NoResultFound:
-        return None
-    return None
-
-
-def leave_room(room_id: int, token: str) -> None:
-    readcommitted_engine = engine.execution_options(isolation_level="READ COMMITTED")
-    with readcommitted_engine.begin() as conn:
-        user_id, is_owner = _get_room_user_id_from_room(conn, room_id, token)
-        _leave_room_by_user_id(conn, room_id, user_id, is_owner)
+        storage.leave_room(room_id, user_id)
+    _room_changed(room_id)
@@ -0,0 +1,69 @@
+"""ルームの変更通知
+
+join/leave/start が commit した後に notify(room_id) を呼ぶと, そのルームの version が進み,
+/room/wait の long-poll や WebSocket で待っているリクエストが起こされる.
+model はスレッドプール上で動くので, 待機側のイベントループへは call_soon_threadsafe で渡す.
+
+通知はプロセス内だけで届き, version もこのプロセスの連番なのでクライアントには返さない.
+待機側は起こされたら DB の room.version を読み直し, 複数 worker の場合は定期的な読み直しで補う.
+"""
+
+import asyncio
+import itertools
+import threading
+
+
+def _wake(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+class RoomNotifier:
+    def __init__(self):
+        # version はプロセス全体で単調増加する連番. 未通知のルームは 0
+        self._seq = itertools.count(1)
+        self._versions: dict[int, int] = {}
+        self._waiters: dict[
+            int, list[tuple[asyncio.AbstractEventLoop, asyncio.Future]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def version(self, room_id: int) -> int:
+        return self._versions.get(room_id, 0)
+
+    def notify(self, room_id: int) -> None:
+        with self._lock:
+            self._versions[room_id] = next(self._seq)
+            waiters = self._waiters.pop(room_id, [])
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(_wake, fut)
+
+    def forget(self, room_id: int) -> None:
+        """片付けたルームの version を捨てる"""
+        with self._lock:
+            self._versions.pop(room_id, None)
+
+    async def wait(self, room_id: int, version: int, timeout: float) -> bool:
+        """version が進むまで最大 timeout 秒待つ. 進んだら True"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        waiter = (loop, fut)
+        with self._lock:
+            if self._versions.get(room_id, 0) != version:
+                return True
+            self._waiters.setdefault(room_id, []).append(waiter)
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(room_id)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[room_id]
+
+
+room_notifier = RoomNotifier()
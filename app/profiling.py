@@ -0,0 +1,285 @@
+"""必要な時だけ取るリクエストのプロファイル
+
+対象のリクエスト (config.PROFILE_KEY のヘッダ付き, または PROFILE_SAMPLE_RATE で抜き出したもの) について
+
+- cProfile: ハンドラを実行したスレッドで取る. sync def のハンドラはスレッドプールで動くので,
+  middleware ではなく ProfiledRoute がエンドポイントを包んで, 実行するスレッドで有効にする.
+  async def のハンドラはイベントループ上の他のリクエストの処理も混ざるので, run_in_thread で
+  スレッドプールに回した処理があれば, そのスレッドで取った方だけを書く.
+  cProfile は同時に1リクエストだけ (取れなかったリクエストはタイムラインだけ書く).
+- SQL のタイムライン: 文ごとの開始時刻/所要時間と, コネクション待ちの時間 (metrics のフック)
+
+を PROFILE_DIR に <時刻>-<id>.json (+ .prof) として書き, PROFILE_MAX_FILES を超えたら古いものから消す.
+.prof は `python -m pstats <file>` や snakeviz で見る. /admin/profiles で route ごとに遅い順の一覧を,
+/admin/profiles/{id} で1件分のタイムラインと関数を返す (どちらも PROFILE_KEY のヘッダが要る).
+"""
+
+import asyncio
+import contextlib
+import cProfile
+import functools
+import hmac
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+
+from . import config
+from .metrics import current_timeline, endpoint_label
+
+logger = logging.getLogger(__name__)
+
+HEADER = "X-Gameserver-Profile"
+# .json に載せる関数の数 (cumtime 順)
+TOP_FUNCTIONS = 20
+SQL_MAX_LENGTH = 500
+
+# 同時に cProfile を取るのは1リクエストだけ
+_cprofile_lock = threading.Lock()
+
+
+class RequestProfile:
+    def __init__(self, cprofile: bool):
+        self.id = uuid.uuid4().hex[:12]
+        self.cprofile = cprofile
+        self.profiles: list[cProfile.Profile] = []
+        # run_in_thread でスレッドプールに回した処理の分
+        self.thread_profiles: list[cProfile.Profile] = []
+        self.timeline: list[tuple] = []
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def profiling(self, in_thread: bool = False):
+        """今のスレッドで cProfile を取る"""
+        if not self.cprofile:
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            (self.thread_profiles if in_thread else self.profiles).append(profile)
+
+
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar(
+    "current_profile", default=None
+)
+
+
+async def run_in_thread(func: Callable, *args):
+    """スレッドプールで func を実行する. プロファイル中のリクエストならそのスレッドでも cProfile を取る"""
+    profile = current_profile.get()
+    if profile is None:
+        return await run_in_threadpool(func, *args)
+
+    def profiled():
+        with profile.profiling(in_thread=True):
+            return func(*args)
+
+    return await run_in_threadpool(profiled)
+
+
+def _profiled(func: Callable) -> Callable:
+    if getattr(func, "__profiled__", False):
+        # include_router で作り直される時に二重に包まない
+        return func
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return await func(*args, **kwargs)
+            with profile.profiling():
+                return await func(*args, **kwargs)
+
+        wrapper = async_wrapper
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return func(*args, **kwargs)
+            with profile.profiling():
+                return func(*args, **kwargs)
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """エンドポイントを, それを実行するスレッドで cProfile を取るように包む"""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _profiled(endpoint), **kwargs)
+
+
+def is_admin(key: Optional[str]) -> bool:
+    return bool(config.PROFILE_KEY) and hmac.compare_digest(
+        (key or "").encode(), config.PROFILE_KEY.encode()
+    )
+
+
+def _top_functions(stats: pstats.Stats) -> list[dict]:
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [
+        {
+            "function": f"{filename}:{line}({name})",
+            "calls": nc,
+            "tottime_ms": round(tt * 1000, 3),
+            "cumtime_ms": round(ct * 1000, 3),
+        }
+        for (filename, line, name), (cc, nc, tt, ct, callers) in rows[:TOP_FUNCTIONS]
+    ]
+
+
+def _rotate(directory: str) -> None:
+    names = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    for name in names[: max(len(names) - config.PROFILE_MAX_FILES, 0)]:
+        base = os.path.join(directory, name[: -len(".json")])
+        for path in (base + ".json", base + ".prof"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def _save(profile: RequestProfile, record: dict) -> None:
+    directory = config.PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    # 時刻順に並ぶ名前にして, ローテーションは名前順で古いものから消す
+    now = time.time()
+    millis = int(now * 1000) % 1000
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + f"{millis:03d}"
+    base = os.path.join(directory, f"{stamp}-{profile.id}")
+    # スレッドプールに回した処理があれば, 他のリクエストも混ざるイベントループの方は載せない
+    profiles = profile.thread_profiles or profile.profiles
+    if profiles:
+        stats = pstats.Stats(profiles[0])
+        for other in profiles[1:]:
+            stats.add(other)
+        stats.dump_stats(base + ".prof")
+        record["profile"] = os.path.basename(base) + ".prof"
+        record["top_functions"] = _top_functions(stats)
+    record["timeline"] = [
+        {
+            "kind": kind,
+            "start_ms": round((started - profile.started) * 1000, 3),
+            "duration_ms": round(elapsed * 1000, 3),
+            "statement": None if statement is None else statement[:SQL_MAX_LENGTH],
+        }
+        for kind, started, elapsed, statement in profile.timeline
+    ]
+    tmp = base + ".json.tmp"
+    with open(tmp, "w") as f:
+        json.dump(record, f, ensure_ascii=False)
+    # 書きかけのファイルを summary に読ませない
+    os.replace(tmp, base + ".json")
+    _rotate(directory)
+
+
+async def middleware(request, call_next: Callable):
+    if request.url.path.startswith("/admin/"):
+        return await call_next(request)
+    admin = is_admin(request.headers.get(HEADER))
+    rate = config.PROFILE_SAMPLE_RATE
+    if not admin and not (rate > 0 and random.random() < rate):
+        return await call_next(request)
+    cprofile = _cprofile_lock.acquire(blocking=False)
+    profile = RequestProfile(cprofile)
+    profile_token = current_profile.set(profile)
+    timeline_token = current_timeline.set(profile.timeline)
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - profile.started
+        current_timeline.reset(timeline_token)
+        current_profile.reset(profile_token)
+        if cprofile:
+            _cprofile_lock.release()
+        sql = [event for event in profile.timeline if event[0] == "sql"]
+        record = {
+            "id": profile.id,
+            "at": time.time(),
+            "method": request.method,
+            "route": endpoint_label(request),
+            "status": status_code,
+            "elapsed_ms": round(elapsed * 1000, 3),
+            "sql_statements": len(sql),
+            "sql_ms": round(sum(event[2] for event in sql) * 1000, 3),
+            "pool_wait_ms": round(
+                sum(e[2] for e in profile.timeline if e[0] == "pool_wait") * 1000, 3
+            ),
+            "sampled": not admin,
+        }
+        try:
+            await run_in_threadpool(_save, profile, record)
+        except Exception:
+            logger.exception("failed to save request profile")
+
+
+def _load_records(directory: str) -> list[dict]:
+    records = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError):
+            # 他の worker がローテーションで消した
+            continue
+        # 一覧には本体 (タイムラインと関数) を載せない
+        record.pop("timeline", None)
+        top = record.pop("top_functions", None)
+        if top:
+            record["top_function"] = top[0]["function"]
+        records.append(record)
+    return records
+
+
+def summary(limit: int) -> dict[str, list[dict]]:
+    """PROFILE_DIR にある (全 worker の) プロファイルを route ごとに遅い順に limit 件ずつ"""
+    routes: dict[str, list[dict]] = {}
+    for record in _load_records(config.PROFILE_DIR):
+        routes.setdefault(record["route"], []).append(record)
+    return {
+        route: sorted(records, key=lambda r: r["elapsed_ms"], reverse=True)[:limit]
+        for route, records in sorted(routes.items())
+    }
+
+
+def load(profile_id: str) -> Optional[dict]:
+    """1件分 (タイムラインと関数の一覧を含む)"""
+    if not profile_id.isalnum():
+        return None
+    suffix = f"-{profile_id}.json"
+    try:
+        names = os.listdir(config.PROFILE_DIR)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if name.endswith(suffix):
+            try:
+                with open(os.path.join(config.PROFILE_DIR, name)) as f:
+                    return json.load(f)
+            except (FileNotFoundError, ValueError):
+                return None
+    return None
@@ -0,0 +1,94 @@
+"""終わったルームを room/member から片付けるバックグラウンドスレッド
+
+解散済みのルームと全員のスコアが揃ったライブは ROOM_FINISHED_TIMEOUT 秒後 (ライブは最後のスコアから) に,
+それ以外でも ROOM_IDLE_TIMEOUT 秒更新がないルーム (放置された待機/ライブ) は
+room_archive/member_archive に移す (memory storage では捨てる).
+room/member を小さく保って list/join のクエリが伸びないようにするため.
+
+前の処理と取り合わないように, REAPER_BATCH_SIZE 件ずつ別トランザクションで移し,
+REAPER_MAX_ROOMS_PER_SECOND を超えないようにバッチの間で休む.
+複数 worker で同時に動いても対象行をロックしてから移すので二重には移らない.
+"""
+
+import logging
+import threading
+import time
+from typing import Optional
+
+from . import config, model
+from .notify import room_notifier
+from .registry import room_registry
+from .shared_cache import shared_cache
+
+logger = logging.getLogger(__name__)
+
+
+class RoomReaper:
+    def __init__(
+        self,
+        interval: float = config.REAPER_INTERVAL,
+        batch_size: int = config.REAPER_BATCH_SIZE,
+        max_rooms_per_second: float = config.REAPER_MAX_ROOMS_PER_SECOND,
+        finished_timeout: float = config.ROOM_FINISHED_TIMEOUT,
+        idle_timeout: float = config.ROOM_IDLE_TIMEOUT,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_rooms_per_second = max_rooms_per_second
+        self.finished_timeout = finished_timeout
+        self.idle_timeout = idle_timeout
+        self.archived = 0
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self, now: Optional[float] = None) -> int:
+        """今片付けられるルームを全部 (バッチに分けて) 片付け, 件数を返す"""
+        if now is None:
+            now = time.time()
+        finished_before = int(now - self.finished_timeout)
+        idle_before = int(now - self.idle_timeout)
+        total = 0
+        while not self._stopping.is_set():
+            if room_registry is not None:
+                # write-behind に残っている updated_at の更新を先に書く
+                room_registry.flush(self.interval)
+            room_ids = model.storage.archive_rooms(
+                finished_before, idle_before, self.batch_size
+            )
+            for room_id in room_ids:
+                if room_registry is not None:
+                    room_registry.evict(room_id)
+                room_notifier.forget(room_id)
+                if shared_cache is not None:
+                    shared_cache.forget(room_id)
+            total += len(room_ids)
+            self.archived += len(room_ids)
+            if len(room_ids) < self.batch_size:
+                break
+            self._stopping.wait(len(room_ids) / self.max_rooms_per_second)
+        if total:
+            logger.info("room reaper archived %d rooms", total)
+        return total
+
+    def _loop(self) -> None:
+        while not self._stopping.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("room reaper failed")
+
+    def start(self) -> None:
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name="room-reaper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+room_reaper: Optional[RoomReaper] = RoomReaper() if config.REAPER else None
@@ -0,0 +1,526 @@
+"""ルームの状態をプロセス内に持つレジストリ (config.ROOM_REGISTRY=True の時に使う)
+
+待機中/ライブ中のルームとメンバーをメモリ上で管理して list/join/wait/start/leave を
+DBに行かずに返す. 変更は write-behind キューに積み, 別スレッドが順番通りに
+room/member テーブルへ書き込む. 起動時には DB から読み直すので, プロセスが落ちても
+失うのはキューに残っていた直近の書き込みだけになる.
+制約違反/値の不正で ROOM_REGISTRY_MAX_ATTEMPTS 回続けて書けなかったバッチは1文ずつ書き直し,
+それでも書けない文は dead_letters に移して先に進む (キューが詰まって flush を待つ /room/end が
+止まらないように). 捨てた文を待っていた flush は RegistryWriteError を投げる.
+接続断などその文のせいではない失敗では捨てずに, 間隔を延ばしながら書けるまで再試行する
+(1文でも捨てると後の書き込みだけが入って DB がずれ, 読み直しても直らない).
+
+プロセス内の状態が正なので uvicorn の worker は1つで動かすこと.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import DataError, IntegrityError
+
+from . import config
+from .db import engine
+from .ResReqModel import (
+    JoinRoomResult,
+    LiveDifficulty,
+    RoomInfo,
+    RoomUser,
+    WaitRoomStatus,
+)
+from .storage import listing_version_base
+
+logger = logging.getLogger(__name__)
+
+# 何度書き直しても書けない (その文のせいで書けない) 失敗. これだけを dead letter にする
+_UNWRITABLE = (IntegrityError, DataError)
+
+
+class RegistryWriteError(Exception):
+    """待っていた write-behind の書き込みが捨てられたか, 間に合わなかった時に投げる"""
+
+
+class RoomMember:
+    __slots__ = ("user_id", "name", "leader_card_id", "difficulty")
+
+    def __init__(
+        self, user_id: int, name: str, leader_card_id: int, difficulty: LiveDifficulty
+    ):
+        self.user_id = user_id
+        self.name = name
+        self.leader_card_id = leader_card_id
+        self.difficulty = difficulty
+
+
+class Room:
+    __slots__ = ("room_id", "live_id", "status", "owner", "members", "version")
+
+    def __init__(
+        self,
+        room_id: int,
+        live_id: int,
+        status: WaitRoomStatus,
+        owner: int,
+        version: int = 1,
+    ):
+        self.room_id = room_id
+        self.live_id = live_id
+        self.status = status
+        self.owner = owner
+        # room.version と同じ値. 書き込みと一緒に DB 側も +1 する
+        self.version = version
+        # user_id -> RoomMember (入室順)
+        self.members: dict[int, RoomMember] = {}
+
+
+def _room_id(room: Room) -> int:
+    return room.room_id
+
+
+class RoomRegistry:
+    # 捨てた書き込みはこれだけ手元に残す (調査用)
+    DEAD_LETTER_LIMIT = 1000
+
+    def __init__(
+        self,
+        batch_size: int = 256,
+        max_attempts: int = config.ROOM_REGISTRY_MAX_ATTEMPTS,
+    ):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._rooms: dict[int, Room] = {}
+        # live_id -> {room_id: Room}. 待機中のルームだけを入れる
+        self._waiting_by_live: dict[int, dict[int, Room]] = {}
+        # live_id -> /room/list の version. 0 は全体
+        self._listing_base = listing_version_base()
+        self._listing_versions: dict[int, int] = {}
+        self._lock = threading.RLock()
+
+        # write-behind キュー. (sql, params) を積んだ順に書く
+        self._writes: list[Tuple[str, dict]] = []
+        self._enqueued = 0
+        self._written = 0
+        self._cond = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+        self._stopping = False
+        # 捨てた書き込み (sql, params) と, 最後に捨てた書き込みの通し番号 (1始まり)
+        self.dead_letters: deque[Tuple[str, dict]] = deque(
+            maxlen=self.DEAD_LETTER_LIMIT
+        )
+        self.dropped = 0
+        self._last_dropped = 0
+
+    # --- 起動/終了 ---
+
+    def load(self) -> None:
+        """DB から待機中/ライブ中のルームを読み直す"""
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text("""
+                    SELECT room.room_id, room.live_id, room.status, room.owner, room.version,
+                        member.member_id, member.difficulty, user.name, user.leader_card_id
+                    FROM room
+                    INNER JOIN member ON member.room_id=room.room_id AND member.left_at=0
+                    INNER JOIN user ON member.member_id=user.id
+                    WHERE room.status!=:dissolution
+                    ORDER BY room.room_id
+                    """),
+                {"dissolution": WaitRoomStatus.Dissolution.value},
+            ).all()
+        with self._lock:
+            self._rooms.clear()
+            self._waiting_by_live.clear()
+            for row in rows:
+                room = self._rooms.get(row["room_id"])
+                if room is None:
+                    room = Room(
+                        row["room_id"],
+                        row["live_id"],
+                        WaitRoomStatus(row["status"]),
+                        row["owner"],
+                        row["version"],
+                    )
+                    self._add(room)
+                room.members[row["member_id"]] = RoomMember(
+                    row["member_id"],
+                    row["name"],
+                    row["leader_card_id"],
+                    LiveDifficulty(row["difficulty"]),
+                )
+        logger.info("room registry loaded %d rooms", len(self._rooms))
+
+    def start(self) -> None:
+        self.load()
+        self._stopping = False
+        self._writer = threading.Thread(
+            target=self._write_loop, name="room-registry-writer", daemon=True
+        )
+        self._writer.start()
+
+    def stop(self) -> None:
+        """キューに残った書き込みを書き終えてから止める. 止める途中で書けなくなったら残りは諦める"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    # --- 参照/更新 ---
+
+    def _listing_changed(self, live_id: int) -> None:
+        for key in (live_id, 0):
+            self._listing_versions[key] = self._listing_versions.get(key, 0) + 1
+
+    def _add(self, room: Room) -> None:
+        self._rooms[room.room_id] = room
+        if room.status == WaitRoomStatus.Waiting:
+            self._waiting_by_live.setdefault(room.live_id, {})[room.room_id] = room
+
+    def _unlist(self, room: Room) -> None:
+        waiting = self._waiting_by_live.get(room.live_id)
+        if waiting is not None:
+            waiting.pop(room.room_id, None)
+            if not waiting:
+                del self._waiting_by_live[room.live_id]
+
+    def add_room(
+        self,
+        room_id: int,
+        live_id: int,
+        owner,
+        select_difficulty: LiveDifficulty,
+    ) -> None:
+        """create_room でDBに書いた直後に登録する (room_id はDBで採番するため)"""
+        room = Room(room_id, live_id, WaitRoomStatus.Waiting, owner.id)
+        room.members[owner.id] = RoomMember(
+            owner.id, owner.name, owner.leader_card_id, select_difficulty
+        )
+        with self._lock:
+            self._add(room)
+            self._listing_changed(live_id)
+
+    def list_room(
+        self, live_id: int, cursor: int = 0, limit: int = config.ROOM_LIST_DEFAULT_LIMIT
+    ) -> Tuple[list[RoomInfo], Optional[int]]:
+        with self._lock:
+            if live_id != 0:
+                rooms = self._waiting_by_live.get(live_id, {}).values()
+            else:
+                rooms = (
+                    room
+                    for room in self._rooms.values()
+                    if room.status == WaitRoomStatus.Waiting
+                )
+            # add_room は DB で採番した後なので, 同時に作られると room_id 順に入るとは限らない
+            page = sorted(
+                (
+                    room
+                    for room in rooms
+                    if room.room_id > cursor
+                    and len(room.members) < config.MAX_USER_COUNT
+                ),
+                key=_room_id,
+            )[: limit + 1]
+            next_cursor = None
+            if len(page) > limit:
+                page = page[:limit]
+                next_cursor = page[-1].room_id
+            return [
+                RoomInfo(
+                    room_id=room.room_id,
+                    live_id=room.live_id,
+                    joined_user_count=len(room.members),
+                    max_user_count=config.MAX_USER_COUNT,
+                )
+                for room in page
+            ], next_cursor
+
+    def list_room_since(
+        self, live_id: int, cursor: int, limit: int, known_version: int
+    ) -> Tuple[int, Optional[Tuple[list[RoomInfo], Optional[int]]]]:
+        with self._lock:
+            version = self._listing_base + self._listing_versions.get(live_id, 0)
+            if known_version != 0 and version == known_version:
+                return version, None
+            return version, self.list_room(live_id, cursor, limit)
+
+    def join_room(
+        self, room_id: int, user, select_difficulty: LiveDifficulty
+    ) -> JoinRoomResult:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None or room.status == WaitRoomStatus.Dissolution:
+                return JoinRoomResult.Disbanded
+            if user.id in room.members:
+                return JoinRoomResult.Ok
+            if room.status != WaitRoomStatus.Waiting:
+                return JoinRoomResult.OtherError
+            if len(room.members) >= config.MAX_USER_COUNT:
+                return JoinRoomResult.RoomFull
+            room.members[user.id] = RoomMember(
+                user.id, user.name, user.leader_card_id, select_difficulty
+            )
+            room.version += 1
+            self._listing_changed(room.live_id)
+            self._enqueue(
+                "INSERT INTO `member` (room_id, member_id, difficulty)"
+                " VALUES (:room_id, :user_id, :difficulty)",
+                {
+                    "room_id": room_id,
+                    "user_id": user.id,
+                    "difficulty": select_difficulty.value,
+                },
+            )
+            self._enqueue(
+                "UPDATE `room` SET joined_user_count=joined_user_count+1, updated_at=:now,"
+                " version=version+1 WHERE room_id=:room_id",
+                {"room_id": room_id, "now": int(time.time())},
+            )
+        logger.debug("join room %s: user %s", room_id, user.id)
+        return JoinRoomResult.Ok
+
+    def quick_join(
+        self, live_id: int, user, select_difficulty: LiveDifficulty
+    ) -> Optional[int]:
+        """live_id の待機中のルームのうち一番埋まっているものに入る. 入れるルームがなければ None"""
+        with self._lock:
+            best = None
+            for room in self._waiting_by_live.get(live_id, {}).values():
+                if len(room.members) >= config.MAX_USER_COUNT:
+                    continue
+                if user.id in room.members:
+                    return room.room_id
+                if best is None or len(room.members) > len(best.members):
+                    best = room
+            if best is None:
+                return None
+            self.join_room(best.room_id, user, select_difficulty)
+            return best.room_id
+
+    def wait_room(
+        self, room_id: int, user_id: int
+    ) -> Tuple[WaitRoomStatus, list[RoomUser]]:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return WaitRoomStatus.Dissolution, []
+            return room.status, [
+                RoomUser(
+                    user_id=member.user_id,
+                    name=member.name,
+                    leader_card_id=member.leader_card_id,
+                    select_difficulty=member.difficulty,
+                    is_me=member.user_id == user_id,
+                    is_host=member.user_id == room.owner,
+                )
+                for member in room.members.values()
+            ]
+
+    def wait_room_since(
+        self, room_id: int, user_id: int, known_version: int
+    ) -> Tuple[int, WaitRoomStatus, Optional[list[RoomUser]]]:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return 0, WaitRoomStatus.Dissolution, []
+            if room.version == known_version:
+                return room.version, room.status, None
+            status, room_user_list = self.wait_room(room_id, user_id)
+            return room.version, status, room_user_list
+
+    def start_room(self, room_id: int, user_id: int) -> None:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None or room.owner != user_id:
+                logger.debug("owner is diffrent!! room %s: user %s", room_id, user_id)
+                return None
+            if room.status != WaitRoomStatus.Waiting:
+                return None
+            room.status = WaitRoomStatus.LiveStart
+            room.version += 1
+            self._unlist(room)
+            self._listing_changed(room.live_id)
+            self._enqueue(
+                "UPDATE `room` SET `status`=:status, updated_at=:now, version=version+1"
+                " WHERE `room_id`=:room_id",
+                {
+                    "status": WaitRoomStatus.LiveStart.value,
+                    "room_id": room_id,
+                    "now": int(time.time()),
+                },
+            )
+
+    def leave_room(self, room_id: int, user_id: int) -> None:
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None or user_id not in room.members:
+                return None
+            del room.members[user_id]
+            room.version += 1
+            self._listing_changed(room.live_id)
+            if room.owner == user_id:
+                if room.members:
+                    # sql_storage と同じく user_id が一番小さいメンバー
+                    room.owner = min(room.members)
+                    logger.debug("room %s: new_owner %s", room_id, room.owner)
+                    self._enqueue(
+                        "UPDATE room SET owner=:new_owner WHERE room_id=:room_id",
+                        {"room_id": room_id, "new_owner": room.owner},
+                    )
+                elif room.status == WaitRoomStatus.Waiting:
+                    # ライブ後に全員抜けたルームは LiveStart のまま (sql_storage と同じ)
+                    room.status = WaitRoomStatus.Dissolution
+                    self._enqueue(
+                        "UPDATE room SET status=:dissolution WHERE room_id=:room_id",
+                        {
+                            "room_id": room_id,
+                            "dissolution": WaitRoomStatus.Dissolution.value,
+                        },
+                    )
+            # 結果を出したメンバーの行は消さずに印を付ける (sql_storage._leave_room と同じ)
+            params = {"room_id": room_id, "user_id": user_id, "now": int(time.time())}
+            self._enqueue(
+                "UPDATE member SET left_at=:now"
+                " WHERE room_id=:room_id AND member_id=:user_id AND score IS NOT NULL",
+                params,
+            )
+            self._enqueue(
+                "DELETE FROM member WHERE room_id=:room_id AND member_id=:user_id"
+                " AND score IS NULL",
+                params,
+            )
+            self._enqueue(
+                "UPDATE `room` SET joined_user_count=joined_user_count-1, updated_at=:now,"
+                " version=version+1 WHERE room_id=:room_id",
+                {"room_id": room_id, "now": int(time.time())},
+            )
+            if not room.members:
+                self._unlist(room)
+                del self._rooms[room_id]
+
+    def update_user(self, user) -> None:
+        """名前/アバターの変更をメンバー情報に反映する"""
+        with self._lock:
+            for room in self._rooms.values():
+                member = room.members.get(user.id)
+                if member is not None:
+                    member.name = user.name
+                    member.leader_card_id = user.leader_card_id
+
+    def evict(self, room_id: int) -> None:
+        """DB 側で片付けたルームをメモリからも消す"""
+        with self._lock:
+            room = self._rooms.pop(room_id, None)
+            if room is not None:
+                self._unlist(room)
+                self._listing_changed(room.live_id)
+
+    # --- write-behind ---
+
+    def _enqueue(self, sql: str, params: dict) -> None:
+        with self._cond:
+            self._writes.append((sql, params))
+            self._enqueued += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """ここまでに積んだ書き込みがDBにcommitされるまで待つ
+
+        timeout までに終わらなければ False. 待っていた書き込みを捨てていたら RegistryWriteError.
+        writer を起動していなければ (テストなど) 待っても書かれないので, 待たずに True を返す.
+        """
+        with self._cond:
+            start, target = self._written, self._enqueued
+            if self._writer is None:
+                return True
+            if not self._cond.wait_for(lambda: self._written >= target, timeout):
+                return False
+            if self._last_dropped > start:
+                raise RegistryWriteError(
+                    f"room registry dropped {self.dropped} writes, see dead_letters"
+                )
+            return True
+
+    def pending(self) -> int:
+        with self._cond:
+            return self._enqueued - self._written
+
+    def _write_batch(self, batch: list[Tuple[str, dict]]) -> None:
+        with engine.begin() as conn:
+            for sql, params in batch:
+                conn.execute(text(sql), params)
+
+    def _done(self, count: int) -> None:
+        """キューの先頭 count 件を書き終えた (または捨てた)"""
+        with self._cond:
+            del self._writes[:count]
+            self._written += count
+            self._cond.notify_all()
+
+    def _write_one_by_one(self, batch: list[Tuple[str, dict]]) -> None:
+        """バッチのどの文が書けないのかわからないので, 1文ずつ書いて書けない文だけ捨てる
+
+        その文のせいではない失敗はそのまま投げる. 書けた/捨てた文はキューから外してあるので,
+        再試行は失敗した文から続ける.
+        """
+        for write in batch:
+            try:
+                self._write_batch([write])
+            except _UNWRITABLE:
+                logger.exception("room registry dropped a write: %s %s", *write)
+                with self._cond:
+                    self.dead_letters.append(write)
+                    self.dropped += 1
+                    self._last_dropped = self._written + 1
+            self._done(1)
+
+    def _write_loop(self) -> None:
+        # failures: 続けて失敗した回数 (再試行の間隔を延ばす). attempts: そのうち制約違反/値の不正の回数
+        failures = attempts = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._writes or self._stopping)
+                if not self._writes and self._stopping:
+                    return
+                batch = self._writes[: self.batch_size]
+            try:
+                if attempts < self.max_attempts:
+                    self._write_batch(batch)
+                    self._done(len(batch))
+                else:
+                    self._write_one_by_one(batch)
+            except Exception as e:
+                # 書けなかった分はキューに残したまま再試行する (順序を崩さない)
+                failures += 1
+                if isinstance(e, _UNWRITABLE):
+                    attempts += 1
+                logger.exception(
+                    "room registry write failed (%d times, %d/%d unwritable), retrying",
+                    failures,
+                    attempts,
+                    self.max_attempts,
+                )
+                interval = min(
+                    config.ROOM_REGISTRY_RETRY_INTERVAL * 2 ** (failures - 1),
+                    config.ROOM_REGISTRY_MAX_RETRY_INTERVAL,
+                )
+                with self._cond:
+                    if self._cond.wait_for(lambda: self._stopping, interval):
+                        logger.error(
+                            "room registry stopped with %d writes not written",
+                            len(self._writes),
+                        )
+                        return
+                continue
+            failures = attempts = 0
+
+
+if config.ROOM_REGISTRY and config.STORAGE == "memory":
+    raise ValueError(
+        "GAMESERVER_ROOM_REGISTRY=1 requires an SQL storage (mysql/sqlite)"
+    )
+room_registry: Optional[RoomRegistry] = RoomRegistry() if config.ROOM_REGISTRY else None
@@ -0,0 +1,151 @@
+"""/room/end のスコアをまとめて書くスレッド (config.SCORE_BATCH=True の時に使う)
+
+ライブの終わりにはルームの全員がほぼ同時に /room/end を投げるので, 1件ずつ
+BEGIN → UPDATE → SELECT → COMMIT すると commit (fsync) の数だけ待つことになる.
+ここでは最初の1件が来てから SCORE_BATCH_WINDOW 秒 (または SCORE_BATCH_MAX 件) まで集めて
+1トランザクションで書き (sql_storage._end_rooms), commit できてから呼び出し元に返す
+(group commit). 書いている間に来た分は次のトランザクションにまとまる.
+
+まとめた書き込みが失敗したら1件ずつ書き直し, 失敗したものだけ呼び出し元に例外を返す.
+writer スレッドが止まったり落ちたりした時は, キューに残っていた分に ScoreWriterError を返す.
+start() 前 (テストなど) は呼び出したスレッドでそのまま1件ずつ書く.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional, Tuple
+
+from . import config, sql_storage
+from .db import engine, read_router
+from .ResReqModel import LiveDifficulty
+from .storage import SafeUser
+
+logger = logging.getLogger(__name__)
+
+Played = Optional[Tuple[int, LiveDifficulty, SafeUser]]
+
+
+class ScoreWriterError(Exception):
+    """スコアを書けないまま writer が止まったか, commit が間に合わなかった時に投げる"""
+
+
+class ScoreWriter:
+    def __init__(
+        self,
+        window: float = config.SCORE_BATCH_WINDOW,
+        max_batch: int = config.SCORE_BATCH_MAX,
+    ):
+        self.window = window
+        self.max_batch = max_batch
+        # ((room_id, user_id, score, judge_count_list), Future) を来た順に
+        self._queue: list[Tuple[tuple, Future]] = []
+        self._cond = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+        self._stopping = False
+        # writer がキューを引き取るか. 止まったら False にして, 以降は呼び出し元で書く
+        self._accepting = False
+        self._batches = 0
+        self._scores = 0
+
+    def start(self) -> None:
+        self._stopping = False
+        self._accepting = True
+        self._writer = threading.Thread(
+            target=self._write_loop, name="score-writer", daemon=True
+        )
+        self._writer.start()
+
+    def stop(self) -> None:
+        """キューに残っている分を書いてから止める"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def submit(
+        self, room_id: int, user_id: int, score: int, judge_count_list: list[int]
+    ) -> "Future[Played]":
+        """commit できたら (live_id, 難易度, user) (メンバーでなければ None) が入る Future を返す"""
+        # SqlStorage.end_room と同じく, この後の読み込みを primary に向ける
+        read_router.pin(("user", user_id), ("room", room_id))
+        future: "Future[Played]" = Future()
+        item = ((room_id, user_id, score, list(judge_count_list)), future)
+        with self._cond:
+            if self._accepting:
+                self._queue.append(item)
+                # 待っている writer を起こすのは, 空から1件目と上限に達した時だけ
+                if len(self._queue) == 1 or len(self._queue) >= self.max_batch:
+                    self._cond.notify_all()
+                return future
+        self._write([item])
+        return future
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def stats(self) -> dict[str, int]:
+        with self._cond:
+            return {"batches": self._batches, "scores": self._scores}
+
+    def _write_loop(self) -> None:
+        batch: list[Tuple[tuple, Future]] = []
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._queue or self._stopping)
+                    if not self._queue:
+                        self._accepting = False
+                        return
+                    deadline = time.monotonic() + self.window
+                    while len(self._queue) < self.max_batch and not self._stopping:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    batch = self._queue[: self.max_batch]
+                    del self._queue[: len(batch)]
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    # _write が途中で落ちても呼び出し元を待たせたままにしない
+                    logger.exception("score writer failed")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            with self._cond:
+                self._accepting = False
+                queue, self._queue = self._queue, []
+            for _, future in batch + queue:
+                if not future.done():
+                    future.set_exception(ScoreWriterError("score writer stopped"))
+
+    def _write(self, batch: list[Tuple[tuple, Future]]) -> None:
+        try:
+            with engine.begin() as conn:
+                results = sql_storage._end_rooms(conn, [score for score, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            logger.exception(
+                "score batch of %d failed, retrying one by one", len(batch)
+            )
+            for item in batch:
+                self._write([item])
+            return
+        with self._cond:
+            self._batches += 1
+            self._scores += len(batch)
+        for (_, future), played in zip(batch, results):
+            future.set_result(played)
+
+
+if config.SCORE_BATCH and config.STORAGE == "memory":
+    raise ValueError("GAMESERVER_SCORE_BATCH=1 requires an SQL storage (mysql/sqlite)")
+score_writer: Optional[ScoreWriter] = ScoreWriter() if config.SCORE_BATCH else None
@@ -0,0 +1,230 @@
+"""worker 間で共有するルームのキャッシュ (/room/wait と /room/list)
+
+uvicorn を複数 worker で動かすとプロセス内のキャッシュは他 worker の変更で古くなるので,
+同じホストの worker 全員が開く SQLite のファイル (/dev/shm などの tmpfs に置く) に
+スナップショットを, DB のどの version の内容かと一緒に置く. Redis などの別プロセスは要らない.
+1回の読み書きはローカルファイルへの数十µs だが, ロック待ちもあるので async_model からはスレッドで呼ぶ.
+
+- 読み出し側: スナップショットとその version を読み, DB には今の version だけを聞く
+  (/room/wait は room.version, /room/list は live_id ごとの live_room_version. どちらも主キーの1行で,
+  storage の wait_room_since / list_room_since に渡す). 同じならスナップショットを返し,
+  違えば DB が一緒に返した内容をその version を付けて入れる.
+- 書き込み側 (create/join/leave/start/end) はこのファイルに何もしない. version は DB が変更と同じ
+  トランザクションで上げるので, 他の worker (他のホストでも) の変更にも次の読み出しで気付く.
+  ファイルへの書き込み (SQLite の書き込みロック) は, 内容が変わった後に読まれた時だけになる.
+
+メンバーやページを読む SELECT を省く代わりに, 当たっても DB には version を読む1文を投げる.
+片付けたルームの行は reaper が forget で消し, 使われなくなったページは SHARED_CACHE_TTL 秒で捨てる.
+"""
+
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+import orjson
+
+from . import config
+from .ResReqModel import LiveDifficulty, RoomInfo, RoomUser, WaitRoomStatus
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshot (
+  key TEXT PRIMARY KEY,
+  version INTEGER NOT NULL,
+  value BLOB NOT NULL,
+  expires_at REAL NOT NULL
+);
+"""
+
+_GET_SQL = "SELECT version, value FROM snapshot WHERE key=? AND expires_at>?"
+
+# 古い version のスナップショットで新しい方を上書きしない
+_FILL_SQL = """
+INSERT INTO snapshot (key, version, value, expires_at) VALUES (?, ?, ?, ?)
+ON CONFLICT(key) DO UPDATE
+SET version=excluded.version, value=excluded.value, expires_at=excluded.expires_at
+WHERE excluded.version>=snapshot.version
+"""
+
+
+def _room_key(room_id: int) -> str:
+    return f"room:{room_id}"
+
+
+def _list_key(live_id: int, cursor: int, limit: int) -> str:
+    return f"list:{live_id}:{cursor}:{limit}"
+
+
+class SharedRoomCache:
+    def __init__(self, path: str, ttl: float = config.SHARED_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        # sqlite3 の接続はスレッドをまたげないので, スレッドプールのスレッドごとに開く
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # なかったか DB の version より古かったので入れた回数
+        self.fills = 0
+        self._connect().executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=config.SQLITE_BUSY_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            # 消えても DB から作り直せるので fsync しない
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def _get(self, key: str) -> Tuple[int, Optional[bytes]]:
+        """(スナップショットの version, 中身) を返す. なければ (0, None)"""
+        row = self._connect().execute(_GET_SQL, (key, time.time())).fetchone()
+        with self._stats_lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return (0, None) if row is None else row
+
+    def _fill(self, key: str, version: int, value: bytes) -> None:
+        expires_at = time.time() + self.ttl
+        self._connect().execute(_FILL_SQL, (key, version, value, expires_at))
+        with self._stats_lock:
+            self.fills += 1
+
+    def get_wait(
+        self, room_id: int, user_id: int
+    ) -> Tuple[int, Optional[Tuple[WaitRoomStatus, list[RoomUser]]]]:
+        """(スナップショットの room.version, スナップショット) を返す. なければ (0, None)
+
+        使う前に DB の room.version と同じか確かめること (storage.wait_room_since).
+        """
+        version, value = self._get(_room_key(room_id))
+        if value is None:
+            return version, None
+        snapshot = orjson.loads(value)
+        room_user_list = [
+            RoomUser.construct(
+                user_id=member_id,
+                name=name,
+                leader_card_id=leader_card_id,
+                select_difficulty=LiveDifficulty(difficulty),
+                is_me=member_id == user_id,
+                is_host=is_host,
+            )
+            for member_id, name, leader_card_id, difficulty, is_host in snapshot[
+                "users"
+            ]
+        ]
+        return version, (WaitRoomStatus(snapshot["status"]), room_user_list)
+
+    def set_wait(
+        self,
+        room_id: int,
+        version: int,
+        status: WaitRoomStatus,
+        room_user_list: list[RoomUser],
+    ) -> None:
+        # is_me は読む人ごとに違うので持たない
+        value = orjson.dumps(
+            {
+                "status": status.value,
+                "users": [
+                    [
+                        user.user_id,
+                        user.name,
+                        user.leader_card_id,
+                        user.select_difficulty.value,
+                        user.is_host,
+                    ]
+                    for user in room_user_list
+                ],
+            }
+        )
+        self._fill(_room_key(room_id), version, value)
+
+    def get_list(
+        self, live_id: int, cursor: int, limit: int
+    ) -> Tuple[int, Optional[Tuple[list[RoomInfo], Optional[int]]]]:
+        """(スナップショットの一覧の version, ページ) を返す. なければ (0, None)
+
+        使う前に DB の live_id の一覧の version と同じか確かめること (storage.list_room_since).
+        """
+        version, value = self._get(_list_key(live_id, cursor, limit))
+        if value is None:
+            return version, None
+        snapshot = orjson.loads(value)
+        room_info_list = [
+            RoomInfo.construct(
+                room_id=room_id,
+                live_id=room_live_id,
+                joined_user_count=joined_user_count,
+                max_user_count=max_user_count,
+            )
+            for room_id, room_live_id, joined_user_count, max_user_count in snapshot[
+                "rooms"
+            ]
+        ]
+        return version, (room_info_list, snapshot["next_cursor"])
+
+    def set_list(
+        self,
+        live_id: int,
+        cursor: int,
+        limit: int,
+        version: int,
+        room_info_list: list[RoomInfo],
+        next_cursor: Optional[int],
+    ) -> None:
+        value = orjson.dumps(
+            {
+                "rooms": [
+                    [
+                        room.room_id,
+                        room.live_id,
+                        room.joined_user_count,
+                        room.max_user_count,
+                    ]
+                    for room in room_info_list
+                ],
+                "next_cursor": next_cursor,
+            }
+        )
+        self._fill(_list_key(live_id, cursor, limit), version, value)
+
+    def forget(self, room_id: int) -> None:
+        """片付けたルームの行を消す (reaper から呼ぶ). 期限切れのページもついでに消す"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM snapshot WHERE key=?", (_room_key(room_id),))
+            conn.execute("DELETE FROM snapshot WHERE expires_at<=?", (time.time(),))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def stats(self) -> dict[str, int]:
+        with self._stats_lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "fills": self.fills,
+            }
+
+
+if config.SHARED_CACHE and (config.STORAGE == "memory" or config.ROOM_REGISTRY):
+    # どちらもルームの状態がプロセス内にあり, worker 1つで動かす前提
+    raise ValueError(
+        "GAMESERVER_SHARED_CACHE requires an SQL storage without the room registry"
+    )
+shared_cache: Optional[SharedRoomCache] = (
+    SharedRoomCache(config.SHARED_CACHE) if config.SHARED_CACHE else None
+)
@@ -0,0 +1,917 @@
+"""MySQL / SQLite 用の Storage
+
+SQL は両方で動くように書いている (SQLite もバッククォートを受け付ける).
+`_xxx(conn, ...)` は async_model からも AsyncConnection.run_sync で使う.
+"""
+
+import logging
+import os
+import time
+import uuid
+from typing import Iterator, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import IntegrityError, NoResultFound
+
+from .config import MAX_USER_COUNT, QUICKJOIN_CANDIDATES
+from .db import engine, read_router, readcommitted_engine
+from .ResReqModel import (
+    JoinRoomResult,
+    LiveDifficulty,
+    ResultUser,
+    RoomInfo,
+    RoomUser,
+    WaitRoomStatus,
+)
+from .storage import SafeUser, Storage
+
+logger = logging.getLogger(__name__)
+
+SQLITE_SCHEMA = os.path.join(os.path.dirname(__file__), "..", "schema_sqlite.sql")
+
+
+def _now() -> int:
+    """room.updated_at に入れる時刻 (UNIX秒)"""
+    return int(time.time())
+
+
+def _create_user(conn, name: str, leader_card_id: int) -> Tuple[str, SafeUser]:
+    token = str(uuid.uuid4())
+    # NOTE: tokenが衝突したらリトライする必要がある.
+    result = conn.execute(
+        text(
+            "INSERT INTO `user` (name, token, leader_card_id) VALUES (:name, :token, :leader_card_id)"
+        ),
+        {"name": name, "token": token, "leader_card_id": leader_card_id},
+    )
+    return token, SafeUser(
+        id=result.lastrowid, name=name, leader_card_id=leader_card_id
+    )
+
+
+def _get_user_by_token(conn, token: str) -> Optional[SafeUser]:
+    result = conn.execute(
+        text("SELECT `id`, `name`, `leader_card_id` FROM `user` WHERE `token`=:token"),
+        {"token": token},
+    )
+    try:
+        row = result.one()
+    except NoResultFound:
+        return None
+    return SafeUser.from_orm(row)
+
+
+def _get_user_by_id(conn, user_id: int) -> Optional[SafeUser]:
+    row = conn.execute(
+        text("SELECT `id`, `name`, `leader_card_id` FROM `user` WHERE `id`=:id"),
+        {"id": user_id},
+    ).one_or_none()
+    return None if row is None else SafeUser.from_orm(row)
+
+
+def _update_user(conn, user_id: int, name: str, leader_card_id: int) -> None:
+    conn.execute(
+        text(
+            "UPDATE `user` SET name=:name, leader_card_id=:leader_card_id WHERE id=:id"
+        ),
+        {"name": name, "leader_card_id": leader_card_id, "id": user_id},
+    )
+
+
+def _add_joined_user_count(conn, room_id: int, delta: int) -> None:
+    """member の増減に合わせて room.joined_user_count を更新する (一覧用の非正規化カラム)"""
+    conn.execute(
+        text(
+            "UPDATE `room` SET joined_user_count=joined_user_count+:delta, updated_at=:now,"
+            " version=version+1 WHERE room_id=:room_id"
+        ),
+        {"room_id": room_id, "delta": delta, "now": _now()},
+    )
+
+
+# 入場可能なルームの一覧 (/room/list) が変わりうる操作 (create/join/leave/start/片付け) で,
+# そのルームの live_id の version を +1 する. 他の行のロックを取った後, トランザクションの最後に書く
+_BUMP_LISTING_VERSION_SQL = {
+    "mysql": """
+        INSERT INTO live_room_version (live_id, version)
+        SELECT DISTINCT live_id, 1 FROM room WHERE room_id IN :room_ids
+        ON DUPLICATE KEY UPDATE version=version+1
+    """,
+    "sqlite": """
+        INSERT INTO live_room_version (live_id, version)
+        SELECT DISTINCT live_id, 1 FROM room WHERE room_id IN :room_ids
+        ON CONFLICT(live_id) DO UPDATE SET version=version+1
+    """,
+}
+
+
+def _bump_listing_version(conn, room_ids: list[int]) -> None:
+    conn.execute(
+        text(_BUMP_LISTING_VERSION_SQL[conn.dialect.name]).bindparams(
+            bindparam("room_ids", expanding=True)
+        ),
+        {"room_ids": room_ids},
+    )
+
+
+def _listing_version(conn, live_id: int) -> int:
+    """live_id の一覧の version. live_id が 0 (全体) なら全 live_id の合計 (どれかが変われば上がる)"""
+    if live_id == 0:
+        sql = "SELECT COALESCE(SUM(version), 0) FROM live_room_version"
+    else:
+        sql = "SELECT COALESCE(MAX(version), 0) FROM live_room_version WHERE live_id=:live_id"
+    return int(conn.execute(text(sql), {"live_id": live_id}).scalar())
+
+
+def _insert_member(conn, room_id, user_id, select_difficulty: LiveDifficulty):
+    conn.execute(
+        text(
+            "INSERT INTO `member` (room_id, member_id, difficulty) VALUES (:room_id, :user_id, :select_difficulty)"
+        ),
+        {
+            "room_id": room_id,
+            "user_id": user_id,
+            "select_difficulty": select_difficulty.value,
+        },
+    )
+
+
+def _create_room(
+    conn, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+) -> int:
+    result = conn.execute(
+        text(
+            "INSERT INTO `room` (live_id, status, owner, joined_user_count, updated_at)"
+            " VALUES (:live_id, :status, :owner, 1, :now)"
+        ),
+        {
+            "live_id": live_id,
+            "status": WaitRoomStatus.Waiting.value,
+            "owner": user_id,
+            "now": _now(),
+        },
+    )
+
+    room_id = result.lastrowid
+    _insert_member(conn, room_id, user_id, select_difficulty)
+    _bump_listing_version(conn, [room_id])
+    return room_id
+
+
+def _list_room(
+    conn, live_id: int, cursor: int, limit: int
+) -> Tuple[list[RoomInfo], Optional[int]]:
+    """room_id が cursor より大きい入場可能なルームを limit 件返す
+
+    room(status, live_id, room_id) のインデックスを順に読むだけなので, ルームの総数ではなく
+    limit に比例したコストになる. 2つ目の戻り値は次ページの cursor (なければ None).
+    """
+    where_query = "AND live_id=:live_id" if live_id != 0 else ""
+    result = conn.execute(
+        text(f"""
+            SELECT room_id, live_id, joined_user_count
+            FROM room
+            WHERE status=:waiting {where_query}
+                AND room_id>:cursor AND joined_user_count<:max_user_count
+            ORDER BY room_id
+            LIMIT :limit
+            """),
+        {
+            "live_id": live_id,
+            "waiting": WaitRoomStatus.Waiting.value,
+            "cursor": cursor,
+            "max_user_count": MAX_USER_COUNT,
+            # 次ページの有無を知るために1件多く取る
+            "limit": limit + 1,
+        },
+    )
+    rows = result.all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["room_id"]
+
+    room_info_list = [
+        RoomInfo(
+            room_id=row["room_id"],
+            live_id=row["live_id"],
+            joined_user_count=row["joined_user_count"],
+            max_user_count=MAX_USER_COUNT,
+        )
+        for row in rows
+    ]
+    return room_info_list, next_cursor
+
+
+def _list_room_since(
+    conn, live_id: int, cursor: int, limit: int, known_version: int
+) -> Tuple[int, Optional[Tuple[list[RoomInfo], Optional[int]]]]:
+    """live_id の一覧の version が known_version のままならページを読まずに (version, None) を返す
+
+    version はページより先に読むので, その間に変わっても古い version と新しいページの組になる
+    だけで, 次の呼び出しで読み直す. known_version が 0 (まだ何も持っていない) なら必ず読む.
+    """
+    version = _listing_version(conn, live_id)
+    if known_version != 0 and version == known_version:
+        return version, None
+    return version, _list_room(conn, live_id, cursor, limit)
+
+
+def _classify_join_failure(conn, room_id: int, user_id: int) -> JoinRoomResult:
+    """枠の確保に失敗した理由を調べる"""
+    row = conn.execute(
+        text("""
+            SELECT status, joined_user_count, EXISTS(
+                SELECT 1 FROM member
+                WHERE room_id=:room_id AND member_id=:user_id AND left_at=0
+            ) AS is_member
+            FROM room
+            WHERE room_id=:room_id
+            """),
+        {"room_id": room_id, "user_id": user_id},
+    ).one_or_none()
+    if (
+        row is None
+        or row["status"] == WaitRoomStatus.Dissolution.value
+        # ライブ後に全員抜けたルーム (LiveStart のまま)
+        or row["joined_user_count"] == 0
+    ):
+        return JoinRoomResult.Disbanded
+    if row["is_member"]:
+        logger.debug("already joined room %s: user %s", room_id, user_id)
+        return JoinRoomResult.Ok
+    if row["status"] != WaitRoomStatus.Waiting.value:
+        # ライブ開始済み
+        return JoinRoomResult.OtherError
+    return JoinRoomResult.RoomFull
+
+
+def _join_room(
+    conn, room_id: int, user_id: int, select_difficulty: LiveDifficulty
+) -> JoinRoomResult:
+    """ルームに入る. 定員チェックと枠の確保は1文の UPDATE で行う
+
+    room 行の joined_user_count を条件付きで +1 し, 成功した時だけ member を INSERT する.
+    UPDATE は room 行を排他ロックし, 最新の commit 済みの値で WHERE を評価し直すので,
+    同時に join が来ても定員を超えない. 成功/失敗どちらも SQL は2文で済む.
+    """
+    result = conn.execute(
+        text("""
+            UPDATE room
+            SET joined_user_count=joined_user_count+1, updated_at=:now, version=version+1
+            WHERE room_id=:room_id AND status=:waiting
+                AND joined_user_count<:max_user_count
+                AND NOT EXISTS(
+                    SELECT 1 FROM member WHERE room_id=:room_id AND member_id=:user_id
+                )
+            """),
+        {
+            "room_id": room_id,
+            "user_id": user_id,
+            "waiting": WaitRoomStatus.Waiting.value,
+            "max_user_count": MAX_USER_COUNT,
+            "now": _now(),
+        },
+    )
+    if result.rowcount != 1:
+        return _classify_join_failure(conn, room_id, user_id)
+
+    try:
+        _insert_member(conn, room_id, user_id, select_difficulty)
+    except IntegrityError:
+        # 同じユーザーの join が並行して先に入った. 確保した枠を返す
+        _add_joined_user_count(conn, room_id, -1)
+        logger.debug("already joined room %s: user %s", room_id, user_id)
+        return JoinRoomResult.Ok
+    _bump_listing_version(conn, [room_id])
+    logger.debug("join room %s: user %s", room_id, user_id)
+    return JoinRoomResult.Ok
+
+
+def _quick_join(
+    conn, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+) -> Tuple[int, bool]:
+    """live_id の待機中のルームのうち一番埋まっているものに入る. なければ作る
+
+    候補を QUICKJOIN_CANDIDATES 件取り, 埋まっている順に _join_room の条件付き UPDATE で入る.
+    同時に来た quickjoin に枠を取られたら次の候補に移るので, 全部の候補で負けた時だけ作る.
+    戻り値は (room_id, 作ったかどうか).
+    """
+    rows = conn.execute(
+        text("""
+            SELECT room_id
+            FROM room
+            WHERE status=:waiting AND live_id=:live_id
+                AND joined_user_count<:max_user_count
+            ORDER BY joined_user_count DESC, room_id
+            LIMIT :limit
+            """),
+        {
+            "waiting": WaitRoomStatus.Waiting.value,
+            "live_id": live_id,
+            "max_user_count": MAX_USER_COUNT,
+            "limit": QUICKJOIN_CANDIDATES,
+        },
+    ).all()
+    for row in rows:
+        result = _join_room(conn, row["room_id"], user_id, select_difficulty)
+        if result == JoinRoomResult.Ok:
+            return row["room_id"], False
+    return _create_room(conn, user_id, live_id, select_difficulty), True
+
+
+def _get_user_info(rows, req_user_id) -> Tuple[WaitRoomStatus, list[RoomUser]]:
+    user_info_list = []
+    status = WaitRoomStatus(rows[0]["status"])
+    host_user_id = rows[0]["owner"]
+    for row in rows:
+        user_info_list.append(
+            RoomUser(
+                user_id=row["member_id"],
+                name=row["name"],
+                leader_card_id=row["leader_card_id"],
+                select_difficulty=LiveDifficulty(row["difficulty"]),
+                is_me=row["member_id"] == req_user_id,
+                is_host=row["member_id"] == host_user_id,
+            )
+        )
+    return status, user_info_list
+
+
+def _wait_room(
+    conn, room_id: int, user_id: int
+) -> Tuple[WaitRoomStatus, list[RoomUser]]:
+    result = conn.execute(
+        text("""
+            SELECT member_id, user.name, user.leader_card_id, difficulty, room.owner, room.status
+            FROM member
+            INNER JOIN user
+            ON member.member_id=user.id
+            INNER JOIN room
+            ON member.room_id=room.room_id
+            WHERE member.room_id=:room_id AND member.left_at=0
+            """),
+        {"room_id": room_id},
+    )
+    rows = result.all()
+    if not rows:
+        # 誰もいない = 解散済み (または存在しないルーム)
+        return WaitRoomStatus.Dissolution, []
+    return _get_user_info(rows, user_id)
+
+
+def _wait_room_since(
+    conn, room_id: int, user_id: int, known_version: int
+) -> Tuple[int, WaitRoomStatus, Optional[list[RoomUser]]]:
+    """room.version が known_version のままならメンバーを読まずに (version, status, None) を返す
+
+    member/user は version が違う時だけ LEFT JOIN するので, 変化がなければ room の主キーを
+    1行読むだけで済む. 変化があっても1文で全体を返す. ルームがなければ version は 0.
+    """
+    rows = conn.execute(
+        text("""
+            SELECT room.version, room.status, room.owner,
+                member.member_id, member.difficulty, user.name, user.leader_card_id
+            FROM room
+            LEFT JOIN member
+            ON member.room_id=room.room_id AND member.left_at=0
+                AND room.version!=:known_version
+            LEFT JOIN user
+            ON member.member_id=user.id
+            WHERE room.room_id=:room_id
+            """),
+        {"room_id": room_id, "known_version": known_version},
+    ).all()
+    if not rows:
+        return 0, WaitRoomStatus.Dissolution, []
+    version = rows[0]["version"]
+    if version == known_version:
+        return version, WaitRoomStatus(rows[0]["status"]), None
+    if rows[0]["member_id"] is None:
+        # 誰もいない = 解散済み
+        return version, WaitRoomStatus.Dissolution, []
+    status, room_user_list = _get_user_info(rows, user_id)
+    return version, status, room_user_list
+
+
+def _start_room(conn, room_id: int, user_id: int) -> None:
+    # オーナーの確認と更新を1文で (オーナーでなければ0行)
+    result = conn.execute(
+        text("""
+            UPDATE `room` SET `status`=:status, updated_at=:now, version=version+1
+            WHERE `room_id`=:room_id AND `owner`=:user_id
+            """),
+        {
+            "status": WaitRoomStatus.LiveStart.value,
+            "room_id": room_id,
+            "user_id": user_id,
+            "now": _now(),
+        },
+    )
+    if result.rowcount != 1:
+        logger.debug("owner is diffrent!! room %s: user %s", room_id, user_id)
+        return None
+    _bump_listing_version(conn, [room_id])
+
+
+# member の判定数カラム. judge_count_list はこの順 (perfect, great, good, bad, miss)
+JUDGE_COLUMNS = (
+    "judge_perfect",
+    "judge_great",
+    "judge_good",
+    "judge_bad",
+    "judge_miss",
+)
+
+
+def _update_myresult_by_user_id(
+    conn, room_id: int, user_id: int, score: int, judge_count_list: list[int]
+):
+    params = dict(zip(JUDGE_COLUMNS, judge_count_list))
+    params.update(
+        {"room_id": room_id, "user_id": user_id, "score": score, "now": _now()}
+    )
+    conn.execute(
+        text("""
+            UPDATE `member`
+            SET score=:score, judge_perfect=:judge_perfect, judge_great=:judge_great,
+                judge_good=:judge_good, judge_bad=:judge_bad, judge_miss=:judge_miss,
+                scored_at=:now
+            WHERE room_id=:room_id AND member_id=:user_id
+            """),
+        params,
+    )
+
+
+def _end_room(
+    conn, room_id: int, user_id: int, score: int, judge_count_list: list[int]
+) -> Optional[Tuple[int, LiveDifficulty, SafeUser]]:
+    _update_myresult_by_user_id(conn, room_id, user_id, score, judge_count_list)
+    # ランキング用. 名前なども一緒に引いて user を別に読まない
+    row = conn.execute(
+        text("""
+            SELECT room.live_id, member.difficulty, user.name, user.leader_card_id
+            FROM member
+            JOIN room ON room.room_id=member.room_id
+            JOIN `user` ON user.id=member.member_id
+            WHERE member.room_id=:room_id AND member.member_id=:user_id
+            """),
+        {"room_id": room_id, "user_id": user_id},
+    ).one_or_none()
+    if row is None:
+        return None
+    user = SafeUser(id=user_id, name=row["name"], leader_card_id=row["leader_card_id"])
+    return row["live_id"], LiveDifficulty(row["difficulty"]), user
+
+
+def _end_rooms(
+    conn, scores: list[Tuple[int, int, int, list[int]]]
+) -> list[Optional[Tuple[int, LiveDifficulty, SafeUser]]]:
+    """(room_id, user_id, score, judge_count_list) をまとめて書く _end_room
+
+    UPDATE は executemany で1回に流し, ランキング用の情報はルーム単位の SELECT 1文で引く.
+    戻り値は scores と同じ順. メンバーでなかったものは None.
+    """
+    params = []
+    now = _now()
+    for room_id, user_id, score, judge_count_list in scores:
+        row = dict(zip(JUDGE_COLUMNS, judge_count_list))
+        row.update({"room_id": room_id, "user_id": user_id, "score": score, "now": now})
+        params.append(row)
+    conn.execute(
+        text("""
+            UPDATE `member`
+            SET score=:score, judge_perfect=:judge_perfect, judge_great=:judge_great,
+                judge_good=:judge_good, judge_bad=:judge_bad, judge_miss=:judge_miss,
+                scored_at=:now
+            WHERE room_id=:room_id AND member_id=:user_id
+            """),
+        params,
+    )
+    rows = conn.execute(
+        text("""
+            SELECT member.room_id, member.member_id, room.live_id, member.difficulty,
+                user.name, user.leader_card_id
+            FROM member
+            JOIN room ON room.room_id=member.room_id
+            JOIN `user` ON user.id=member.member_id
+            WHERE member.room_id IN :room_ids
+            """).bindparams(bindparam("room_ids", expanding=True)),
+        {"room_ids": sorted({room_id for room_id, *_ in scores})},
+    ).all()
+    played = {}
+    for row in rows:
+        user = SafeUser(
+            id=row["member_id"], name=row["name"], leader_card_id=row["leader_card_id"]
+        )
+        played[row["room_id"], row["member_id"]] = (
+            row["live_id"],
+            LiveDifficulty(row["difficulty"]),
+            user,
+        )
+    return [played.get((room_id, user_id)) for room_id, user_id, *_ in scores]
+
+
+def check_can_return(rows):
+    for row in rows:
+        if row["score"] is None:
+            return False
+    return True
+
+
+def _get_result_user_list_from_row(rows) -> list[ResultUser]:
+    if not check_can_return(rows):
+        return []
+    resultuser_list = []
+    for row in rows:
+        resultuser_list.append(
+            ResultUser(
+                user_id=row["member_id"],
+                judge_count_list=[row[column] for column in JUDGE_COLUMNS],
+                score=row["score"],
+            )
+        )
+    return resultuser_list
+
+
+def _result_room(conn, room_id: int) -> list[ResultUser]:
+    result = conn.execute(
+        text("""
+            SELECT member_id, score, judge_perfect, judge_great, judge_good,
+                judge_bad, judge_miss
+            FROM member
+            WHERE room_id=:room_id
+            """),
+        {"room_id": room_id},
+    )
+    rows = result.all()
+    return _get_result_user_list_from_row(rows)
+
+
+# メンバーなら人数を減らし, オーナーなら残っている一番古い (member_id の小さい) メンバーに
+# 譲る. 待機中に誰も残らなければ解散にする. ライブ後に全員抜けたルームは, 書き出しがライブを
+# したルームとして読むので LiveStart のまま残す (wait は誰もいなければ解散と返す).
+# member より先に room の行をロックする (join と同じ順).
+# MySQL は SET を左から評価して後の式が更新後の値を見るので, owner を見る status を先に書く.
+# left_at が 0 でない行は抜けたメンバー (結果を出した後に抜けた. _leave_room を参照)
+_LEAVE_ROOM_SQL = """
+    UPDATE room
+    SET status=CASE
+            WHEN status=:waiting AND owner=:user_id AND NOT EXISTS(
+                SELECT 1 FROM member
+                WHERE room_id=:room_id AND member_id!=:user_id AND left_at=0
+            ) THEN :dissolution
+            ELSE status
+        END,
+        owner=CASE
+            WHEN owner=:user_id THEN COALESCE((
+                SELECT MIN(member_id) FROM member
+                WHERE room_id=:room_id AND member_id!=:user_id AND left_at=0
+            ), owner)
+            ELSE owner
+        END,
+        joined_user_count=joined_user_count-1,
+        updated_at=:now,
+        version=version+1
+    WHERE room_id=:room_id AND EXISTS(
+        SELECT 1 FROM member
+        WHERE room_id=:room_id AND member_id=:user_id AND left_at=0
+    )
+"""
+
+
+def _leave_room(conn, room_id: int, user_id: int) -> None:
+    params = {
+        "room_id": room_id,
+        "user_id": user_id,
+        "waiting": WaitRoomStatus.Waiting.value,
+        "dissolution": WaitRoomStatus.Dissolution.value,
+        "now": _now(),
+    }
+    result = conn.execute(text(_LEAVE_ROOM_SQL), params)
+    if result.rowcount != 1:
+        # メンバーではない (もう抜けた / ルームがない)
+        return None
+    # 結果を出したメンバーの行はランキング/集計/書き出しが読むので消さずに印を付ける.
+    # ライブ後に抜けるのが普通なので, こちらを先に試す
+    result = conn.execute(
+        text(
+            "UPDATE member SET left_at=:now"
+            " WHERE room_id=:room_id AND member_id=:user_id AND score IS NOT NULL"
+        ),
+        params,
+    )
+    if result.rowcount == 0:
+        conn.execute(
+            text("DELETE FROM member WHERE room_id=:room_id AND member_id=:user_id"),
+            params,
+        )
+    _bump_listing_version(conn, [room_id])
+    logger.debug("leave room %s: user %s", room_id, user_id)
+
+
+# 片付けてよいルーム. 解散済み (finished_before より前に更新) / 全員のスコアが揃ったライブ
+# (最後のスコアも finished_before より前) と, idle_before より前から更新のないルーム.
+# /room/end は room.updated_at を更新しないので, ライブの猶予は member.scored_at から数える
+_ARCHIVE_CONDITION = """
+    (status=:dissolution AND updated_at<:finished_before)
+    OR (status=:live_start AND updated_at<:finished_before AND NOT EXISTS(
+        SELECT 1 FROM member WHERE member.room_id=room.room_id
+            AND (member.score IS NULL OR member.scored_at>=:finished_before)
+    ))
+    OR updated_at<:idle_before
+"""
+
+_ROOM_COLUMNS = "room_id, live_id, status, owner, joined_user_count, updated_at"
+_MEMBER_COLUMNS = (
+    "room_id, member_id, difficulty, score, judge_perfect, judge_great, judge_good, "
+    "judge_bad, judge_miss, scored_at, left_at"
+)
+
+
+def _archive_rooms(
+    conn, finished_before: int, idle_before: int, limit: int
+) -> list[int]:
+    """片付けてよいルームを最大 limit 件, member ごと room_archive/member_archive に移す
+
+    対象の room 行は FOR UPDATE でロックしてから移すので, 並行する join は
+    消えた後のルームを見て Disbanded になる (READ COMMITTED で呼ぶこと. ギャップロックを避ける).
+    """
+    lock = " FOR UPDATE" if conn.dialect.name == "mysql" else ""
+    rows = conn.execute(
+        text(f"""
+            SELECT room_id FROM room
+            WHERE {_ARCHIVE_CONDITION}
+            ORDER BY room_id
+            LIMIT :limit{lock}
+            """),
+        {
+            "dissolution": WaitRoomStatus.Dissolution.value,
+            "live_start": WaitRoomStatus.LiveStart.value,
+            "finished_before": finished_before,
+            "idle_before": idle_before,
+            "limit": limit,
+        },
+    ).all()
+    room_ids = [row["room_id"] for row in rows]
+    if not room_ids:
+        return []
+    # 放置されていた待機中のルームは一覧から消える
+    _bump_listing_version(conn, room_ids)
+    params = {"room_ids": room_ids, "now": _now()}
+    for sql in (
+        f"""
+        INSERT INTO room_archive ({_ROOM_COLUMNS}, archived_at)
+        SELECT {_ROOM_COLUMNS}, :now FROM room WHERE room_id IN :room_ids
+        """,
+        f"""
+        INSERT INTO member_archive ({_MEMBER_COLUMNS})
+        SELECT {_MEMBER_COLUMNS} FROM member WHERE room_id IN :room_ids
+        """,
+        "DELETE FROM member WHERE room_id IN :room_ids",
+        "DELETE FROM room WHERE room_id IN :room_ids",
+    ):
+        conn.execute(
+            text(sql).bindparams(bindparam("room_ids", expanding=True)), params
+        )
+    return room_ids
+
+
+# スコアの入っている member を user と合わせて読む. {member}/{room} に本体かアーカイブを入れる
+_SCORES_SQL = """
+    SELECT r.live_id, m.difficulty, m.member_id, u.name, u.leader_card_id, m.score
+    FROM {member} m
+    JOIN {room} r ON r.room_id=m.room_id
+    JOIN `user` u ON u.id=m.member_id
+    WHERE m.score IS NOT NULL
+"""
+
+
+def _iter_scores(conn) -> Iterator[tuple]:
+    for member, room in (("member", "room"), ("member_archive", "room_archive")):
+        # 全件を一度にメモリに載せないよう, サーバーサイドカーソルで流す
+        result = conn.execution_options(stream_results=True).execute(
+            text(_SCORES_SQL.format(member=member, room=room))
+        )
+        for row in result:
+            yield (
+                row["live_id"],
+                LiveDifficulty(row["difficulty"]),
+                row["member_id"],
+                row["name"],
+                row["leader_card_id"],
+                row["score"],
+            )
+
+
+# scored_at が [:scored_from, :scored_before) の結果. 本体とアーカイブを1文で読む
+_RESULTS_SQL = """
+    SELECT m.room_id, m.member_id, r.live_id, m.difficulty, m.score,
+        COALESCE(m.judge_perfect, 0), COALESCE(m.judge_great, 0), COALESCE(m.judge_good, 0),
+        COALESCE(m.judge_bad, 0), COALESCE(m.judge_miss, 0), m.scored_at
+    FROM {member} m
+    JOIN {room} r ON r.room_id=m.room_id
+    WHERE m.score IS NOT NULL
+        AND m.scored_at>=:scored_from AND m.scored_at<:scored_before
+"""
+
+
+def _iter_results(conn, scored_from: int, scored_before: int) -> Iterator[tuple]:
+    sql = " UNION ALL ".join(
+        _RESULTS_SQL.format(member=member, room=room)
+        for member, room in (("member", "room"), ("member_archive", "room_archive"))
+    )
+    result = conn.execution_options(stream_results=True).execute(
+        text(sql), {"scored_from": scored_from, "scored_before": scored_before}
+    )
+    for row in result:
+        yield tuple(row)
+
+
+# ライブが終わったルームのスコアを (room_id, member_id) 順に :limit 行. {member}/{room} に本体かアーカイブを,
+# {finished} に本体ならスコアの揃っていないルームを除く条件を入れる. どちらも member の主キー順に読んで
+# LIMIT で止まる (CROSS JOIN は SQLite で結合順を member 先に固定するため. MySQL では JOIN と同じ)
+_EXPORT_SQL = """
+    SELECT * FROM (
+        SELECT m.room_id, m.member_id, r.live_id, m.difficulty, m.score,
+            m.judge_perfect, m.judge_great, m.judge_good, m.judge_bad, m.judge_miss,
+            m.scored_at
+        FROM {member} m
+        CROSS JOIN {room} r ON r.room_id=m.room_id
+        WHERE r.status=:live_start AND m.score IS NOT NULL{finished}{filters}
+            AND (m.room_id>:after_room_id
+                OR (m.room_id=:after_room_id AND m.member_id>:after_member_id))
+        ORDER BY m.room_id, m.member_id
+        LIMIT :limit
+    ) {alias}
+"""
+_EXPORT_UNFINISHED = """
+            AND NOT EXISTS(
+                SELECT 1 FROM member u WHERE u.room_id=m.room_id AND u.score IS NULL
+            )"""
+
+
+def _iter_export(
+    conn,
+    after: Tuple[int, int],
+    live_id: Optional[int],
+    min_room_id: Optional[int],
+    max_room_id: Optional[int],
+    limit: int,
+) -> Iterator[tuple]:
+    """書き出しの1ページ. reaper が本体からアーカイブへ移している途中でも, 1文なので重複/欠落しない"""
+    filters = ""
+    if live_id is not None:
+        filters += " AND r.live_id=:live_id"
+    if min_room_id is not None:
+        filters += " AND m.room_id>=:min_room_id"
+    if max_room_id is not None:
+        filters += " AND m.room_id<=:max_room_id"
+    sql = " UNION ALL ".join(
+        _EXPORT_SQL.format(
+            member=member, room=room, alias=alias, finished=finished, filters=filters
+        )
+        for member, room, alias, finished in (
+            ("member", "room", "live", _EXPORT_UNFINISHED),
+            ("member_archive", "room_archive", "archived", ""),
+        )
+    )
+    result = conn.execution_options(stream_results=True).execute(
+        text(sql + " ORDER BY room_id, member_id LIMIT :limit"),
+        {
+            "live_start": WaitRoomStatus.LiveStart.value,
+            "after_room_id": after[0],
+            "after_member_id": after[1],
+            "live_id": live_id,
+            "min_room_id": min_room_id,
+            "max_room_id": max_room_id,
+            "limit": limit,
+        },
+    )
+    for row in result:
+        yield tuple(row)
+
+
+class SqlStorage(Storage):
+    def __init__(self):
+        if engine.dialect.name == "sqlite":
+            # MySQL はデプロイ時に schema.sql を流すが, SQLite は起動時に作る
+            with open(SQLITE_SCHEMA) as f:
+                statements = [s for s in f.read().split(";") if s.strip()]
+            with engine.begin() as conn:
+                for statement in statements:
+                    conn.exec_driver_sql(statement)
+
+    def create_user(self, name: str, leader_card_id: int) -> Tuple[str, SafeUser]:
+        with engine.begin() as conn:
+            return _create_user(conn, name, leader_card_id)
+
+    def get_user_by_token(self, token: str) -> Optional[SafeUser]:
+        with engine.begin() as conn:
+            return _get_user_by_token(conn, token)
+
+    def get_user_by_id(self, user_id: int) -> Optional[SafeUser]:
+        with engine.begin() as conn:
+            return _get_user_by_id(conn, user_id)
+
+    def update_user(self, user_id: int, name: str, leader_card_id: int) -> None:
+        with engine.begin() as conn:
+            _update_user(conn, user_id, name, leader_card_id)
+
+    def create_room(
+        self, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+    ) -> int:
+        read_router.pin(("user", user_id))
+        with engine.begin() as conn:
+            return _create_room(conn, user_id, live_id, select_difficulty)
+
+    def list_room(
+        self, live_id: int, cursor: int, limit: int
+    ) -> Tuple[list[RoomInfo], Optional[int]]:
+        # https://docs.sqlalchemy.org/en/14/core/connections.html#setting-transaction-isolation-levels-including-dbapi-autocommit
+        # 誰のリクエストかわからないので pin は見ない (一覧は元々すぐ古くなる)
+        with read_router.engine(read_committed=True).begin() as conn:
+            return _list_room(conn, live_id, cursor, limit)
+
+    def list_room_since(
+        self, live_id: int, cursor: int, limit: int, known_version: int
+    ) -> Tuple[int, Optional[Tuple[list[RoomInfo], Optional[int]]]]:
+        with read_router.engine(read_committed=True).begin() as conn:
+            return _list_room_since(conn, live_id, cursor, limit, known_version)
+
+    def join_room(
+        self, room_id: int, user_id: int, select_difficulty: LiveDifficulty
+    ) -> JoinRoomResult:
+        # 書いた本人のこの後の wait が遅れたレプリカを読まないように, 書く前に pin する
+        read_router.pin(("user", user_id))
+        with readcommitted_engine.begin() as conn:
+            return _join_room(conn, room_id, user_id, select_difficulty)
+
+    def quick_join(
+        self, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+    ) -> Tuple[int, bool]:
+        read_router.pin(("user", user_id))
+        with readcommitted_engine.begin() as conn:
+            return _quick_join(conn, user_id, live_id, select_difficulty)
+
+    def wait_room(
+        self, room_id: int, user_id: int
+    ) -> Tuple[WaitRoomStatus, list[RoomUser]]:
+        with read_router.engine(("user", user_id)).begin() as conn:
+            return _wait_room(conn, room_id, user_id)
+
+    def wait_room_since(
+        self, room_id: int, user_id: int, known_version: int
+    ) -> Tuple[int, WaitRoomStatus, Optional[list[RoomUser]]]:
+        with read_router.engine(("user", user_id)).begin() as conn:
+            return _wait_room_since(conn, room_id, user_id, known_version)
+
+    def start_room(self, room_id: int, user_id: int) -> None:
+        read_router.pin(("user", user_id))
+        with engine.begin() as conn:
+            _start_room(conn, room_id, user_id)
+
+    def end_room(
+        self, room_id: int, user_id: int, score: int, judge_count_list: list[int]
+    ) -> Optional[Tuple[int, LiveDifficulty, SafeUser]]:
+        # /room/result は token を取らないので, ルーム単位で pin する
+        read_router.pin(("user", user_id), ("room", room_id))
+        with engine.begin() as conn:
+            return _end_room(conn, room_id, user_id, score, judge_count_list)
+
+    def result_room(self, room_id: int) -> list[ResultUser]:
+        with read_router.engine(("room", room_id)).begin() as conn:
+            return _result_room(conn, room_id)
+
+    def leave_room(self, room_id: int, user_id: int) -> None:
+        read_router.pin(("user", user_id))
+        with readcommitted_engine.begin() as conn:
+            _leave_room(conn, room_id, user_id)
+
+    def archive_rooms(
+        self, finished_before: int, idle_before: int, limit: int
+    ) -> list[int]:
+        with readcommitted_engine.begin() as conn:
+            return _archive_rooms(conn, finished_before, idle_before, limit)
+
+    def iter_scores(self) -> Iterator[tuple]:
+        with engine.connect() as conn:
+            yield from _iter_scores(conn)
+
+    def iter_results(self, scored_from: int, scored_before: int) -> Iterator[tuple]:
+        # 集計用の読み込みなのでレプリカでよい
+        with read_router.engine().connect() as conn:
+            yield from _iter_results(conn, scored_from, scored_before)
+
+    def iter_export(
+        self,
+        after: Tuple[int, int],
+        live_id: Optional[int],
+        min_room_id: Optional[int],
+        max_room_id: Optional[int],
+        limit: int,
+    ) -> Iterator[tuple]:
+        with read_router.engine().connect() as conn:
+            yield from _iter_export(
+                conn, after, live_id, min_room_id, max_room_id, limit
+            )
@@ -0,0 +1,186 @@
+"""user/room/member の永続化のインターフェース
+
+実装は config.STORAGE で選ぶ.
+
+- "mysql": MySQL (sql_storage.SqlStorage)
+- "sqlite": SQLite のファイル or :memory: (sql_storage.SqlStorage. SQL は MySQL と共通)
+- "memory": Python の dict だけで持つ (memory_storage.MemoryStorage)
+
+token の解決 (キャッシュ) や変更通知は model 側でやるので, ここでは token を受け取るのは
+ユーザーを引く時だけで, それ以外は解決済みの user_id を受け取る.
+"""
+
+import time
+from abc import ABC, abstractmethod
+from typing import Iterator, Optional, Tuple
+
+from pydantic import BaseModel
+
+from . import config
+from .ResReqModel import (
+    JoinRoomResult,
+    LiveDifficulty,
+    ResultUser,
+    RoomInfo,
+    RoomUser,
+    WaitRoomStatus,
+)
+
+
+class SafeUser(BaseModel):
+    """token を含まないUser"""
+
+    id: int
+    name: str
+    leader_card_id: int
+
+    class Config:
+        orm_mode = True
+
+
+class Storage(ABC):
+    @abstractmethod
+    def create_user(self, name: str, leader_card_id: int) -> Tuple[str, SafeUser]:
+        """ユーザーを作って (token, user) を返す"""
+
+    @abstractmethod
+    def get_user_by_token(self, token: str) -> Optional[SafeUser]: ...
+
+    @abstractmethod
+    def get_user_by_id(self, user_id: int) -> Optional[SafeUser]: ...
+
+    @abstractmethod
+    def update_user(self, user_id: int, name: str, leader_card_id: int) -> None: ...
+
+    @abstractmethod
+    def create_room(
+        self, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+    ) -> int:
+        """ルームを作ってホストを入れ, room_id を返す"""
+
+    @abstractmethod
+    def list_room(
+        self, live_id: int, cursor: int, limit: int
+    ) -> Tuple[list[RoomInfo], Optional[int]]:
+        """入場可能なルームを room_id 昇順に limit 件と, 次ページの cursor を返す"""
+
+    @abstractmethod
+    def list_room_since(
+        self, live_id: int, cursor: int, limit: int, known_version: int
+    ) -> Tuple[int, Optional[Tuple[list[RoomInfo], Optional[int]]]]:
+        """(live_id の一覧の version, (ページ, 次ページの cursor)) を返す
+
+        version は live_id ごと (0 なら全体) で, そのルームが作られる/入退室/ライブ開始/片付けられる
+        たびに上がり, 下がらない. known_version (0 以外) と同じならページを読まずに None を返す.
+        """
+
+    @abstractmethod
+    def join_room(
+        self, room_id: int, user_id: int, select_difficulty: LiveDifficulty
+    ) -> JoinRoomResult: ...
+
+    @abstractmethod
+    def quick_join(
+        self, user_id: int, live_id: int, select_difficulty: LiveDifficulty
+    ) -> Tuple[int, bool]:
+        """live_id の入場可能なルームのうち一番埋まっているものに入り, なければ作る
+
+        (room_id, 作ったかどうか) を返す. 選ぶのと入るのは同じトランザクション (ロック) で行う.
+        """
+
+    @abstractmethod
+    def wait_room(
+        self, room_id: int, user_id: int
+    ) -> Tuple[WaitRoomStatus, list[RoomUser]]: ...
+
+    @abstractmethod
+    def wait_room_since(
+        self, room_id: int, user_id: int, known_version: int
+    ) -> Tuple[int, WaitRoomStatus, Optional[list[RoomUser]]]:
+        """(ルームの version, status, メンバー) を返す. version が known_version と同じならメンバーは None
+
+        version はメンバーの入退室/オーナーの交代/ライブ開始で上がる (名前などの変更では上がらない).
+        ルームがなければ (0, Dissolution, []).
+        """
+
+    @abstractmethod
+    def start_room(self, room_id: int, user_id: int) -> None:
+        """オーナーの時だけライブ開始にする"""
+
+    @abstractmethod
+    def end_room(
+        self, room_id: int, user_id: int, score: int, judge_count_list: list[int]
+    ) -> Optional[Tuple[int, LiveDifficulty, SafeUser]]:
+        """スコアを記録し, ランキング用に (live_id, 難易度, user) を返す. メンバーでなければ None"""
+
+    @abstractmethod
+    def result_room(self, room_id: int) -> list[ResultUser]:
+        """全員のスコアが揃っていれば結果を, 揃っていなければ [] を返す"""
+
+    @abstractmethod
+    def leave_room(self, room_id: int, user_id: int) -> None:
+        """オーナーが抜けたら残りの誰かに引き継ぎ, 誰もいなくなったら解散する"""
+
+    @abstractmethod
+    def archive_rooms(
+        self, finished_before: int, idle_before: int, limit: int
+    ) -> list[int]:
+        """終わったルームを最大 limit 件片付けて, その room_id を返す (app/reaper.py から呼ぶ)
+
+        解散済みのルームは最終更新が, 全員のスコアが揃ったライブは最後のスコアも finished_before
+        より前なら, それ以外のルームも最終更新が idle_before より前なら対象にする (時刻は UNIX秒).
+        """
+
+    @abstractmethod
+    def iter_scores(self) -> Iterator[tuple]:
+        """記録済みの全スコアを (live_id, 難易度, user_id, name, leader_card_id, score) で流す
+
+        起動時のランキングの作り直し用 (app/leaderboard.py). 順序は不定.
+        """
+
+    @abstractmethod
+    def iter_results(self, scored_from: int, scored_before: int) -> Iterator[tuple]:
+        """scored_at が [scored_from, scored_before) の結果を流す (/live/stats の集計用. 順序は不定)
+
+        1行は (room_id, member_id, live_id, 難易度(int), score,
+        perfect, great, good, bad, miss, scored_at).
+        """
+
+    @abstractmethod
+    def iter_export(
+        self,
+        after: Tuple[int, int],
+        live_id: Optional[int],
+        min_room_id: Optional[int],
+        max_room_id: Optional[int],
+        limit: int,
+    ) -> Iterator[tuple]:
+        """ライブが終わったルーム (アーカイブ済みを含む) のスコアを (room_id, member_id) 順に流す
+
+        (room_id, member_id) が after より後の最大 limit 行. live_id, room_id の範囲 (両端を含む) は
+        None なら絞らない. 1行は (room_id, member_id, live_id, 難易度(int), score,
+        perfect, great, good, bad, miss, scored_at) (app/export.py の書き出し用).
+        まだスコアが揃っていないルームは含めない.
+        """
+
+
+def listing_version_base() -> int:
+    """プロセス内で数える /room/list の version (memory storage, registry) の初期値
+
+    再起動で 0 から数え直すと前のプロセスで返した version が別の内容で出てしまうので,
+    起動時刻 (秒) の 2^20 倍から始める (1秒に 2^20 回より速く変わらなければ前より大きい).
+    JavaScript の数値で扱える 2^53 には収まる.
+    """
+    return int(time.time()) << 20
+
+
+def create_storage() -> Storage:
+    if config.STORAGE == "memory":
+        from .memory_storage import MemoryStorage
+
+        return MemoryStorage()
+    if config.STORAGE in ("mysql", "sqlite"):
+        from .sql_storage import SqlStorage
+
+        return SqlStorage()
+    raise ValueError(f"unknown storage: {config.STORAGE}")
@@ -0,0 +1,177 @@
+"""/room/wait の push 版 (long-poll と WebSocket)
+
+どちらも DB の room.version (/room/wait の version と同じ, 全 worker 共通) が進んだ時だけ応答する.
+notify.room_notifier はこの worker での変更をすぐ知らせるヒントで, 他 worker での変更は
+LONG_POLL_RECHECK_INTERVAL ごとに version を読み直して拾う (変化がなければ room の1行だけ).
+同期/async どちらのモードでも async def で動かし, ルームの読み出しだけ model 側に任せる.
+"""
+
+import asyncio
+from typing import Optional, Tuple
+
+from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
+from starlette.websockets import WebSocketState
+
+from . import config, fastjson, model
+from .caller import get_caller, resolve_caller
+from .model import Caller, InvalidToken
+from .notify import room_notifier
+from .profiling import ProfiledRoute
+from .ResReqModel import (
+    RoomUser,
+    RoomWaitDelta,
+    RoomWaitPollRequest,
+    RoomWaitPollResponse,
+    WaitRoomStatus,
+)
+
+if config.ASYNC_MODE:
+    from . import async_model
+
+router = APIRouter(route_class=ProfiledRoute)
+
+Snapshot = Tuple[WaitRoomStatus, list[RoomUser]]
+
+
+# どの version とも一致しないので, 必ずメンバーまで読む
+_ANY_VERSION = -1
+
+
+async def _wait_since(
+    room_id: int, caller: Caller, known_version: int
+) -> Tuple[int, WaitRoomStatus, Optional[list[RoomUser]]]:
+    if config.ASYNC_MODE:
+        return await async_model.wait_room_since(room_id, caller, known_version)
+    return await run_in_threadpool(
+        model.wait_room_since, room_id, caller, known_version
+    )
+
+
+async def _wait_snapshot(room_id: int, caller: Caller) -> Tuple[int, Snapshot]:
+    version, room_status, room_user_list = await _wait_since(
+        room_id, caller, _ANY_VERSION
+    )
+    return version, (room_status, room_user_list)
+
+
+async def _next_snapshot(
+    room_id: int, caller: Caller, version: int
+) -> Tuple[int, Snapshot]:
+    """room.version が version から進むまで待って, 新しい version とルームを返す"""
+    while True:
+        # version を読む前に取るので, 読んでいる間の通知で待ちっぱなしにならない
+        hint = room_notifier.version(room_id)
+        new_version, room_status, room_user_list = await _wait_since(
+            room_id, caller, version
+        )
+        if room_user_list is not None:
+            return new_version, (room_status, room_user_list)
+        await room_notifier.wait(room_id, hint, config.LONG_POLL_RECHECK_INTERVAL)
+
+
+@router.post("/room/wait/longpoll", response_model=RoomWaitPollResponse)
+async def room_wait_longpoll(
+    req: RoomWaitPollRequest, caller: Caller = Depends(get_caller)
+):
+    """version から変化があるまで (最大 timeout 秒) 待ってから /room/wait と同じ内容を返す"""
+    if req.version is not None:
+        timeout = min(max(req.timeout, 0.0), config.LONG_POLL_MAX_TIMEOUT)
+        try:
+            version, snapshot = await asyncio.wait_for(
+                _next_snapshot(req.room_id, caller, req.version), timeout
+            )
+        except asyncio.TimeoutError:
+            version, snapshot = await _wait_snapshot(req.room_id, caller)
+    else:
+        version, snapshot = await _wait_snapshot(req.room_id, caller)
+    room_status, room_user_list = snapshot
+    return fastjson.room_wait_poll_response(version, room_status, room_user_list)
+
+
+def _diff(version: int, old: Snapshot, new: Snapshot) -> RoomWaitDelta:
+    old_users = {user.user_id: user for user in old[1]}
+    new_ids = {user.user_id for user in new[1]}
+    return RoomWaitDelta(
+        version=version,
+        status=new[0],
+        updated_user_list=[
+            user for user in new[1] if old_users.get(user.user_id) != user
+        ],
+        left_user_id_list=[user_id for user_id in old_users if user_id not in new_ids],
+    )
+
+
+def _header_token(websocket: WebSocket) -> Optional[str]:
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        return credentials
+    return None
+
+
+async def _first_message_token(websocket: WebSocket) -> Optional[str]:
+    """accept 後の最初のメッセージ {"token": "<user_token>"} から読む
+
+    ブラウザの WebSocket はヘッダを付けられないため. token は URL に載せない
+    (アクセスログやプロキシに残る) ので query では受け付けない.
+    """
+    try:
+        message = await asyncio.wait_for(
+            websocket.receive_json(), config.WS_AUTH_TIMEOUT
+        )
+    except (asyncio.TimeoutError, ValueError, WebSocketDisconnect):
+        return None
+    token = message.get("token") if isinstance(message, dict) else None
+    return token if isinstance(token, str) and token else None
+
+
+async def _ws_caller(token: Optional[str]) -> Optional[Caller]:
+    try:
+        return None if token is None else await resolve_caller(token)
+    except InvalidToken:
+        return None
+
+
+@router.websocket("/room/wait/ws")
+async def room_wait_ws(websocket: WebSocket, room_id: int):
+    """メンバーの入退室・ライブ開始のたびに RoomWaitDelta を push する"""
+    token = _header_token(websocket)
+    if token is None:
+        await websocket.accept()
+        token = await _first_message_token(websocket)
+    # 接続の間は同じ Caller で読み直す
+    caller = await _ws_caller(token)
+    if caller is None:
+        # token を送る前に切られていたら閉じるものがない
+        if websocket.client_state != WebSocketState.DISCONNECTED:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if websocket.client_state == WebSocketState.CONNECTING:
+        await websocket.accept()
+
+    snapshot: Snapshot = (WaitRoomStatus.Waiting, [])
+    version, new_snapshot = await _wait_snapshot(room_id, caller)
+    # クライアントからは何も来ない想定. receive は切断検知のためだけに待つ
+    receiver = asyncio.ensure_future(websocket.receive())
+    waiter = None
+    try:
+        while True:
+            await websocket.send_text(_diff(version, snapshot, new_snapshot).json())
+            snapshot = new_snapshot
+            if snapshot[0] != WaitRoomStatus.Waiting:
+                break
+            waiter = asyncio.ensure_future(_next_snapshot(room_id, caller, version))
+            while not waiter.done():
+                done, _ = await asyncio.wait(
+                    {receiver, waiter}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if receiver in done:
+                    if receiver.result()["type"] == "websocket.disconnect":
+                        return
+                    receiver = asyncio.ensure_future(websocket.receive())
+            version, new_snapshot = waiter.result()
+    finally:
+        receiver.cancel()
+        if waiter is not None:
+            waiter.cancel()
+    await websocket.close()
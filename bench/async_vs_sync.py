@@ -0,0 +1,115 @@
+"""sync モードと async モード (config.ASYNC_MODE) の /room/wait, /room/join を比較する
+
+    python -m bench.async_vs_sync --requests 5000 --concurrency 200
+
+schema.sql を流した MySQL が必要. モードごとに uvicorn を立ち上げて同じ負荷をかけ,
+エンドポイントごとの requests/sec と p99 を表にして出す.
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from .util import summarize, uvicorn_server
+
+MODES = {
+    "sync": {"GAMESERVER_ASYNC_MODE": "0"},
+    "async": {"GAMESERVER_ASYNC_MODE": "1"},
+}
+
+
+def _auth(token: str) -> dict[str, str]:
+    return {"Authorization": f"bearer {token}"}
+
+
+async def _setup(client: httpx.AsyncClient, users: int, rooms: int):
+    tokens = []
+    for i in range(users):
+        res = await client.post(
+            "/user/create", json={"user_name": f"bench_{i}", "leader_card_id": 1000}
+        )
+        tokens.append(res.json()["user_token"])
+    room_ids = []
+    for i in range(rooms):
+        res = await client.post(
+            "/room/create",
+            headers=_auth(tokens[i]),
+            json={"live_id": 1001, "select_difficulty": 1},
+        )
+        room_ids.append(res.json()["room_id"])
+    return tokens, room_ids
+
+
+async def _run(client, path, make_body, tokens, total, concurrency):
+    latencies: list[float] = []
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            token = tokens[i % len(tokens)]
+            started = time.perf_counter()
+            res = await client.post(path, headers=_auth(token), json=make_body(i))
+            latencies.append(time.perf_counter() - started)
+            res.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+async def _bench(base_url: str, args) -> dict[str, dict]:
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=60
+    ) as client:
+        tokens, room_ids = await _setup(client, args.users, args.rooms)
+
+        def room_of(i):
+            return room_ids[i % len(room_ids)]
+
+        join = await _run(
+            client,
+            "/room/join",
+            lambda i: {"room_id": room_of(i), "select_difficulty": 2},
+            tokens,
+            args.requests,
+            args.concurrency,
+        )
+        wait = await _run(
+            client,
+            "/room/wait",
+            lambda i: {"room_id": room_of(i)},
+            tokens,
+            args.requests,
+            args.concurrency,
+        )
+    return {"/room/join": join, "/room/wait": wait}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    results = {}
+    for mode, env in MODES.items():
+        with uvicorn_server(args.port, env) as base_url:
+            results[mode] = asyncio.run(_bench(base_url, args))
+
+    print(f"{'endpoint':<12} {'mode':<6} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for path in ("/room/join", "/room/wait"):
+        for mode in MODES:
+            r = results[mode][path]
+            print(
+                f"{path:<12} {mode:<6} {r['rps']:>10.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
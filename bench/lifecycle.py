@@ -0,0 +1,287 @@
+"""ルームのライフサイクルを再現する負荷試験
+
+    python -m bench.lifecycle --players 2000                  # in-process (ASGI直結)
+    python -m bench.lifecycle --spawn --players 2000          # uvicorn を起動して叩く
+    python -m bench.lifecycle --url http://127.0.0.1:8000     # 起動済みのサーバーを叩く
+
+仮想プレイヤーは MAX_USER_COUNT 人ずつのグループで
+user/create → room/create (ホスト) or room/list → room/join (ゲスト) → room/wait (ポーリング)
+→ room/start (ホスト) → room/end → room/result (ポーリング) → room/leave を実行する.
+
+エンドポイントごとの p50/p95/p99, requests/sec, 1リクエストあたりのSQL文数 (/metrics から取る) を出し,
+--save-baseline で保存した結果と比べて --threshold 以上悪化していたら終了コード 1 を返す.
+baseline はマシン依存なのでリポジトリには入れず, 各自のマシンで作る.
+(--workers 2 以上だと /metrics は1 worker分しか見えないので sql/req は参考値になる)
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+from typing import Optional
+
+import httpx
+
+from app.config import MAX_USER_COUNT
+
+from .util import summarize, uvicorn_server
+
+DEFAULT_BASELINE = "bench/baseline.json"
+
+_SQL_METRIC = re.compile(
+    r'^gameserver_request_sql_statements_(sum|count)\{endpoint="([^"]+)"\} (\S+)$'
+)
+
+
+class Recorder:
+    """エンドポイントごとのレイテンシを記録する"""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+
+    async def post(self, client: httpx.AsyncClient, path: str, json=None, token=None):
+        headers = {"Authorization": f"bearer {token}"} if token else None
+        started = time.perf_counter()
+        response = await client.post(path, json=json, headers=headers)
+        self.latencies[path].append(time.perf_counter() - started)
+        if response.status_code != 200:
+            self.errors[path] += 1
+            return None
+        return response.json()
+
+
+async def _poll_wait(rec, client, token, room_id, args, until):
+    deadline = time.monotonic() + args.phase_timeout
+    while time.monotonic() < deadline:
+        body = await rec.post(client, "/room/wait", {"room_id": room_id}, token)
+        if body is not None and until(body):
+            return body
+        await asyncio.sleep(args.poll_interval)
+    return None
+
+
+async def _play(rec, client, token, room_id, args):
+    """ライブ〜リザルト〜退出 (ホスト/ゲスト共通)"""
+    await asyncio.sleep(args.play_time)
+    await rec.post(
+        client,
+        "/room/end",
+        {
+            "room_id": room_id,
+            "score": random.randint(0, 1_000_000),
+            "judge_count_list": [random.randint(0, 500) for _ in range(5)],
+        },
+        token,
+    )
+    deadline = time.monotonic() + args.phase_timeout
+    while time.monotonic() < deadline:
+        body = await rec.post(client, "/room/result", {"room_id": room_id})
+        if body is not None and body["result_user_list"]:
+            break
+        await asyncio.sleep(args.poll_interval)
+    await rec.post(client, "/room/leave", {"room_id": room_id}, token)
+
+
+async def _create_user(rec, client, name) -> str:
+    body = await rec.post(
+        client, "/user/create", {"user_name": name, "leader_card_id": 1000}
+    )
+    return body["user_token"]
+
+
+async def _host(rec, client, group: int, room_ready: asyncio.Future, args):
+    token = await _create_user(rec, client, f"bench_host_{group}")
+    live_id = args.live_id_base + group % args.lives
+    body = await rec.post(
+        client,
+        "/room/create",
+        {"live_id": live_id, "select_difficulty": 1},
+        token,
+    )
+    room_id = body["room_id"]
+    room_ready.set_result((room_id, live_id))
+    # 全員揃うか時間切れで開始する
+    await _poll_wait(
+        rec,
+        client,
+        token,
+        room_id,
+        args,
+        lambda b: len(b["room_user_list"]) >= args.group_size,
+    )
+    await rec.post(client, "/room/start", {"room_id": room_id}, token)
+    await _play(rec, client, token, room_id, args)
+
+
+async def _guest(rec, client, group: int, index: int, room_ready: asyncio.Future, args):
+    token = await _create_user(rec, client, f"bench_guest_{group}_{index}")
+    room_id, live_id = await room_ready
+    # 実際のクライアントと同じく一覧を引いてから入る
+    await rec.post(client, "/room/list", {"live_id": live_id})
+    body = await rec.post(
+        client, "/room/join", {"room_id": room_id, "select_difficulty": 2}, token
+    )
+    if body is None or body["join_room_result"] != 1:
+        return
+    started = await _poll_wait(
+        rec, client, token, room_id, args, lambda b: b["status"] != 1
+    )
+    if started is None or started["status"] != 2:
+        return
+    await _play(rec, client, token, room_id, args)
+
+
+async def _sql_counters(client: httpx.AsyncClient) -> dict[str, list[float]]:
+    response = await client.get("/metrics")
+    counters: dict[str, list[float]] = defaultdict(lambda: [0.0, 0.0])
+    for line in response.text.splitlines():
+        m = _SQL_METRIC.match(line)
+        if m:
+            kind, endpoint, value = m.groups()
+            counters[endpoint][0 if kind == "sum" else 1] = float(value)
+    return counters
+
+
+async def _run(client: httpx.AsyncClient, args) -> dict:
+    rec = Recorder()
+    before = await _sql_counters(client)
+    groups = args.players // args.group_size
+    tasks = []
+    for group in range(groups):
+        room_ready = asyncio.get_running_loop().create_future()
+        tasks.append(_host(rec, client, group, room_ready, args))
+        for index in range(args.group_size - 1):
+            tasks.append(_guest(rec, client, group, index, room_ready, args))
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    after = await _sql_counters(client)
+
+    report = {}
+    for path, latencies in sorted(rec.latencies.items()):
+        stats = summarize(latencies, elapsed)
+        sql_sum = after[path][0] - before[path][0]
+        sql_count = after[path][1] - before[path][1]
+        stats["sql_per_request"] = sql_sum / sql_count if sql_count else 0.0
+        stats["errors"] = rec.errors[path]
+        report[path] = stats
+    total = [v for latencies in rec.latencies.values() for v in latencies]
+    report["total"] = summarize(total, elapsed)
+    return report
+
+
+async def _run_in_process(args) -> dict:
+    from app.api import app
+
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=args.phase_timeout
+        ) as client:
+            return await _run(client, args)
+    finally:
+        await app.router.shutdown()
+
+
+async def _run_remote(base_url: str, args) -> dict:
+    limits = httpx.Limits(max_connections=args.connections)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=args.phase_timeout
+    ) as client:
+        return await _run(client, args)
+
+
+def _print_report(report: dict) -> None:
+    print(
+        f"{'endpoint':<16} {'requests':>9} {'req/s':>9} {'p50 ms':>8} "
+        f"{'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8} {'errors':>7}"
+    )
+    for path, r in report.items():
+        print(
+            f"{path:<16} {r['requests']:>9} {r['rps']:>9.1f} {r['p50_ms']:>8.1f} "
+            f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+            f"{r.get('sql_per_request', 0):>8.2f} {r.get('errors', 0):>7}"
+        )
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """baseline より threshold (割合) 以上悪化した項目を返す. SQL文数は少しでも増えたら悪化"""
+    regressions = []
+    for path, base in baseline.items():
+        current = report.get(path)
+        if current is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append(
+                f"{path}: p95 {base['p95_ms']:.1f}ms -> {current['p95_ms']:.1f}ms"
+            )
+        if current["rps"] < base["rps"] * (1 - threshold):
+            regressions.append(
+                f"{path}: req/s {base['rps']:.1f} -> {current['rps']:.1f}"
+            )
+        base_sql = base.get("sql_per_request")
+        if base_sql is not None and current["sql_per_request"] > base_sql + 0.01:
+            regressions.append(
+                f"{path}: sql/req {base_sql:.2f} -> {current['sql_per_request']:.2f}"
+            )
+    return regressions
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--group-size", type=int, default=MAX_USER_COUNT)
+    parser.add_argument("--lives", type=int, default=10, help="live_id の種類数")
+    parser.add_argument("--live-id-base", type=int, default=9000)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--play-time", type=float, default=1.0)
+    parser.add_argument("--phase-timeout", type=float, default=60.0)
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--url", help="起動済みサーバーのURL")
+    parser.add_argument("--spawn", action="store_true", help="uvicorn を起動して叩く")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--json", help="結果をJSONで書き出すパス")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        report = asyncio.run(_run_remote(args.url, args))
+    elif args.spawn:
+        with uvicorn_server(args.port, {}, workers=args.workers) as base_url:
+            report = asyncio.run(_run_remote(base_url, args))
+    else:
+        report = asyncio.run(_run_in_process(args))
+
+    _print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"no baseline at {args.baseline} (run with --save-baseline)")
+        return 0
+    regressions = compare(report, baseline, args.threshold)
+    for line in regressions:
+        print("REGRESSION", line)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
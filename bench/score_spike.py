@@ -0,0 +1,201 @@
+"""ライブ終了時の /room/end の集中を再現し, スコアのまとめ書き (config.SCORE_BATCH) の有無を比べる
+
+    python -m bench.score_spike --rooms 2000 --concurrency 1000
+    python -m bench.score_spike --direct --rooms 2000 --concurrency 200
+
+schema.sql を流した MySQL が必要 (GAMESERVER_DATABASE_URI). モードごとに uvicorn を立ち上げ,
+--rooms 個のルームに MAX_USER_COUNT 人ずつ入れてライブを開始した後, 全員の /room/end を一斉に投げる.
+/room/end の requests/sec, p50/p99 と, まとめ書きの場合は1トランザクションあたりの件数を出す.
+
+--direct は HTTP を通さず, --concurrency 本のスレッドから storage.end_room と ScoreWriter を
+直接呼んで書き込みの部分だけを比べる (負荷をかける側とサーバーが同じ CPU を取り合う小さいマシン用).
+"""
+
+import argparse
+import asyncio
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from app.config import MAX_USER_COUNT
+
+from .util import summarize, uvicorn_server
+
+MODES = {
+    "single": {"GAMESERVER_SCORE_BATCH": "0"},
+    "batched": {"GAMESERVER_SCORE_BATCH": "1"},
+}
+
+_WRITER_METRIC = re.compile(r"^gameserver_score_writer_(batches|scores) (\S+)$")
+
+
+def _auth(token: str) -> dict[str, str]:
+    return {"Authorization": f"bearer {token}"}
+
+
+async def _gather_limited(concurrency: int, coroutines):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(limited(c) for c in coroutines))
+
+
+async def _setup_room(client: httpx.AsyncClient, r: int, live_id: int):
+    tokens = []
+    for i in range(MAX_USER_COUNT):
+        res = await client.post(
+            "/user/create",
+            json={"user_name": f"spike_{r}_{i}", "leader_card_id": 1000},
+        )
+        tokens.append(res.json()["user_token"])
+    res = await client.post(
+        "/room/create",
+        headers=_auth(tokens[0]),
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    room_id = res.json()["room_id"]
+    for token in tokens[1:]:
+        await client.post(
+            "/room/join",
+            headers=_auth(token),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+    await client.post(
+        "/room/start", headers=_auth(tokens[0]), json={"room_id": room_id}
+    )
+    return [(room_id, token) for token in tokens]
+
+
+async def _writer_stats(client: httpx.AsyncClient) -> dict[str, float]:
+    res = await client.get("/metrics")
+    stats = {}
+    for line in res.text.splitlines():
+        m = _WRITER_METRIC.match(line)
+        if m:
+            stats[m.group(1)] = float(m.group(2))
+    return stats
+
+
+async def _bench(base_url: str, args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=120
+    ) as client:
+        live_id = int(time.time()) % 1_000_000
+        rooms = await _gather_limited(
+            args.concurrency,
+            (_setup_room(client, r, live_id) for r in range(args.rooms)),
+        )
+        players = [player for room in rooms for player in room]
+        latencies: list[float] = []
+
+        async def end(room_id: int, token: str):
+            started = time.perf_counter()
+            res = await client.post(
+                "/room/end",
+                headers=_auth(token),
+                json={"room_id": room_id, "score": 1000, "judge_count_list": [1] * 5},
+            )
+            latencies.append(time.perf_counter() - started)
+            res.raise_for_status()
+
+        before = await _writer_stats(client)
+        started = time.perf_counter()
+        await _gather_limited(
+            args.concurrency, (end(room_id, token) for room_id, token in players)
+        )
+        result = summarize(latencies, time.perf_counter() - started)
+        after = await _writer_stats(client)
+    batches = after.get("batches", 0) - before.get("batches", 0)
+    scores = after.get("scores", 0) - before.get("scores", 0)
+    result["scores_per_batch"] = scores / batches if batches else 1.0
+    return result
+
+
+def _bench_direct(args) -> dict[str, dict]:
+    from app import model
+    from app.ResReqModel import LiveDifficulty
+    from app.score_writer import ScoreWriter
+
+    live_id = int(time.time()) % 1_000_000
+    players = []
+    for r in range(args.rooms):
+        users = []
+        for i in range(MAX_USER_COUNT):
+            _, user = model.storage.create_user(f"spike_{r}_{i}", 1000)
+            users.append(user)
+        room_id = model.storage.create_room(users[0].id, live_id, LiveDifficulty.Normal)
+        for user in users[1:]:
+            model.storage.join_room(room_id, user.id, LiveDifficulty.Normal)
+        players += [(room_id, user.id) for user in users]
+
+    writer = ScoreWriter()
+    calls = {
+        "single": lambda room_id, user_id: model.storage.end_room(
+            room_id, user_id, 1000, [1] * 5
+        ),
+        "batched": lambda room_id, user_id: writer.submit(
+            room_id, user_id, 1000, [1] * 5
+        ).result(),
+    }
+    results = {}
+    writer.start()
+    try:
+        for mode, call in calls.items():
+            latencies: list[float] = []
+
+            def end(player):
+                started = time.perf_counter()
+                call(*player)
+                latencies.append(time.perf_counter() - started)
+
+            before = writer.stats()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(end, players))
+            results[mode] = summarize(latencies, time.perf_counter() - started)
+            after = writer.stats()
+            batches = after["batches"] - before["batches"]
+            scores = after["scores"] - before["scores"]
+            results[mode]["scores_per_batch"] = scores / batches if batches else 1.0
+    finally:
+        writer.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--direct", action="store_true")
+    args = parser.parse_args()
+
+    if args.direct:
+        results = _bench_direct(args)
+    else:
+        results = {}
+        for mode, env in MODES.items():
+            with uvicorn_server(args.port, env, workers=args.workers) as base_url:
+                results[mode] = asyncio.run(_bench(base_url, args))
+
+    print(f"{'mode':<8} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'scores/tx':>10}")
+    for mode in MODES:
+        r = results[mode]
+        print(
+            f"{mode:<8} {r['rps']:>10.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f}"
+            f" {r['scores_per_batch']:>10.1f}"
+        )
+    single, batched = results["single"]["rps"], results["batched"]["rps"]
+    if single > 0:
+        print(f"batched / single: {batched / single:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
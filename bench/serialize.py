@@ -0,0 +1,128 @@
+"""レスポンスのシリアライズ1回あたりの時間を比べる (DB/HTTP なし)
+
+    python -m bench.serialize --iterations 20000
+
+- default: FastAPI 標準の経路 (response_model で検証し直し → jsonable_encoder → json.dumps)
+- fast: app/fastjson.py (属性から dict → orjson)
+
+4人のルームの /room/wait と, 100件の /room/list を対象にする.
+両者の出力がバイト列で一致することも確かめる.
+"""
+
+import argparse
+import asyncio
+import time
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app import config, fastjson
+from app.config import MAX_USER_COUNT
+from app.ResReqModel import (
+    LiveDifficulty,
+    RoomInfo,
+    RoomListResponse,
+    RoomUser,
+    RoomWaitResponse,
+    WaitRoomStatus,
+)
+
+
+def _room_users() -> list[RoomUser]:
+    return [
+        RoomUser(
+            user_id=i,
+            name=f"bench_user_{i}",
+            leader_card_id=1000 + i,
+            select_difficulty=LiveDifficulty.Hard,
+            is_me=i == 1,
+            is_host=i == 0,
+        )
+        for i in range(MAX_USER_COUNT)
+    ]
+
+
+def _room_infos() -> list[RoomInfo]:
+    return [
+        RoomInfo(
+            room_id=i,
+            live_id=1001,
+            joined_user_count=i % MAX_USER_COUNT,
+            max_user_count=MAX_USER_COUNT,
+        )
+        for i in range(1, 101)
+    ]
+
+
+async def _default_body(field, content) -> bytes:
+    """FastAPI がハンドラの戻り値に対してやることと同じ
+
+    /room/wait, /room/list はどちらも response_model_exclude_unset=True
+    """
+    encoded = await serialize_response(
+        field=field, response_content=content, exclude_unset=True
+    )
+    return JSONResponse(encoded).body
+
+
+CASES = {
+    "wait (4 members)": (
+        RoomWaitResponse,
+        lambda users: RoomWaitResponse(
+            status=WaitRoomStatus.Waiting, room_user_list=users
+        ),
+        lambda users: fastjson.room_wait_response(WaitRoomStatus.Waiting, users).body,
+        _room_users,
+    ),
+    "list (100 rooms)": (
+        RoomListResponse,
+        lambda rooms: RoomListResponse(room_info_list=rooms, next_cursor=100),
+        lambda rooms: fastjson.room_list_response(rooms, 100).body,
+        _room_infos,
+    ),
+}
+
+
+async def check() -> None:
+    """どのケースも両者の出力が一致することを確かめる (tests からも呼ぶ)"""
+    for name, (response_model, build, fast, make) in CASES.items():
+        field = create_response_field(name="Response", type_=response_model)
+        data = make()
+        assert await _default_body(field, build(data)) == fast(data), name
+
+
+async def _measure(iterations: int) -> None:
+    await check()
+    print(f"{'case':<18} {'default us':>11} {'fast us':>9} {'speedup':>8}")
+    for name, (response_model, build, fast, make) in CASES.items():
+        field = create_response_field(name="Response", type_=response_model)
+        data = make()
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await _default_body(field, build(data))
+        default = (time.perf_counter() - started) / iterations
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fast(data)
+        fast_time = (time.perf_counter() - started) / iterations
+
+        print(
+            f"{name:<18} {default * 1e6:>11.1f} {fast_time * 1e6:>9.1f} "
+            f"{default / fast_time:>7.1f}x"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    # GAMESERVER_FAST_JSON=0 でも fast の経路を測る
+    config.FAST_JSON = True
+    asyncio.run(_measure(args.iterations))
+
+
+if __name__ == "__main__":
+    main()
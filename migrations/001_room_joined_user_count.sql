@@ -0,0 +1,12 @@
+-- room.joined_user_count (非正規化したメンバー数) と /room/list 用のインデックスを追加する
+-- member(room_id) は PRIMARY KEY (room_id, member_id) の先頭なので追加のインデックスは不要
+
+ALTER TABLE `room`
+  ADD COLUMN `joined_user_count` int NOT NULL DEFAULT 0,
+  ADD KEY `status_live_id` (`status`, `live_id`, `room_id`),
+  ADD KEY `status_room_id` (`status`, `room_id`);
+
+UPDATE `room`
+SET `joined_user_count` = (
+  SELECT COUNT(*) FROM `member` WHERE `member`.`room_id` = `room`.`room_id`
+);
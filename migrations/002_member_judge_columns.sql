@@ -0,0 +1,20 @@
+-- member.judge_count ("4, 3, 2, 4, 1" のような文字列) を判定ごとの int カラムに分ける
+-- 順番は perfect, great, good, bad, miss
+
+ALTER TABLE `member`
+  ADD COLUMN `judge_perfect` int DEFAULT NULL,
+  ADD COLUMN `judge_great` int DEFAULT NULL,
+  ADD COLUMN `judge_good` int DEFAULT NULL,
+  ADD COLUMN `judge_bad` int DEFAULT NULL,
+  ADD COLUMN `judge_miss` int DEFAULT NULL;
+
+UPDATE `member`
+SET
+  `judge_perfect` = CAST(SUBSTRING_INDEX(`judge_count`, ',', 1) AS SIGNED),
+  `judge_great` = CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(`judge_count`, ',', 2), ',', -1) AS SIGNED),
+  `judge_good` = CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(`judge_count`, ',', 3), ',', -1) AS SIGNED),
+  `judge_bad` = CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(`judge_count`, ',', 4), ',', -1) AS SIGNED),
+  `judge_miss` = CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(`judge_count`, ',', 5), ',', -1) AS SIGNED)
+WHERE `judge_count` IS NOT NULL;
+
+ALTER TABLE `member` DROP COLUMN `judge_count`;
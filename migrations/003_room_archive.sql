@@ -0,0 +1,32 @@
+-- ルームの最終更新時刻 (UNIX秒) と, reaper (app/reaper.py) が片付けたルームの移動先
+-- 既存のルームは適用時点を最終更新とする (すぐには片付けられず, 放置タイムアウト後に移る)
+
+ALTER TABLE `room`
+  ADD COLUMN `updated_at` bigint NOT NULL DEFAULT 0,
+  ADD KEY `status_updated_at` (`status`, `updated_at`);
+
+UPDATE `room` SET `updated_at` = UNIX_TIMESTAMP();
+
+CREATE TABLE `room_archive` (
+  `room_id` bigint NOT NULL,
+  `live_id` int DEFAULT NULL,
+  `status` int DEFAULT NULL,
+  `owner` bigint DEFAULT NULL,
+  `joined_user_count` int NOT NULL DEFAULT 0,
+  `updated_at` bigint NOT NULL DEFAULT 0,
+  `archived_at` bigint NOT NULL,
+  PRIMARY KEY (`room_id`)
+);
+
+CREATE TABLE `member_archive` (
+  `room_id` bigint NOT NULL,
+  `member_id` bigint NOT NULL,
+  `difficulty` int DEFAULT NULL,
+  `score` int DEFAULT NULL,
+  `judge_perfect` int DEFAULT NULL,
+  `judge_great` int DEFAULT NULL,
+  `judge_good` int DEFAULT NULL,
+  `judge_bad` int DEFAULT NULL,
+  `judge_miss` int DEFAULT NULL,
+  PRIMARY KEY (`room_id`, `member_id`)
+);
@@ -0,0 +1,4 @@
+-- /room/wait の version (ルームのメンバー/オーナー/状態が変わるたびに +1 する)
+
+ALTER TABLE `room`
+  ADD COLUMN `version` bigint NOT NULL DEFAULT 1;
@@ -0,0 +1,10 @@
+-- スコアを記録した時刻 (UNIX秒). /live/stats (app/analytics.py) がこの時刻より後の結果だけを読み足す
+-- 既存の結果は 0 のまま (最初の集計で全部読む)
+
+ALTER TABLE `member`
+  ADD COLUMN `scored_at` bigint NOT NULL DEFAULT 0,
+  ADD KEY `scored_at` (`scored_at`);
+
+ALTER TABLE `member_archive`
+  ADD COLUMN `scored_at` bigint NOT NULL DEFAULT 0,
+  ADD KEY `scored_at` (`scored_at`);
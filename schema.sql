@@ -14,7 +14,13 @@ CREATE TABLE `room` (
   `live_id` int DEFAULT NULL,
   `status` int DEFAULT NULL,
   `owner` bigint DEFAULT NULL,
-  PRIMARY KEY (`room_id`)
+  `joined_user_count` int NOT NULL DEFAULT 0,
+  `updated_at` bigint NOT NULL DEFAULT 0,
+  `version` bigint NOT NULL DEFAULT 1,
+  PRIMARY KEY (`room_id`),
+  KEY `status_live_id` (`status`, `live_id`, `room_id`),
+  KEY `status_room_id` (`status`, `room_id`),
+  KEY `status_updated_at` (`status`, `updated_at`)
 );
 
 DROP TABLE IF EXISTS `member`;
@@ -22,8 +28,50 @@ CREATE TABLE `member` (
   `room_id` bigint NOT NULL,
   `member_id` bigint NOT NULL,
   `difficulty` int DEFAULT NULL,
-  `judge_count` varchar(255) DEFAULT NULL,
   `score` int DEFAULT NULL,
-  PRIMARY KEY (`room_id`, `member_id`)
+  `judge_perfect` int DEFAULT NULL,
+  `judge_great` int DEFAULT NULL,
+  `judge_good` int DEFAULT NULL,
+  `judge_bad` int DEFAULT NULL,
+  `judge_miss` int DEFAULT NULL,
+  `scored_at` bigint NOT NULL DEFAULT 0,
+  `left_at` bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (`room_id`, `member_id`),
+  KEY `scored_at` (`scored_at`)
+);
+
+DROP TABLE IF EXISTS `live_room_version`;
+CREATE TABLE `live_room_version` (
+  `live_id` int NOT NULL,
+  `version` bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (`live_id`)
+);
 
+DROP TABLE IF EXISTS `room_archive`;
+CREATE TABLE `room_archive` (
+  `room_id` bigint NOT NULL,
+  `live_id` int DEFAULT NULL,
+  `status` int DEFAULT NULL,
+  `owner` bigint DEFAULT NULL,
+  `joined_user_count` int NOT NULL DEFAULT 0,
+  `updated_at` bigint NOT NULL DEFAULT 0,
+  `archived_at` bigint NOT NULL,
+  PRIMARY KEY (`room_id`)
+);
+
+DROP TABLE IF EXISTS `member_archive`;
+CREATE TABLE `member_archive` (
+  `room_id` bigint NOT NULL,
+  `member_id` bigint NOT NULL,
+  `difficulty` int DEFAULT NULL,
+  `score` int DEFAULT NULL,
+  `judge_perfect` int DEFAULT NULL,
+  `judge_great` int DEFAULT NULL,
+  `judge_good` int DEFAULT NULL,
+  `judge_bad` int DEFAULT NULL,
+  `judge_miss` int DEFAULT NULL,
+  `scored_at` bigint NOT NULL DEFAULT 0,
+  `left_at` bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (`room_id`, `member_id`),
+  KEY `scored_at` (`scored_at`)
 );
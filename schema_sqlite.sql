@@ -0,0 +1,67 @@
+-- schema.sql の SQLite 版 (GAMESERVER_STORAGE=sqlite の時に起動時に流す)
+CREATE TABLE IF NOT EXISTS `user` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `name` varchar(255) DEFAULT NULL,
+  `token` varchar(255) DEFAULT NULL UNIQUE,
+  `leader_card_id` int DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS `room` (
+  `room_id` integer PRIMARY KEY AUTOINCREMENT,
+  `live_id` int DEFAULT NULL,
+  `status` int DEFAULT NULL,
+  `owner` bigint DEFAULT NULL,
+  `joined_user_count` int NOT NULL DEFAULT 0,
+  `updated_at` bigint NOT NULL DEFAULT 0,
+  `version` bigint NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS `status_live_id` ON `room` (`status`, `live_id`, `room_id`);
+CREATE INDEX IF NOT EXISTS `status_room_id` ON `room` (`status`, `room_id`);
+CREATE INDEX IF NOT EXISTS `status_updated_at` ON `room` (`status`, `updated_at`);
+
+CREATE TABLE IF NOT EXISTS `member` (
+  `room_id` bigint NOT NULL,
+  `member_id` bigint NOT NULL,
+  `difficulty` int DEFAULT NULL,
+  `score` int DEFAULT NULL,
+  `judge_perfect` int DEFAULT NULL,
+  `judge_great` int DEFAULT NULL,
+  `judge_good` int DEFAULT NULL,
+  `judge_bad` int DEFAULT NULL,
+  `judge_miss` int DEFAULT NULL,
+  `scored_at` bigint NOT NULL DEFAULT 0,
+  `left_at` bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (`room_id`, `member_id`)
+);
+
+CREATE TABLE IF NOT EXISTS `live_room_version` (
+  `live_id` int NOT NULL PRIMARY KEY,
+  `version` bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS `room_archive` (
+  `room_id` bigint NOT NULL PRIMARY KEY,
+  `live_id` int DEFAULT NULL,
+  `status` int DEFAULT NULL,
+  `owner` bigint DEFAULT NULL,
+  `joined_user_count` int NOT NULL DEFAULT 0,
+  `updated_at` bigint NOT NULL DEFAULT 0,
+  `archived_at` bigint NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS `member_archive` (
+  `room_id` bigint NOT NULL,
+  `member_id` bigint NOT NULL,
+  `difficulty` int DEFAULT NULL,
+  `score` int DEFAULT NULL,
+  `judge_perfect` int DEFAULT NULL,
+  `judge_great` int DEFAULT NULL,
+  `judge_good` int DEFAULT NULL,
+  `judge_bad` int DEFAULT NULL,
+  `judge_miss` int DEFAULT NULL,
+  `scored_at` bigint NOT NULL DEFAULT 0,
+  `left_at` bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (`room_id`, `member_id`)
+);
+CREATE INDEX IF NOT EXISTS `member_scored_at` ON `member` (`scored_at`);
+CREATE INDEX IF NOT EXISTS `member_archive_scored_at` ON `member_archive` (`scored_at`);
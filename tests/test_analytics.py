@@ -0,0 +1,155 @@
+import itertools
+import time
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config, model
+from app.analytics import LiveStatsAggregator
+from app.api import app
+from app.registry import room_registry
+from app.ResReqModel import LiveDifficulty
+
+client = TestClient(app)
+
+
+def _row(live_id, difficulty, score, judges, member_id=None, scored_at=0):
+    # member_id を省略すると別々の結果
+    if member_id is None:
+        member_id = next(_member_ids)
+    return (1, member_id, live_id, difficulty, score, *judges, scored_at)
+
+
+_member_ids = itertools.count(1000)
+
+
+def test_aggregates_chunks_and_incremental_rows():
+    stats = LiveStatsAggregator(chunk_size=3)
+    first = [
+        _row(1, 1, 100, [10, 0, 0, 0, 0]),
+        _row(1, 2, 900, [5, 5, 0, 0, 0]),
+        _row(1, 1, 300, [8, 1, 0, 0, 1]),
+        _row(2, 1, 50, [1, 1, 1, 1, 1]),
+        _row(1, 1, 200, [9, 0, 0, 1, 0]),
+    ]
+    assert stats.add(first, scored_before=100) == 5
+    normal = stats.get(1, LiveDifficulty.Normal, clear_score=200)
+    assert normal.play_count == 3
+    assert normal.score_mean == 200.0
+    assert normal.score_percentiles["p50"] == 200.0
+    assert normal.clear_rate == pytest.approx(2 / 3)
+    assert normal.full_combo_rate == pytest.approx(1 / 3)
+    assert normal.judge_distribution == pytest.approx(
+        (np.array([27, 1, 0, 1, 1]) / 30).tolist()
+    )
+
+    # 次の集計では新しい行だけを足す
+    stats.add([_row(1, 1, 400, [10, 0, 0, 0, 0])], scored_before=200)
+    normal = stats.get(1, LiveDifficulty.Normal, clear_score=200)
+    assert normal.play_count == 4
+    assert normal.score_percentiles["p99"] == pytest.approx(
+        np.percentile([100, 200, 300, 400], 99)
+    )
+    assert normal.full_combo_rate == 0.5
+    assert stats.scored_before == 200
+    assert stats.get(3, LiveDifficulty.Hard).play_count == 0
+
+
+def test_resubmitted_result_replaces_the_counted_one(monkeypatch):
+    monkeypatch.setattr(config, "LIVE_STATS_DEDUP_WINDOW", 1000)
+    stats = LiveStatsAggregator()
+    stats.add(
+        [
+            _row(1, 1, 100, [10, 0, 0, 0, 0], member_id=1, scored_at=50),
+            _row(1, 1, 200, [9, 0, 0, 1, 0], member_id=2, scored_at=60),
+        ],
+        scored_before=100,
+    )
+    # 同じメンバーの /room/end が出し直されて, 新しい scored_at でもう一度読まれる
+    stats.add(
+        [_row(1, 1, 300, [8, 1, 0, 0, 1], member_id=2, scored_at=150)],
+        scored_before=200,
+    )
+    normal = stats.get(1, LiveDifficulty.Normal, clear_score=150)
+    assert normal.play_count == 2
+    assert normal.score_mean == 200.0
+    assert normal.clear_rate == 0.5
+    assert normal.full_combo_rate == 0.5
+    assert normal.judge_distribution == pytest.approx(
+        (np.array([18, 1, 0, 0, 1]) / 20).tolist()
+    )
+
+    # 窓より前に記録された結果は覚えておかない (ルームが片付いていて出し直されない)
+    stats.add([], scored_before=1100)
+    assert list(stats._counted) == [(1, 2)]
+
+
+@pytest.mark.skipif(
+    room_registry is not None, reason="room registry writer is not running"
+)
+def test_live_stats_api(monkeypatch):
+    # 直近の結果もすぐ集計に入るようにする
+    monkeypatch.setattr(model, "live_stats", LiveStatsAggregator())
+    monkeypatch.setattr(config, "LIVE_STATS_LAG", -1)
+    live_id = 400000 + int(time.time() * 1000) % 10**8
+    for i, score in enumerate((1000, 3000)):
+        token = client.post(
+            "/user/create", json={"user_name": f"stats_{i}", "leader_card_id": 1}
+        ).json()["user_token"]
+        headers = {"Authorization": f"bearer {token}"}
+        room_id = client.post(
+            "/room/create",
+            headers=headers,
+            json={"live_id": live_id, "select_difficulty": 2},
+        ).json()["room_id"]
+        client.post("/room/start", headers=headers, json={"room_id": room_id})
+        client.post(
+            "/room/end",
+            headers=headers,
+            json={
+                "room_id": room_id,
+                "score": score,
+                "judge_count_list": [3, 1, 0, 0, i],
+            },
+        )
+        # 結果を出した後に抜けても集計に残る
+        client.post("/room/leave", headers=headers, json={"room_id": room_id})
+
+    response = client.post(
+        "/live/stats", json={"live_id": live_id, "clear_score": 2000}
+    )
+    assert response.status_code == 200
+    normal, hard = response.json()["stats"]
+    assert normal["play_count"] == 0
+    assert hard["select_difficulty"] == 2
+    assert hard["play_count"] == 2
+    assert hard["score_mean"] == 2000.0
+    assert hard["clear_rate"] == 0.5
+    assert hard["full_combo_rate"] == 0.5
+    assert hard["judge_distribution"] == pytest.approx([6 / 9, 2 / 9, 0, 0, 1 / 9])
+
+    # 出し直された /room/end は置き換わるだけで2回数えない
+    monkeypatch.setattr(config, "LIVE_STATS_REFRESH_INTERVAL", 0)
+    time.sleep(1.1)
+    client.post(
+        "/room/end",
+        headers=headers,
+        json={"room_id": room_id, "score": 5000, "judge_count_list": [3, 1, 0, 0, 1]},
+    )
+    response = client.post(
+        "/live/stats", json={"live_id": live_id, "clear_score": 2000}
+    )
+    hard = response.json()["stats"][1]
+    assert hard["play_count"] == 2
+    assert hard["score_mean"] == 3000.0
+
+    # 起動時の集計も同じ
+    monkeypatch.setattr(model, "live_stats", LiveStatsAggregator())
+    model.warm_live_stats()
+    response = client.post(
+        "/live/stats", json={"live_id": live_id, "clear_score": 2000}
+    )
+    hard = response.json()["stats"][1]
+    assert hard["play_count"] == 2
+    assert hard["score_mean"] == 3000.0
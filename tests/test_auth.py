@@ -0,0 +1,112 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import model
+from app.api import app
+from app.auth import InvalidToken, TokenSigner
+
+client = TestClient(app)
+
+
+def test_token_signer_rotation():
+    old = TokenSigner("k1:old-secret")
+    token = old.sign(42, issued_at=1000)
+    assert token.startswith("v1.k1.42.1000.")
+    assert old.user_id(token) == 42
+    # uuid の token は対象外
+    assert old.user_id("0b7e9a4c-3c3e-4a4e-9f0e-1f2d3c4b5a69") is None
+
+    # 新しい鍵を先頭に足す: 新しい鍵で署名し, 古い token も通る
+    rotated = TokenSigner("k2:new-secret,k1:old-secret")
+    assert rotated.sign(42).startswith("v1.k2.42.")
+    assert rotated.user_id(token) == 42
+    # 古い鍵を消すと通らない
+    with pytest.raises(InvalidToken):
+        TokenSigner("k2:new-secret").user_id(token)
+
+    with pytest.raises(InvalidToken):
+        old.user_id(token.replace(".42.", ".43."))
+    with pytest.raises(InvalidToken):
+        TokenSigner("k1:old-secret", max_age=60).user_id(token, now=1061)
+    # 署名に ASCII 以外が混ざっていても不正な token として扱う
+    with pytest.raises(InvalidToken):
+        old.user_id("v1.k1.42.1000.\xe9abc")
+    assert not TokenSigner("").enabled
+
+
+def test_signed_token_api(monkeypatch):
+    monkeypatch.setattr(model, "token_signer", TokenSigner(""))
+    response = client.post(
+        "/user/create", json={"user_name": "uuid_user", "leader_card_id": 1000}
+    )
+    uuid_token = response.json()["user_token"]
+
+    monkeypatch.setattr(model, "token_signer", TokenSigner("k1:secret"))
+    response = client.post(
+        "/user/create", json={"user_name": "signed_user", "leader_card_id": 1000}
+    )
+    signed_token = response.json()["user_token"]
+    assert signed_token.startswith("v1.")
+    response = client.get(
+        "/user/me", headers={"Authorization": f"bearer {signed_token}"}
+    )
+    assert response.json()["name"] == "signed_user"
+
+    # uuid の token は DB 経由で受け付け, refresh で署名付きに移行できる
+    response = client.post(
+        "/user/token/refresh", headers={"Authorization": f"bearer {uuid_token}"}
+    )
+    refreshed = response.json()["user_token"]
+    assert refreshed.startswith("v1.")
+    response = client.get("/user/me", headers={"Authorization": f"bearer {refreshed}"})
+    assert response.json()["name"] == "uuid_user"
+
+    response = client.post(
+        "/room/create",
+        headers={"Authorization": f"bearer {signed_token[:-2]}xx"},
+        json={"live_id": 1001, "select_difficulty": 1},
+    )
+    assert response.status_code == 401
+    response = client.post(
+        "/room/wait",
+        headers={"Authorization": "bearer v1.k1.1.2.\xe9abc".encode("latin-1")},
+        json={"room_id": 1},
+    )
+    assert response.status_code == 401
+
+
+def test_caller_is_resolved_once_per_request(monkeypatch):
+    monkeypatch.setattr(model, "token_signer", TokenSigner(""))
+    token = client.post(
+        "/user/create", json={"user_name": "caller_user", "leader_card_id": 1000}
+    ).json()["user_token"]
+    headers = {"Authorization": f"bearer {token}"}
+    lookups = []
+    get_user_by_token = model.storage.get_user_by_token
+
+    def counting_get_user_by_token(token):
+        lookups.append(token)
+        return get_user_by_token(token)
+
+    monkeypatch.setattr(model.storage, "get_user_by_token", counting_get_user_by_token)
+    # キャッシュに当たらない時も, token からユーザーを引くのはリクエストで1回
+    model.user_cache.pop(token)
+    response = client.post(
+        "/room/create", headers=headers, json={"live_id": 1001, "select_difficulty": 1}
+    )
+    assert response.status_code == 200
+    assert lookups == [token]
+    caller = model.resolve_caller(token)
+    assert (caller.user_id, caller.user.name) == (caller.user.id, "caller_user")
+    assert lookups == [token]
+
+    # join だけは不正な token でも 401 ではなく OtherError を返す
+    response = client.post(
+        "/room/join",
+        headers={"Authorization": "bearer unknown-token"},
+        json={"room_id": response.json()["room_id"], "select_difficulty": 1},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"join_room_result": 4}
+    with pytest.raises(InvalidToken):
+        model.resolve_caller("unknown-token")
@@ -0,0 +1,196 @@
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config, export, model, profiling
+from app.api import app
+from app.export import ExportFormat
+from app.registry import room_registry
+
+# registry は member の INSERT を write-behind するので, writer を起動しないテストでは書けていない
+pytestmark = pytest.mark.skipif(
+    room_registry is not None, reason="room registry writer is not running"
+)
+
+client = TestClient(app)
+
+KEY = "test-export-key"
+
+
+def _play(live_id: int, scores: list, end: bool = True, leave: bool = False) -> int:
+    """scores の人数でルームを作ってライブを始め, (end なら) 全員のスコアを送る
+
+    leave なら最後に全員 /room/leave する.
+    """
+    headers = []
+    for i in range(len(scores)):
+        token = client.post(
+            "/user/create", json={"user_name": f"export_{i}", "leader_card_id": 1}
+        ).json()["user_token"]
+        headers.append({"Authorization": f"bearer {token}"})
+    room_id = client.post(
+        "/room/create",
+        headers=headers[0],
+        json={"live_id": live_id, "select_difficulty": 1},
+    ).json()["room_id"]
+    for h in headers[1:]:
+        client.post(
+            "/room/join", headers=h, json={"room_id": room_id, "select_difficulty": 2}
+        )
+    client.post("/room/start", headers=headers[0], json={"room_id": room_id})
+    for i, (h, score) in enumerate(zip(headers, scores)):
+        if end or i == 0:
+            client.post(
+                "/room/end",
+                headers=h,
+                json={"room_id": room_id, "score": score, "judge_count_list": [i] * 5},
+            )
+    if leave:
+        for h in headers:
+            client.post("/room/leave", headers=h, json={"room_id": room_id})
+    return room_id
+
+
+@pytest.fixture(scope="module")
+def rooms():
+    live_id = 500000 + int(time.time() * 1000) % 10**8
+    # 結果を出した後に全員抜けても出す
+    finished = _play(live_id, [100, 200, 300], leave=True)
+    # スコアが揃っていないルームは出さない
+    _play(live_id, [400, 500], end=False)
+    other = _play(live_id + 1, [600])
+    return live_id, finished, other
+
+
+def test_export_rows_in_key_order_across_pages(rooms):
+    live_id, finished, other = rooms
+    rows = list(export.iter_rows(model.storage, live_id=live_id, page_size=2))
+    assert [(row[0], row[4]) for row in rows] == [
+        (finished, 100),
+        (finished, 200),
+        (finished, 300),
+    ]
+    assert [row[1] for row in rows] == sorted(row[1] for row in rows)
+    assert rows[1][2:10] == (live_id, 2, 200, 1, 1, 1, 1, 1)
+
+    # 途中の行から再開すると続きだけ
+    after = (rows[0][0], rows[0][1])
+    resumed = export.iter_rows(model.storage, live_id=live_id, after=after, page_size=2)
+    assert list(resumed) == rows[1:]
+    # room_id の範囲で絞る
+    rows = list(export.iter_rows(model.storage, min_room_id=other, max_room_id=other))
+    assert [(row[0], row[2], row[4]) for row in rows] == [(other, live_id + 1, 600)]
+
+
+def test_admin_export_endpoint(rooms, monkeypatch):
+    live_id, finished, _ = rooms
+    assert client.get("/admin/export").status_code == 404
+    monkeypatch.setattr(config, "PROFILE_KEY", KEY)
+    response = client.get("/admin/export", headers={profiling.HEADER: "x"})
+    assert response.status_code == 403
+    headers = {profiling.HEADER: KEY}
+
+    response = client.get(
+        "/admin/export",
+        headers=headers,
+        params={"format": "csv", "live_id": live_id},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert lines[0] == ",".join(export.COLUMNS)
+    assert [line.split(",")[4] for line in lines[1:]] == ["100", "200", "300"]
+
+    response = client.get("/admin/export", headers=headers, params={"live_id": live_id})
+    first = json.loads(response.text.splitlines()[0])
+    assert first["room_id"] == finished
+    assert first["judge_count_list"] == [0] * 5
+    response = client.get(
+        "/admin/export",
+        headers=headers,
+        params={"live_id": live_id, "after": f"{finished}:{first['member_id']}"},
+    )
+    assert [json.loads(line)["score"] for line in response.text.splitlines()] == [
+        200,
+        300,
+    ]
+    response = client.get("/admin/export", headers=headers, params={"after": "x"})
+    assert response.status_code == 400
+
+
+class _FailingStorage:
+    """limit 行読んだところで落ちる storage (書き出しの途中で止まった場合)"""
+
+    def __init__(self, storage, limit: int):
+        self.storage = storage
+        self.remaining = limit
+
+    def iter_export(self, *args):
+        for row in self.storage.iter_export(*args):
+            if self.remaining == 0:
+                raise RuntimeError("connection lost")
+            self.remaining -= 1
+            yield row
+
+
+def test_export_to_file_resumes_from_checkpoint(rooms, tmp_path):
+    live_id = rooms[0]
+    expected = tmp_path / "expected.csv"
+    export.export_to_file(model.storage, str(expected), ExportFormat.csv, live_id)
+
+    output = tmp_path / "results.csv"
+    checkpoint = str(tmp_path / "results.ckpt")
+    with pytest.raises(RuntimeError):
+        export.export_to_file(
+            _FailingStorage(model.storage, 1),
+            str(output),
+            ExportFormat.csv,
+            live_id,
+            checkpoint=checkpoint,
+            page_size=2,
+        )
+    # checkpoint がまだないので最初から書き直し, 2行目で checkpoint を書いた後に落ちる
+    with pytest.raises(RuntimeError):
+        export.export_to_file(
+            _FailingStorage(model.storage, 2),
+            str(output),
+            ExportFormat.csv,
+            live_id,
+            checkpoint=checkpoint,
+            page_size=2,
+        )
+    assert json.loads(open(checkpoint).read())["rows"] == 2
+    # checkpoint より後に書きかけた分は捨てて続きから書く
+    with open(output, "ab") as f:
+        f.write(b"partial line")
+    written = export.export_to_file(
+        model.storage,
+        str(output),
+        ExportFormat.csv,
+        live_id,
+        checkpoint=checkpoint,
+        page_size=2,
+    )
+    assert written == 1
+    assert output.read_bytes() == expected.read_bytes()
+
+
+def test_export_to_file_restarts_when_output_is_missing(rooms, tmp_path):
+    live_id = rooms[0]
+    expected = tmp_path / "expected.csv"
+    export.export_to_file(model.storage, str(expected), ExportFormat.csv, live_id)
+
+    output = tmp_path / "results.csv"
+    checkpoint = tmp_path / "results.ckpt"
+    checkpoint.write_text(json.dumps({"after": [0, 0], "offset": 100, "rows": 2}))
+    written = export.export_to_file(
+        model.storage,
+        str(output),
+        ExportFormat.csv,
+        live_id,
+        checkpoint=str(checkpoint),
+    )
+    assert written == 3
+    assert output.read_bytes() == expected.read_bytes()
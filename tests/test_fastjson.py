@@ -0,0 +1,79 @@
+import asyncio
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app import config, fastjson
+from app.ResReqModel import (
+    LiveDifficulty,
+    ResultUser,
+    RoomInfo,
+    RoomListResponse,
+    RoomResultResponse,
+    RoomUser,
+    RoomWaitResponse,
+    WaitRoomStatus,
+)
+from bench import serialize
+
+
+def _default_body(response) -> bytes:
+    # /room/list, /room/wait は response_model_exclude_unset=True
+    return JSONResponse(jsonable_encoder(response, exclude_unset=True)).body
+
+
+def test_fastjson_matches_default_encoding(monkeypatch):
+    monkeypatch.setattr(config, "FAST_JSON", True)
+    users = [
+        RoomUser(
+            user_id=i,
+            name=f"ユーザー{i}",
+            leader_card_id=1000,
+            select_difficulty=LiveDifficulty.Hard,
+            is_me=i == 0,
+            is_host=i == 1,
+        )
+        for i in range(4)
+    ]
+    assert fastjson.room_wait_response(WaitRoomStatus.LiveStart, users).body == (
+        _default_body(
+            RoomWaitResponse(status=WaitRoomStatus.LiveStart, room_user_list=users)
+        )
+    )
+
+    rooms = [
+        RoomInfo(room_id=i, live_id=1001, joined_user_count=1, max_user_count=4)
+        for i in range(3)
+    ]
+    for next_cursor in (None, 2):
+        assert fastjson.room_list_response(rooms, next_cursor).body == _default_body(
+            RoomListResponse(room_info_list=rooms, next_cursor=next_cursor)
+        )
+
+    # version を送ってきた時だけ version/unchanged が付く
+    assert fastjson.room_wait_response(WaitRoomStatus.Waiting, [], 3, True).body == (
+        _default_body(
+            RoomWaitResponse(
+                status=WaitRoomStatus.Waiting,
+                room_user_list=[],
+                version=3,
+                unchanged=True,
+            )
+        )
+    )
+    assert fastjson.room_list_response(rooms, None, 5).body == _default_body(
+        RoomListResponse(
+            room_info_list=rooms, next_cursor=None, version=5, unchanged=False
+        )
+    )
+
+    results = [ResultUser(user_id=1, judge_count_list=[1, 2, 3, 4, 5], score=100)]
+    assert fastjson.room_result_response(results).body == _default_body(
+        RoomResultResponse(result_user_list=results)
+    )
+
+
+def test_serialize_bench_outputs_match(monkeypatch):
+    # python -m bench.serialize の計測前の一致チェック
+    monkeypatch.setattr(config, "FAST_JSON", True)
+    asyncio.run(serialize.check())
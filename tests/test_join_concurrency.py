@@ -0,0 +1,80 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.testclient import TestClient
+
+from app import model
+from app.api import app
+from app.config import MAX_USER_COUNT
+from app.ResReqModel import JoinRoomResult, LiveDifficulty
+
+client = TestClient(app)
+parallel_joins = 32
+
+
+def _create_user(i):
+    response = client.post(
+        "/user/create",
+        json={"user_name": f"concurrent_user_{i}", "leader_card_id": 1000},
+    )
+    return response.json()["user_token"]
+
+
+def test_parallel_join_keeps_capacity():
+    host_token = _create_user("host")
+    tokens = [_create_user(i) for i in range(parallel_joins)]
+    response = client.post(
+        "/room/create",
+        headers={"Authorization": f"bearer {host_token}"},
+        json={"live_id": 1004, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+
+    # 同じユーザーの二重 join も混ぜる
+    tokens = tokens + tokens[:4]
+    with ThreadPoolExecutor(max_workers=len(tokens)) as executor:
+        results = list(
+            executor.map(
+                lambda token: model.join_room(
+                    room_id, LiveDifficulty.Hard, model.resolve_caller(token)
+                ),
+                tokens,
+            )
+        )
+
+    assert set(results) <= {JoinRoomResult.Ok, JoinRoomResult.RoomFull}
+    status, room_user_list = model.wait_room(room_id, model.resolve_caller(host_token))
+    assert len(room_user_list) == MAX_USER_COUNT
+    room_info_list, _ = model.list_room(1004)
+    assert room_id not in [room.room_id for room in room_info_list]
+
+    # 入れたユーザーは全員 Ok を受け取っている
+    joined = {user.user_id for user in room_user_list if not user.is_host}
+    ok_users = {
+        model.get_user_by_token(token).id
+        for token, result in zip(tokens, results)
+        if result == JoinRoomResult.Ok
+    }
+    assert ok_users == joined
+
+
+def test_parallel_quickjoin_fills_rooms():
+    live_id = 200000 + int(time.time() * 1000) % 10**8
+    tokens = [_create_user(f"quick_{i}") for i in range(parallel_joins)]
+    with ThreadPoolExecutor(max_workers=len(tokens)) as executor:
+        results = list(
+            executor.map(
+                lambda token: model.quick_join(
+                    live_id, LiveDifficulty.Hard, model.resolve_caller(token)
+                ),
+                tokens,
+            )
+        )
+
+    members = Counter(room_id for room_id, _ in results)
+    for room_id, count in members.items():
+        _, room_user_list = model.wait_room(room_id, model.resolve_caller(tokens[0]))
+        assert len(room_user_list) == count <= MAX_USER_COUNT
+    # 作ったのは入れるルームがなかった時だけ
+    assert sum(created for _, created in results) == len(members)
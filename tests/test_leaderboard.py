@@ -0,0 +1,104 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import model
+from app.api import app
+from app.leaderboard import Leaderboard
+from app.registry import room_registry
+from app.ResReqModel import LiveDifficulty
+
+client = TestClient(app)
+
+
+def test_board_keeps_best_score_per_user_within_size():
+    board = Leaderboard(size=3)
+    normal = LiveDifficulty.Normal
+    assert board.record(1, normal, 1, "a", 10, 100)
+    assert board.record(1, normal, 2, "b", 10, 300)
+    assert board.record(1, normal, 3, "c", 10, 200)
+    # 自己ベスト未満は無視
+    assert not board.record(1, normal, 2, "b", 10, 50)
+    # 圏外
+    assert not board.record(1, normal, 4, "d", 10, 90)
+    # 同点は先に出した方が上
+    assert board.record(1, normal, 5, "e", 10, 200)
+    assert [(e.rank, e.user_id, e.score) for e in board.top(1, normal)] == [
+        (1, 2, 300),
+        (2, 3, 200),
+        (3, 5, 200),
+    ]
+    # 自己ベスト更新で1件のまま順位が上がる
+    assert board.record(1, normal, 5, "e", 10, 400)
+    assert [e.user_id for e in board.top(1, normal, 2)] == [5, 2]
+    assert board.top(1, LiveDifficulty.Hard) == []
+
+
+# TestClient を startup なしで使っているので registry の writer が動いておらず member が DB にない
+@pytest.mark.skipif(room_registry is not None, reason="room registry is not started")
+def test_leaderboard_api():
+    live_id = int(time.time() * 1000) % 1_000_000_000
+    tokens = []
+    for i in range(2):
+        response = client.post(
+            "/user/create",
+            json={"user_name": f"leaderboard_{i}", "leader_card_id": 100 + i},
+        )
+        tokens.append(response.json()["user_token"])
+    headers = [{"Authorization": f"bearer {token}"} for token in tokens]
+
+    response = client.post(
+        "/room/create",
+        headers=headers[0],
+        json={"live_id": live_id, "select_difficulty": 2},
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=headers[1],
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+    client.post("/room/start", headers=headers[0], json={"room_id": room_id})
+    for i, score in enumerate([1234, 5678]):
+        response = client.post(
+            "/room/end",
+            headers=headers[i],
+            json={"room_id": room_id, "score": score, "judge_count_list": [1] * 5},
+        )
+        assert response.status_code == 200
+
+    request = {"live_id": live_id, "select_difficulty": 2}
+    response = client.post("/live/leaderboard", json=request)
+    assert response.status_code == 200
+    ranking = response.json()["ranking"]
+    assert [(e["name"], e["leader_card_id"], e["score"]) for e in ranking] == [
+        ("leaderboard_1", 101, 5678),
+        ("leaderboard_0", 100, 1234),
+    ]
+    response = client.post(
+        "/live/leaderboard", json={"live_id": live_id, "select_difficulty": 1}
+    )
+    assert response.json()["ranking"] == []
+
+    # 結果を見て全員抜けた後に, 起動時と同じく storage から作り直しても同じ
+    response = client.post("/room/result", json={"room_id": room_id})
+    assert len(response.json()["result_user_list"]) == 2
+    for h in headers:
+        client.post("/room/leave", headers=h, json={"room_id": room_id})
+    assert model.rebuild_leaderboard() >= 2
+    response = client.post("/live/leaderboard", json=request)
+    assert response.json()["ranking"] == ranking
+
+    # 名前/アバターの変更はすぐ反映される
+    response = client.post(
+        "/user/update",
+        headers=headers[0],
+        json={"user_name": "leaderboard_renamed", "leader_card_id": 200},
+    )
+    assert response.status_code == 200
+    response = client.post("/live/leaderboard", json=request)
+    assert [(e["name"], e["leader_card_id"]) for e in response.json()["ranking"]] == [
+        ("leaderboard_1", 101),
+        ("leaderboard_renamed", 200),
+    ]
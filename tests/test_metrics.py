@@ -0,0 +1,53 @@
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config
+from app.api import app
+from app.metrics import is_transaction_control
+
+client = TestClient(app)
+
+
+def test_metrics():
+    response = client.post(
+        "/user/create", json={"user_name": "metrics", "leader_card_id": 1000}
+    )
+    assert response.status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert 'gameserver_request_duration_seconds_count{endpoint="/user/create"}' in body
+    assert 'gameserver_request_sql_statements_bucket{endpoint="/user/create"' in body
+    assert "gameserver_pool_checkout_wait_seconds_count" in body
+    assert "gameserver_user_cache_hits" in body
+
+
+def _sql_statements_sum(endpoint: str) -> float:
+    match = re.search(
+        rf'^gameserver_request_sql_statements_sum{{endpoint="{endpoint}"}} (\S+)$',
+        client.get("/metrics").text,
+        re.MULTILINE,
+    )
+    return float(match.group(1)) if match else 0.0
+
+
+def test_transaction_control_is_not_counted():
+    assert is_transaction_control("BEGIN IMMEDIATE")
+    assert is_transaction_control("commit")
+    assert not is_transaction_control("INSERT INTO user (name) VALUES (?)")
+
+
+@pytest.mark.skipif(
+    config.STORAGE == "memory", reason="memory storage does not use SQL"
+)
+def test_sql_statements_match_query_budget():
+    before = _sql_statements_sum("/user/create")
+    response = client.post(
+        "/user/create", json={"user_name": "metrics", "leader_card_id": 1000}
+    )
+    assert response.status_code == 200
+    # INSERT の1文だけ. SQLite の BEGIN IMMEDIATE は数えない (tests/test_query_budget.py と同じ)
+    assert _sql_statements_sum("/user/create") - before == 1
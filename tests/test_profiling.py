@@ -0,0 +1,78 @@
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config, profiling
+from app.api import app
+
+client = TestClient(app)
+
+KEY = "test-profile-key"
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "PROFILE_KEY", KEY)
+    monkeypatch.setattr(config, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "PROFILE_SAMPLE_RATE", 0.0)
+    return tmp_path
+
+
+def _create_user(headers=None) -> str:
+    response = client.post(
+        "/user/create",
+        json={"user_name": "profiled", "leader_card_id": 1},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    return response.json()["user_token"]
+
+
+def test_profile_by_admin_header(profile_dir):
+    # ヘッダなしでは取らない
+    _create_user()
+    assert os.listdir(profile_dir) == []
+    # 鍵が違えば取らない
+    _create_user({profiling.HEADER: "wrong"})
+    assert os.listdir(profile_dir) == []
+
+    _create_user({profiling.HEADER: KEY})
+    names = sorted(os.listdir(profile_dir))
+    assert [name.rsplit(".", 1)[1] for name in names] == ["json", "prof"]
+
+    response = client.get("/admin/profiles", headers={profiling.HEADER: KEY})
+    assert response.status_code == 200
+    (record,) = response.json()["routes"]["/user/create"]
+    assert record["status"] == 200
+    assert record["sampled"] is False
+    assert "timeline" not in record
+
+    response = client.get(
+        f"/admin/profiles/{record['id']}", headers={profiling.HEADER: KEY}
+    )
+    detail = response.json()
+    # ハンドラを実行したスレッド (スレッドプール) の cProfile が取れている
+    assert any("create_user" in f["function"] for f in detail["top_functions"])
+    if config.STORAGE != "memory":
+        assert detail["sql_statements"] >= 1
+        assert any(event["kind"] == "sql" for event in detail["timeline"])
+
+
+def test_profile_admin_endpoints_require_key(profile_dir, monkeypatch):
+    assert client.get("/admin/profiles").status_code == 403
+    response = client.get("/admin/profiles/nothing", headers={profiling.HEADER: KEY})
+    assert response.status_code == 404
+    monkeypatch.setattr(config, "PROFILE_KEY", "")
+    assert client.get("/admin/profiles").status_code == 404
+
+
+def test_sampled_profiles_are_rotated(profile_dir, monkeypatch):
+    monkeypatch.setattr(config, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(config, "PROFILE_MAX_FILES", 2)
+    for _ in range(4):
+        _create_user()
+    records = profiling.summary(10)["/user/create"]
+    assert len(records) == 2
+    assert all(record["sampled"] for record in records)
+    assert len([n for n in os.listdir(profile_dir) if n.endswith(".prof")]) == 2
@@ -0,0 +1,204 @@
+"""app/api.py のエンドポイントごとの SQL 文の数 / トランザクション数の上限
+
+往復を増やす変更をしたらここで落ちる. 上限を上げる時は理由を書くこと.
+user_cache に当たる前提 (外れると user を引く SELECT が1つ増える).
+"""
+
+import contextlib
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app import config
+from app.api import app
+from app.db import engine
+from app.metrics import is_transaction_control
+from app.registry import room_registry
+
+pytestmark = [
+    pytest.mark.skipif(
+        config.STORAGE == "memory", reason="memory storage does not use SQL"
+    ),
+    # registry はルームの書き込みを write-behind でまとめるので数え方が違う
+    pytest.mark.skipif(room_registry is not None, reason="room registry is enabled"),
+]
+
+client = TestClient(app)
+
+# path -> (SQL文, トランザクション).
+# ルームを変える create/join/quickjoin/start/leave は, 最後に /room/list の version を上げる1文が付く
+BUDGETS = {
+    "/user/create": (1, 1),
+    "/user/me": (0, 0),
+    "/user/update": (1, 1),
+    "/user/token/refresh": (0, 0),
+    "/room/create": (3, 1),
+    # version を送ると先に version を読む. 変わっていなければページは読まない
+    "/room/list": (2, 1),
+    # 枠の確保 (UPDATE) + INSERT
+    "/room/join": (3, 1),
+    # 候補の SELECT + join
+    "/room/quickjoin": (4, 1),
+    "/room/wait": (1, 1),
+    # オーナーの確認と更新を1文で
+    "/room/start": (2, 1),
+    # 結果の UPDATE + ランキング用の SELECT
+    "/room/end": (2, 1),
+    "/room/result": (1, 1),
+    # room の UPDATE (人数, オーナーの交代/解散) + 結果を出した member に印を付ける UPDATE.
+    # 結果を出していなければ (待機中など) 印が付かないので, もう1文で DELETE する
+    "/room/leave": (4, 1),
+    "/live/leaderboard": (0, 0),
+    # 前回の集計より後の結果を読み足す時だけ (本体とアーカイブを UNION ALL の1文で)
+    "/live/stats": (1, 1),
+    "/metrics": (0, 0),
+}
+
+
+class QueryCount:
+    def __init__(self):
+        self.statements: list[str] = []
+        self.transactions = 0
+
+
+@contextlib.contextmanager
+def count_queries():
+    counter = QueryCount()
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        # SQLite の begin イベントで流す BEGIN IMMEDIATE はトランザクションの方で数える
+        if not is_transaction_control(statement):
+            counter.statements.append(statement)
+
+    def begin(conn):
+        counter.transactions += 1
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "begin", begin)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        event.remove(engine, "begin", begin)
+
+
+def _call(method: str, path: str, **kwargs):
+    with count_queries() as counter:
+        response = getattr(client, method)(path, **kwargs)
+    assert response.status_code == 200, response.text
+    max_statements, max_transactions = BUDGETS[path]
+    assert len(counter.statements) <= max_statements, (path, counter.statements)
+    assert counter.transactions <= max_transactions, path
+    return response
+
+
+def _create_user(i: int) -> dict:
+    token = _call(
+        "post",
+        "/user/create",
+        json={"user_name": f"budget_{i}", "leader_card_id": i},
+    ).json()["user_token"]
+    return {"Authorization": f"bearer {token}"}
+
+
+def test_endpoint_query_budgets():
+    live_id = int(time.time() * 1000) % 1_000_000_000
+    host, guest, third = [_create_user(i) for i in range(3)]
+    _call("get", "/user/me", headers=host)
+    _call("post", "/user/token/refresh", headers=host)
+    _call(
+        "post",
+        "/user/update",
+        headers=guest,
+        json={"user_name": "budget_guest", "leader_card_id": 9},
+    )
+    # update で消えたキャッシュを入れ直す (ここは上限の対象外)
+    client.get("/user/me", headers=guest)
+
+    room_id = _call(
+        "post",
+        "/room/create",
+        headers=host,
+        json={"live_id": live_id, "select_difficulty": 1},
+    ).json()["room_id"]
+    _call("post", "/room/list", json={"live_id": live_id})
+    listed = _call("post", "/room/list", json={"live_id": live_id, "version": 0})
+    with count_queries() as counter:
+        unchanged = client.post(
+            "/room/list", json={"live_id": live_id, "version": listed.json()["version"]}
+        )
+    assert unchanged.json()["unchanged"] is True
+    # 変わっていなければ version の1文だけ
+    assert len(counter.statements) == 1
+    _call(
+        "post",
+        "/room/join",
+        headers=guest,
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+    quick = _call(
+        "post",
+        "/room/quickjoin",
+        headers=third,
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    assert quick.json() == {"room_id": room_id, "created": False}
+    _call("post", "/room/wait", headers=guest, json={"room_id": room_id})
+    # version 付きも1文 (変わっていなければ room の1行だけ)
+    version = _call(
+        "post", "/room/wait", headers=guest, json={"room_id": room_id, "version": 0}
+    ).json()["version"]
+    unchanged = _call(
+        "post",
+        "/room/wait",
+        headers=guest,
+        json={"room_id": room_id, "version": version},
+    )
+    assert unchanged.json()["unchanged"] is True
+    # オーナーでないユーザーの start は何も変えない
+    _call("post", "/room/start", headers=guest, json={"room_id": room_id})
+    _call("post", "/room/start", headers=host, json={"room_id": room_id})
+    for headers in (host, guest, third):
+        _call(
+            "post",
+            "/room/end",
+            headers=headers,
+            json={"room_id": room_id, "score": 100, "judge_count_list": [1] * 5},
+        )
+    result = _call("post", "/room/result", json={"room_id": room_id}).json()
+    assert len(result["result_user_list"]) == 3
+    _call(
+        "post",
+        "/live/leaderboard",
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    _call("post", "/live/stats", json={"live_id": live_id})
+    _call("get", "/metrics")
+
+    # オーナーが抜けると残りの一番古いメンバーがホストになり, 全員抜けると解散
+    _call("post", "/room/leave", headers=host, json={"room_id": room_id})
+    wait = client.post("/room/wait", headers=guest, json={"room_id": room_id}).json()
+    assert [(u["name"], u["is_host"]) for u in wait["room_user_list"]] == [
+        ("budget_guest", True),
+        ("budget_2", False),
+    ]
+    # もう抜けたユーザーの leave は何もしない
+    _call("post", "/room/leave", headers=host, json={"room_id": room_id})
+    _call("post", "/room/leave", headers=guest, json={"room_id": room_id})
+    _call("post", "/room/leave", headers=third, json={"room_id": room_id})
+    wait = client.post("/room/wait", headers=guest, json={"room_id": room_id}).json()
+    assert wait == {"status": 3, "room_user_list": []}
+
+
+def test_every_api_endpoint_has_a_budget():
+    # /room/wait/longpoll, /room/wait/ws は /room/wait を繰り返すだけなので除く
+    paths = {
+        route.path
+        for route in app.routes
+        if getattr(route, "methods", None)
+        and route.path.startswith(("/user/", "/room/", "/live/"))
+        and not route.path.startswith("/room/wait/")
+    }
+    assert paths <= set(BUDGETS), paths - set(BUDGETS)
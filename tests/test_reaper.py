@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from app import config, export, model
+from app.reaper import RoomReaper
+from app.registry import room_registry
+from app.ResReqModel import JoinRoomResult, LiveDifficulty, WaitRoomStatus
+
+
+def _create_user(i):
+    return model.resolve_caller(model.create_user(f"reaper_user_{i}", 1000))
+
+
+# TestClient を startup なしで使っているので registry の writer が動いておらず DB に書かれない
+@pytest.mark.skipif(room_registry is not None, reason="room registry is not started")
+def test_reaper_archives_finished_rooms():
+    host, guest, idle_host = [_create_user(i) for i in range(3)]
+
+    # 全員のスコアが揃ったライブ (結果を出して抜けた)
+    finished_room_id = model.create_room(host, 1005, LiveDifficulty.Normal)
+    model.start_room(finished_room_id, host)
+    model.end_room(finished_room_id, 100, [1, 2, 3, 4, 5], host)
+    model.leave_room(finished_room_id, host)
+    # 解散済み
+    dissolved_room_id = model.create_room(guest, 1005, LiveDifficulty.Normal)
+    model.leave_room(dissolved_room_id, guest)
+    # まだ待機中
+    waiting_room_id = model.create_room(idle_host, 1005, LiveDifficulty.Normal)
+
+    reaper = RoomReaper(batch_size=1, finished_timeout=0, idle_timeout=10**9)
+    assert reaper.run_once(time.time() + 1) >= 2
+
+    assert model.storage.result_room(finished_room_id) == []
+    # 抜けたメンバーの結果もアーカイブに移っている (memory storage は捨てる)
+    if config.STORAGE != "memory":
+        rows = export.iter_rows(
+            model.storage, min_room_id=finished_room_id, max_room_id=finished_room_id
+        )
+        assert [row[4] for row in rows] == [100]
+    assert model.join_room(dissolved_room_id, LiveDifficulty.Hard, host) == (
+        JoinRoomResult.Disbanded
+    )
+    status, room_user_list = model.wait_room(waiting_room_id, idle_host)
+    assert status == WaitRoomStatus.Waiting
+    assert len(room_user_list) == 1
+
+    # 放置タイムアウトを過ぎれば待機中のルームも片付ける
+    reaper = RoomReaper(finished_timeout=0, idle_timeout=0)
+    reaper.run_once(time.time() + 1)
+    assert model.wait_room(waiting_room_id, idle_host) == (
+        WaitRoomStatus.Dissolution,
+        [],
+    )
+
+
+@pytest.mark.skipif(room_registry is not None, reason="room registry is not started")
+def test_reaper_waits_from_the_last_score():
+    host = _create_user("long_live")
+    room_id = model.create_room(host, 1005, LiveDifficulty.Normal)
+    model.start_room(room_id, host)
+    # ライブ開始 (room の最終更新) から1秒以上経ってスコアが届く
+    time.sleep(1.1)
+    ended = int(time.time())
+    model.end_room(room_id, 100, [1, 2, 3, 4, 5], host)
+
+    # 開始からは猶予を過ぎているが, 最後のスコアからはまだ
+    reaper = RoomReaper(finished_timeout=100, idle_timeout=10**9)
+    reaper.run_once(ended + 100)
+    assert len(model.storage.result_room(room_id)) == 1
+    reaper.run_once(ended + 102)
+    assert model.storage.result_room(room_id) == []
@@ -0,0 +1,229 @@
+import threading
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from app import config, model
+from app.config import MAX_USER_COUNT
+from app.model import SafeUser
+from app.registry import RegistryWriteError, RoomRegistry
+from app.ResReqModel import JoinRoomResult, LiveDifficulty, WaitRoomStatus
+
+
+def _user(i):
+    return SafeUser(id=i, name=f"registry_user_{i}", leader_card_id=1000)
+
+
+def test_registry_lifecycle():
+    # writer スレッドを起動しないので書き込みはキューに溜まるだけ
+    registry = RoomRegistry()
+    registry.add_room(1, 1001, _user(0), LiveDifficulty.Normal)
+    registry.add_room(2, 1002, _user(10), LiveDifficulty.Normal)
+
+    assert [r.room_id for r in registry.list_room(1001)[0]] == [1]
+    assert [r.room_id for r in registry.list_room(0)[0]] == [1, 2]
+    # ページング
+    page, next_cursor = registry.list_room(0, limit=1)
+    assert [r.room_id for r in page] == [1]
+    assert next_cursor == 1
+    page, next_cursor = registry.list_room(0, cursor=next_cursor, limit=1)
+    assert [r.room_id for r in page] == [2]
+    assert next_cursor is None
+    # DB で先に採番されたルームが後から登録されても room_id 順
+    registry.add_room(4, 1003, _user(20), LiveDifficulty.Normal)
+    registry.add_room(3, 1003, _user(21), LiveDifficulty.Normal)
+    assert [r.room_id for r in registry.list_room(1003)[0]] == [3, 4]
+    assert [r.room_id for r in registry.list_room(0)[0]] == [1, 2, 3, 4]
+    registry.leave_room(3, 21)
+    registry.leave_room(4, 20)
+
+    results = [
+        registry.join_room(1, _user(i), LiveDifficulty.Hard)
+        for i in range(1, MAX_USER_COUNT + 1)
+    ]
+    assert results[: MAX_USER_COUNT - 1] == [JoinRoomResult.Ok] * (MAX_USER_COUNT - 1)
+    assert results[-1] == JoinRoomResult.RoomFull
+    assert (
+        registry.join_room(3, _user(1), LiveDifficulty.Hard) == JoinRoomResult.Disbanded
+    )
+    # 満員のルームは一覧に出ない
+    assert registry.list_room(1001) == ([], None)
+
+    status, users = registry.wait_room(1, 1)
+    assert status == WaitRoomStatus.Waiting
+    assert len(users) == MAX_USER_COUNT
+    assert [u.is_me for u in users].count(True) == 1
+    assert [u.user_id for u in users if u.is_host] == [0]
+
+    # オーナーが抜けると次のメンバーがオーナーになる
+    registry.leave_room(1, 0)
+    status, users = registry.wait_room(1, 1)
+    assert [u.user_id for u in users if u.is_host] == [1]
+
+    # オーナー以外は開始できない
+    registry.start_room(1, 2)
+    assert registry.wait_room(1, 1)[0] == WaitRoomStatus.Waiting
+    registry.start_room(1, 1)
+    assert registry.wait_room(1, 1)[0] == WaitRoomStatus.LiveStart
+    assert (
+        registry.join_room(1, _user(0), LiveDifficulty.Hard)
+        == JoinRoomResult.OtherError
+    )
+
+    for i in range(1, MAX_USER_COUNT):
+        registry.leave_room(1, i)
+    assert registry.wait_room(1, 1) == (WaitRoomStatus.Dissolution, [])
+    assert registry.pending() > 0
+
+
+# ここから下は writer スレッドを起動して DB に書く
+requires_db = pytest.mark.skipif(
+    config.STORAGE == "memory", reason="room registry writes to an SQL storage"
+)
+
+
+def _db_user(name: str) -> SafeUser:
+    return model.caller_user(model.resolve_caller(model.create_user(name, 1000)))
+
+
+def _member_ids(room_user_list) -> set[int]:
+    return {u.user_id for u in room_user_list}
+
+
+@requires_db
+def test_registry_writes_behind_and_reloads():
+    host, guest = _db_user("registry_host"), _db_user("registry_guest")
+    room_id = model.storage.create_room(host.id, 1101, LiveDifficulty.Normal)
+    registry = RoomRegistry()
+    registry.start()
+    try:
+        assert registry.join_room(room_id, guest, LiveDifficulty.Hard) == (
+            JoinRoomResult.Ok
+        )
+        registry.start_room(room_id, host.id)
+        version, status, users = registry.wait_room_since(room_id, host.id, 0)
+        assert registry.flush(5)
+        assert registry.pending() == 0
+        # DB にも同じ状態と version が書けている
+        assert model.storage.wait_room_since(room_id, host.id, 0)[:2] == (
+            version,
+            WaitRoomStatus.LiveStart,
+        )
+        assert _member_ids(model.storage.wait_room(room_id, host.id)[1]) == {
+            host.id,
+            guest.id,
+        }
+    finally:
+        registry.stop()
+
+    # 再起動すると DB から読み直す
+    reloaded = RoomRegistry()
+    reloaded.load()
+    assert reloaded.wait_room_since(room_id, host.id, 0)[:2] == (
+        version,
+        WaitRoomStatus.LiveStart,
+    )
+    assert _member_ids(reloaded.wait_room(room_id, host.id)[1]) == _member_ids(users)
+
+
+@requires_db
+def test_registry_keeps_scores_of_members_who_left():
+    host, guest = _db_user("registry_left_host"), _db_user("registry_left_guest")
+    room_id = model.storage.create_room(host.id, 1103, LiveDifficulty.Normal)
+    registry = RoomRegistry()
+    registry.start()
+    try:
+        registry.join_room(room_id, guest, LiveDifficulty.Hard)
+        registry.start_room(room_id, host.id)
+        assert registry.flush(5)
+        model.storage.end_room(room_id, guest.id, 4321, [1] * 5)
+        # スコアを出した guest と出していない host が抜ける
+        registry.leave_room(room_id, guest.id)
+        registry.leave_room(room_id, host.id)
+        assert registry.flush(5)
+    finally:
+        registry.stop()
+
+    scores = [row for row in model.storage.iter_scores() if row[0] == 1103]
+    assert [(row[2], row[5]) for row in scores] == [(guest.id, 4321)]
+    assert model.storage.wait_room(room_id, guest.id) == (
+        WaitRoomStatus.Dissolution,
+        [],
+    )
+    reloaded = RoomRegistry()
+    reloaded.load()
+    assert reloaded.wait_room(room_id, guest.id) == (WaitRoomStatus.Dissolution, [])
+
+
+@requires_db
+def test_registry_drops_writes_that_keep_failing(monkeypatch):
+    monkeypatch.setattr(config, "ROOM_REGISTRY_RETRY_INTERVAL", 0)
+    host = _db_user("registry_dead_letter")
+    room_id = model.storage.create_room(host.id, 1102, LiveDifficulty.Normal)
+    registry = RoomRegistry(max_attempts=2)
+    registry.start()
+    # flush を呼ぶまで writer に書かせない
+    gate = threading.Event()
+    write_batch = registry._write_batch
+
+    def gated(batch):
+        gate.wait(5)
+        write_batch(batch)
+
+    monkeypatch.setattr(registry, "_write_batch", gated)
+    try:
+        # 主キーが重なる INSERT は何度書き直しても書けない
+        bad = (
+            "INSERT INTO member (room_id, member_id, difficulty)"
+            " VALUES (:room_id, :user_id, 1)",
+            {"room_id": room_id, "user_id": host.id},
+        )
+        registry._enqueue(*bad)
+        registry.leave_room(room_id, host.id)
+        threading.Timer(0.1, gate.set).start()
+        # 待っていた書き込みを捨てたら, 止まらずにエラーになる
+        with pytest.raises(RegistryWriteError):
+            registry.flush(5)
+        assert registry.pending() == 0
+        assert list(registry.dead_letters) == [bad]
+        # 後ろの書き込みは書けている
+        assert model.storage.wait_room(room_id, host.id) == (
+            WaitRoomStatus.Dissolution,
+            [],
+        )
+        assert registry.flush(5)
+    finally:
+        gate.set()
+        registry.stop()
+
+
+@requires_db
+def test_registry_retries_through_an_outage(monkeypatch):
+    monkeypatch.setattr(config, "ROOM_REGISTRY_RETRY_INTERVAL", 0)
+    host, guest = _db_user("registry_outage_host"), _db_user("registry_outage_guest")
+    room_id = model.storage.create_room(host.id, 1104, LiveDifficulty.Normal)
+    registry = RoomRegistry(max_attempts=2)
+    registry.start()
+    # max_attempts より長く DB につながらない
+    outage = {"remaining": 10}
+    write_batch = registry._write_batch
+
+    def flaky(batch):
+        if outage["remaining"] > 0:
+            outage["remaining"] -= 1
+            raise OperationalError(batch[0][0], batch[0][1], Exception("gone away"))
+        write_batch(batch)
+
+    monkeypatch.setattr(registry, "_write_batch", flaky)
+    try:
+        registry.join_room(room_id, guest, LiveDifficulty.Hard)
+        registry.start_room(room_id, host.id)
+        assert registry.flush(5)
+        assert outage["remaining"] == 0
+        assert registry.dropped == 0
+        # 1文も捨てずに全部書けている
+        status, users = model.storage.wait_room(room_id, host.id)
+        assert status == WaitRoomStatus.LiveStart
+        assert _member_ids(users) == {host.id, guest.id}
+    finally:
+        registry.stop()
@@ -0,0 +1,133 @@
+import sqlite3
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config, db, model, sql_storage
+from app.api import app
+from app.db import ReadRouter
+from app.registry import room_registry
+from app.shared_cache import SharedRoomCache, shared_cache
+
+client = TestClient(app)
+
+
+def test_read_router_pins_to_primary():
+    router = ReadRouter(
+        ("primary", "primary_rc"), [("a", "a_rc"), ("b", "b_rc")], pin_seconds=0.05
+    )
+    assert [router.engine(("user", 1)) for _ in range(3)] == ["a", "b", "a"]
+    assert router.engine(read_committed=True) == "b_rc"
+    router.pin(("user", 1))
+    assert router.engine(("user", 1)) == "primary"
+    assert router.engine(("room", 9), ("user", 1), read_committed=True) == "primary_rc"
+    # 他のユーザーはレプリカ
+    assert router.engine(("user", 2)) == "a"
+    time.sleep(0.06)
+    assert router.engine(("user", 1)) == "b"
+    # レプリカがなければ pin に関係なく primary
+    assert ReadRouter(("primary", "primary_rc"), [], 5).engine(("user", 1)) == "primary"
+
+
+def _create_user(name: str) -> dict:
+    response = client.post(
+        "/user/create", json={"user_name": name, "leader_card_id": 1}
+    )
+    return {"Authorization": f"bearer {response.json()['user_token']}"}
+
+
+def _replicate(replica_path: str) -> None:
+    """primary の中身をそのままレプリカのファイルに写す (レプリケーションが追いついた状態)"""
+    fairy = db.engine.raw_connection()
+    try:
+        target = sqlite3.connect(replica_path)
+        fairy.connection.backup(target)
+        target.close()
+    finally:
+        fairy.close()
+
+
+# レプリカの代わりに SQLite のファイルを使い, 写すまでは「遅れている」ものとして扱う
+@pytest.mark.skipif(config.STORAGE != "sqlite", reason="replica test uses SQLite files")
+@pytest.mark.skipif(
+    room_registry is not None or shared_cache is not None,
+    reason="reads do not reach the storage",
+)
+def test_reads_go_to_replica_except_for_the_writer(tmp_path, monkeypatch):
+    replica_path = str(tmp_path / "replica.sqlite3")
+    _replicate(replica_path)
+    replica = db._create_sqlite_engine(f"sqlite:///{replica_path}", read_only=True)
+    router = ReadRouter(
+        (db.engine, db.readcommitted_engine), [(replica, replica)], pin_seconds=60
+    )
+    monkeypatch.setattr(sql_storage, "read_router", router)
+
+    live_id = int(time.time() * 1000) % 1_000_000_000
+    host, guest = _create_user("replica_host"), _create_user("replica_guest")
+    room_id = client.post(
+        "/room/create",
+        headers=host,
+        json={"live_id": live_id, "select_difficulty": 1},
+    ).json()["room_id"]
+
+    # 書いた本人は primary を読むので自分のルームが見える
+    response = client.post("/room/wait", headers=host, json={"room_id": room_id})
+    assert response.json()["status"] == 1
+    # 他のユーザーと一覧はまだ追いついていないレプリカを読む
+    response = client.post("/room/wait", headers=guest, json={"room_id": room_id})
+    assert response.json() == {"status": 3, "room_user_list": []}
+    response = client.post("/room/list", json={"live_id": live_id})
+    assert response.json()["room_info_list"] == []
+
+    # join した guest は自分の join をすぐに読める
+    client.post(
+        "/room/join",
+        headers=guest,
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    response = client.post("/room/wait", headers=guest, json={"room_id": room_id})
+    assert len(response.json()["room_user_list"]) == 2
+
+    _replicate(replica_path)
+    response = client.post("/room/list", json={"live_id": live_id})
+    assert [room["room_id"] for room in response.json()["room_info_list"]] == [room_id]
+    replica.dispose()
+
+
+@pytest.mark.skipif(config.STORAGE != "sqlite", reason="replica test uses SQLite files")
+@pytest.mark.skipif(room_registry is not None, reason="reads do not reach the storage")
+def test_replica_reads_are_not_put_in_shared_cache(tmp_path, monkeypatch):
+    replica_path = str(tmp_path / "replica.sqlite3")
+    _replicate(replica_path)
+    replica = db._create_sqlite_engine(f"sqlite:///{replica_path}", read_only=True)
+    router = ReadRouter(
+        (db.engine, db.readcommitted_engine), [(replica, replica)], pin_seconds=60
+    )
+    monkeypatch.setattr(sql_storage, "read_router", router)
+    monkeypatch.setattr(model, "read_router", router)
+    cache = SharedRoomCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    monkeypatch.setattr(model, "shared_cache", cache)
+
+    live_id = int(time.time() * 1000) % 1_000_000_000
+    host, guest = _create_user("replica_host"), _create_user("replica_guest")
+    room_id = client.post(
+        "/room/create",
+        headers=host,
+        json={"live_id": live_id, "select_difficulty": 1},
+    ).json()["room_id"]
+
+    # pin のない guest と一覧はまだ追いついていないレプリカを読む
+    response = client.post("/room/wait", headers=guest, json={"room_id": room_id})
+    assert response.json() == {"status": 3, "room_user_list": []}
+    response = client.post("/room/list", json={"live_id": live_id})
+    assert response.json()["room_info_list"] == []
+    # その内容は共有されないので, 書いた本人 (別 worker でも) は primary から読める
+    response = client.post("/room/wait", headers=host, json={"room_id": room_id})
+    assert response.json()["status"] == 1
+    assert cache.get_wait(room_id, 0)[1] is not None
+
+    _replicate(replica_path)
+    response = client.post("/room/list", json={"live_id": live_id})
+    assert [room["room_id"] for room in response.json()["room_info_list"]] == [room_id]
+    replica.dispose()
@@ -1,7 +1,15 @@
+import threading
+import time
+
+import pytest
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
 
+from app import config, model
 from app.api import app
 from app.config import MAX_USER_COUNT
+from app.registry import room_registry
+from app.ResReqModel import LiveDifficulty
 
 client = TestClient(app)
 user_tokens = []
@@ -103,3 +111,323 @@ def test_room_1():
     )
     assert response.status_code == 200
     print("room/end response:", response.json())
+
+
+def test_room_wait_push():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(5),
+        json={"live_id": 1002, "select_difficulty": 1},
+    )
+    assert response.status_code == 200
+    room_id = response.json()["room_id"]
+
+    # version なしなら待たずに返る
+    response = client.post(
+        "/room/wait/longpoll", headers=_auth_header(5), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    version = response.json()["version"]
+    assert len(response.json()["room_user_list"]) == 1
+
+    # 変化がなければ timeout まで待って同じ version を返す
+    response = client.post(
+        "/room/wait/longpoll",
+        headers=_auth_header(5),
+        json={"room_id": room_id, "version": version, "timeout": 0.1},
+    )
+    assert response.status_code == 200
+    assert response.json()["version"] == version
+
+    with client.websocket_connect(
+        f"/room/wait/ws?room_id={room_id}", headers=_auth_header(5)
+    ) as websocket:
+        first = websocket.receive_json()
+        assert first["status"] == 1
+        assert len(first["updated_user_list"]) == 1
+
+        response = client.post(
+            "/room/join",
+            headers=_auth_header(6),
+            json={"room_id": room_id, "select_difficulty": 2},
+        )
+        assert response.status_code == 200
+        delta = websocket.receive_json()
+        assert delta["version"] != first["version"]
+        assert [u["is_me"] for u in delta["updated_user_list"]] == [False]
+        assert delta["left_user_id_list"] == []
+
+    response = client.post(
+        "/room/wait/longpoll",
+        headers=_auth_header(5),
+        json={"room_id": room_id, "version": version, "timeout": 5},
+    )
+    assert response.json()["version"] != version
+    assert len(response.json()["room_user_list"]) == 2
+
+    # ヘッダを付けられないクライアントは最初のメッセージで token を送る
+    with client.websocket_connect(f"/room/wait/ws?room_id={room_id}") as websocket:
+        websocket.send_json({"token": user_tokens[6]})
+        first = websocket.receive_json()
+        assert [u["is_me"] for u in first["updated_user_list"]] == [False, True]
+
+
+def test_room_wait_ws_rejects_token_in_query():
+    path = f"/room/wait/ws?room_id=1&token={user_tokens[5]}"
+    with client.websocket_connect(path) as websocket:
+        websocket.send_json({"hello": "world"})
+        with pytest.raises(WebSocketDisconnect) as excinfo:
+            websocket.receive_json()
+    assert excinfo.value.code == 1008
+    with pytest.raises(WebSocketDisconnect) as excinfo:
+        with client.websocket_connect(path, headers={"Authorization": "bearer bad"}):
+            pass
+    assert excinfo.value.code == 1008
+
+
+@pytest.mark.skipif(
+    room_registry is not None, reason="storage writes bypass the room registry"
+)
+def test_room_wait_longpoll_sees_other_workers(monkeypatch):
+    monkeypatch.setattr(config, "LONG_POLL_RECHECK_INTERVAL", 0.05)
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(7),
+        json={"live_id": 1002, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    response = client.post(
+        "/room/wait/longpoll", headers=_auth_header(7), json={"room_id": room_id}
+    )
+    version = response.json()["version"]
+    # long-poll の version は /room/wait と同じ room.version (どの worker でも同じ)
+    response = client.post(
+        "/room/wait", headers=_auth_header(7), json={"room_id": room_id, "version": 0}
+    )
+    assert response.json()["version"] == version
+
+    # 別 worker での join はこの worker の通知を通らない
+    guest = model.resolve_caller(user_tokens[8])
+    joiner = threading.Timer(
+        0.2,
+        model.storage.join_room,
+        (room_id, guest.user_id, LiveDifficulty.Normal),
+    )
+    joiner.start()
+    started = time.monotonic()
+    response = client.post(
+        "/room/wait/longpoll",
+        headers=_auth_header(7),
+        json={"room_id": room_id, "version": version, "timeout": 5},
+    )
+    joiner.join()
+    assert 0.2 <= time.monotonic() - started < 5
+    assert response.json()["version"] != version
+    assert len(response.json()["room_user_list"]) == 2
+
+
+def test_room_list_pagination():
+    room_ids = []
+    for i in range(3):
+        response = client.post(
+            "/room/create",
+            headers=_auth_header(i),
+            json={"live_id": 1003, "select_difficulty": 1},
+        )
+        room_ids.append(response.json()["room_id"])
+
+    listed = []
+    cursor = 0
+    while True:
+        response = client.post(
+            "/room/list", json={"live_id": 1003, "cursor": cursor, "limit": 2}
+        )
+        assert response.status_code == 200
+        page = response.json()["room_info_list"]
+        assert len(page) <= 2
+        listed += [room["room_id"] for room in page]
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert set(room_ids) <= set(listed)
+    assert listed == sorted(listed)
+
+
+def test_room_quickjoin():
+    # 前回の実行で残ったルームに入らないように毎回違う live_id を使う
+    live_id = 100000 + int(time.time() * 1000) % 10**8
+
+    def quickjoin(i):
+        response = client.post(
+            "/room/quickjoin",
+            headers=_auth_header(i),
+            json={"live_id": live_id, "select_difficulty": 1},
+        )
+        assert response.status_code == 200
+        return response.json()
+
+    first = quickjoin(0)
+    assert first["created"]
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(1),
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    second_room_id = response.json()["room_id"]
+
+    # 一番埋まっているルーム (同数なら古い方) から埋めていく
+    for i in range(2, MAX_USER_COUNT + 1):
+        assert quickjoin(i) == {"room_id": first["room_id"], "created": False}
+    assert quickjoin(MAX_USER_COUNT + 1) == {
+        "room_id": second_room_id,
+        "created": False,
+    }
+    # 入っているルームにもう一度来ても同じルームを返す
+    assert quickjoin(MAX_USER_COUNT + 1)["room_id"] == second_room_id
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(0), json={"room_id": first["room_id"]}
+    )
+    assert len(response.json()["room_user_list"]) == MAX_USER_COUNT
+
+
+def test_room_result_judge_count():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(7),
+        json={"live_id": 1005, "select_difficulty": 2},
+    )
+    room_id = response.json()["room_id"]
+    response = client.post(
+        "/room/end",
+        headers=_auth_header(7),
+        json={"room_id": room_id, "score": 9876, "judge_count_list": [5, 4, 3, 2, 1]},
+    )
+    assert response.status_code == 200
+
+    response = client.post("/room/result", json={"room_id": room_id})
+    assert response.status_code == 200
+    assert response.json()["result_user_list"] == [
+        {
+            "user_id": response.json()["result_user_list"][0]["user_id"],
+            "judge_count_list": [5, 4, 3, 2, 1],
+            "score": 9876,
+        }
+    ]
+
+    # 揃った結果は2回目以降キャッシュから返る
+    hits = model.result_cache.stats()["hits"]
+    response = client.post("/room/result", json={"room_id": room_id})
+    assert response.json()["result_user_list"][0]["score"] == 9876
+    assert model.result_cache.stats()["hits"] == hits + 1
+
+    # 判定は5種類
+    response = client.post(
+        "/room/end",
+        headers=_auth_header(7),
+        json={"room_id": room_id, "score": 1, "judge_count_list": [1, 2]},
+    )
+    assert response.status_code == 422
+
+
+def test_room_wait_and_list_versions():
+    live_id = 200000 + int(time.time() * 1000) % 10**8
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(8),
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+
+    def wait(version):
+        response = client.post(
+            "/room/wait",
+            headers=_auth_header(8),
+            json={"room_id": room_id, "version": version},
+        )
+        assert response.status_code == 200
+        return response.json()
+
+    def list_rooms(version):
+        response = client.post(
+            "/room/list", json={"live_id": live_id, "version": version}
+        )
+        assert response.status_code == 200
+        return response.json()
+
+    first = wait(0)
+    assert first["unchanged"] is False
+    assert [user["is_host"] for user in first["room_user_list"]] == [True]
+    # 変わっていなければメンバーを返さない
+    assert wait(first["version"]) == {
+        "status": 1,
+        "room_user_list": [],
+        "version": first["version"],
+        "unchanged": True,
+    }
+    listed = list_rooms(0)
+    assert [room["room_id"] for room in listed["room_info_list"]] == [room_id]
+    assert list_rooms(listed["version"])["unchanged"] is True
+
+    client.post(
+        "/room/join",
+        headers=_auth_header(9),
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+    second = wait(first["version"])
+    assert second["version"] > first["version"] and second["unchanged"] is False
+    assert len(second["room_user_list"]) == 2
+    relisted = list_rooms(listed["version"])
+    assert relisted["version"] > listed["version"] and relisted["unchanged"] is False
+    assert relisted["room_info_list"][0]["joined_user_count"] == 2
+
+    # version を送らなければ従来の形
+    response = client.post(
+        "/room/wait", headers=_auth_header(8), json={"room_id": room_id}
+    )
+    assert set(response.json()) == {"status", "room_user_list"}
+
+    client.post("/room/start", headers=_auth_header(8), json={"room_id": room_id})
+    assert wait(second["version"])["status"] == 2
+    # ないルームは version 0 の解散済み
+    response = client.post(
+        "/room/wait",
+        headers=_auth_header(8),
+        json={"room_id": 10**12, "version": 0},
+    )
+    assert response.json() == {
+        "status": 3,
+        "room_user_list": [],
+        "version": 0,
+        "unchanged": False,
+    }
+
+
+def test_room_leave_passes_host_to_smallest_user_id():
+    live_id = 300000 + int(time.time() * 1000) % 10**8
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(5),
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    # 後から作ったユーザーが先に入る (入った順と user_id の順を逆にする)
+    for i in (7, 6):
+        response = client.post(
+            "/room/join",
+            headers=_auth_header(i),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+        assert response.json() == {"join_room_result": 1}
+
+    response = client.post(
+        "/room/leave", headers=_auth_header(5), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    response = client.post(
+        "/room/wait", headers=_auth_header(7), json={"room_id": room_id}
+    )
+    users = response.json()["room_user_list"]
+    assert len(users) == 2
+    host = min(users, key=lambda user: user["user_id"])
+    assert [user["user_id"] for user in users if user["is_host"]] == [host["user_id"]]
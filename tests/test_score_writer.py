@@ -0,0 +1,144 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config, model
+from app.api import app
+from app.config import MAX_USER_COUNT
+from app.registry import room_registry
+from app.ResReqModel import LiveDifficulty
+from app.score_writer import ScoreWriter, ScoreWriterError
+
+pytestmark = [
+    pytest.mark.skipif(
+        config.STORAGE == "memory", reason="score writer requires an SQL storage"
+    ),
+    # registry は member の INSERT を write-behind するので, writer を起動しないテストでは書けていない
+    pytest.mark.skipif(room_registry is not None, reason="room registry is enabled"),
+]
+
+client = TestClient(app)
+rooms = 8
+
+
+def _create_user(i):
+    response = client.post(
+        "/user/create",
+        json={"user_name": f"score_user_{i}", "leader_card_id": 1000},
+    )
+    return response.json()["user_token"]
+
+
+def test_scores_are_written_in_batches():
+    live_id = 300000 + int(time.time() * 1000) % 10**8
+    members = []
+    for r in range(rooms):
+        tokens = [_create_user(r * MAX_USER_COUNT + i) for i in range(MAX_USER_COUNT)]
+        callers = [model.resolve_caller(token) for token in tokens]
+        room_id = model.create_room(callers[0], live_id, LiveDifficulty.Normal)
+        for caller in callers[1:]:
+            model.join_room(room_id, LiveDifficulty.Normal, caller)
+        members += [(room_id, model.get_user_by_token(token)) for token in tokens]
+    outsider = model.get_user_by_token(_create_user("outsider"))
+
+    # 全員の /room/end が同時に来た状態. 窓を長めにして必ずまとまるようにする
+    writer = ScoreWriter(window=0.2, max_batch=len(members))
+    writer.start()
+    try:
+        with ThreadPoolExecutor(max_workers=len(members) + 1) as executor:
+            futures = [
+                executor.submit(
+                    lambda room_id, user: writer.submit(
+                        room_id, user.id, 1000 + user.id, [user.id, 0, 0, 0, 1]
+                    ).result(),
+                    room_id,
+                    user,
+                )
+                for room_id, user in members
+            ]
+            stray = executor.submit(
+                lambda: writer.submit(members[0][0], outsider.id, 1, [1] * 5).result()
+            )
+            results = [future.result() for future in futures]
+    finally:
+        writer.stop()
+
+    # commit 後に, ランキング用の情報を付けて返る
+    for (room_id, user), played in zip(members, results):
+        assert played == (live_id, LiveDifficulty.Normal, user)
+    assert stray.result() is None
+    stats = writer.stats()
+    assert stats["scores"] == len(members) + 1
+    assert stats["batches"] < stats["scores"]
+
+    for room_id in {room_id for room_id, _ in members}:
+        result = model.result_room(room_id)
+        assert len(result) == MAX_USER_COUNT
+        for user in result:
+            assert user.score == 1000 + user.user_id
+            assert user.judge_count_list == [user.user_id, 0, 0, 0, 1]
+
+
+def test_score_writer_writes_inline_before_start():
+    host = _create_user("inline")
+    room_id = model.create_room(model.resolve_caller(host), 1006, LiveDifficulty.Hard)
+    user = model.get_user_by_token(host)
+    writer = ScoreWriter()
+    played = writer.submit(room_id, user.id, 77, [1, 2, 3, 4, 5]).result(timeout=5)
+    assert played == (1006, LiveDifficulty.Hard, user)
+    assert model.result_room(room_id)[0].score == 77
+
+
+# SystemExit で writer スレッドを落とす
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_score_writer_fails_pending_futures():
+    writer = ScoreWriter(window=0)
+    errors = [RuntimeError("broken write"), SystemExit("writer thread died")]
+
+    def broken(batch):
+        raise errors.pop(0)
+
+    writer._write = broken
+    writer.start()
+    try:
+        # 書けなかった分は呼び出し元に例外が返る
+        with pytest.raises(RuntimeError):
+            writer.submit(1, 1, 1, [1] * 5).result(timeout=5)
+        # writer スレッドごと落ちても待たせたままにしない
+        with pytest.raises(ScoreWriterError):
+            writer.submit(1, 1, 1, [1] * 5).result(timeout=5)
+    finally:
+        writer.stop()
+    assert writer.pending() == 0
+
+
+def test_room_end_times_out_with_503(monkeypatch):
+    host = _create_user("timeout")
+    room_id = model.create_room(model.resolve_caller(host), 1007, LiveDifficulty.Hard)
+    writer = ScoreWriter()
+    released = threading.Event()
+    write = writer._write
+
+    def slow(batch):
+        released.wait(5)
+        write(batch)
+
+    writer._write = slow
+    writer.start()
+    monkeypatch.setattr(model, "score_writer", writer)
+    monkeypatch.setattr(model, "SCORE_BATCH_TIMEOUT", 0.05)
+    try:
+        response = client.post(
+            "/room/end",
+            headers={"Authorization": f"bearer {host}"},
+            json={"room_id": room_id, "score": 88, "judge_count_list": [1] * 5},
+        )
+        assert response.status_code == 503
+    finally:
+        released.set()
+        writer.stop()
+    # 待つのをやめても書き込み自体は続くので, 後から結果に出る
+    assert model.result_room(room_id)[0].score == 88
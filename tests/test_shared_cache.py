@@ -0,0 +1,117 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config, model
+from app.api import app
+from app.registry import room_registry
+from app.ResReqModel import LiveDifficulty, RoomInfo, RoomUser, WaitRoomStatus
+from app.shared_cache import SharedRoomCache
+
+client = TestClient(app)
+
+
+def _room_user(user_id: int, is_host: bool) -> RoomUser:
+    return RoomUser(
+        user_id=user_id,
+        name=f"user_{user_id}",
+        leader_card_id=1000,
+        select_difficulty=LiveDifficulty.Hard,
+        is_me=False,
+        is_host=is_host,
+    )
+
+
+def test_wait_snapshot_is_shared_across_workers(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    # 同じファイルを開いた別 worker のつもり
+    worker_a = SharedRoomCache(path, ttl=60)
+    worker_b = SharedRoomCache(path, ttl=60)
+
+    assert worker_a.get_wait(1, 10) == (0, None)
+    worker_a.set_wait(
+        1, 3, WaitRoomStatus.Waiting, [_room_user(10, True), _room_user(11, False)]
+    )
+
+    version, (status, room_user_list) = worker_b.get_wait(1, 11)
+    assert version == 3
+    assert status == WaitRoomStatus.Waiting
+    assert [(u.user_id, u.is_me, u.is_host) for u in room_user_list] == [
+        (10, False, True),
+        (11, True, False),
+    ]
+    assert room_user_list[0].select_difficulty == LiveDifficulty.Hard
+
+    worker_b.set_wait(1, 4, WaitRoomStatus.LiveStart, [_room_user(10, True)])
+    # 先に読み始めていた (古い version の) 内容で新しい方を上書きしない
+    worker_a.set_wait(1, 3, WaitRoomStatus.Waiting, [_room_user(10, True)])
+    version, (status, _) = worker_a.get_wait(1, 10)
+    assert (version, status) == (4, WaitRoomStatus.LiveStart)
+
+    worker_a.forget(1)
+    assert worker_b.get_wait(1, 10) == (0, None)
+
+
+def test_list_snapshot_is_keyed_by_page(tmp_path):
+    cache = SharedRoomCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    assert cache.get_list(1001, 0, 100) == (0, None)
+    rooms = [RoomInfo(room_id=5, live_id=1001, joined_user_count=2, max_user_count=4)]
+    cache.set_list(1001, 0, 100, 7, rooms, None)
+    version, (room_info_list, next_cursor) = cache.get_list(1001, 0, 100)
+    assert version == 7
+    assert room_info_list == rooms and next_cursor is None
+    # 別ページ, 別の live_id は別のキー
+    assert cache.get_list(1001, 5, 100) == (0, None)
+    assert cache.get_list(1002, 0, 100) == (0, None)
+    assert cache.stats() == {"hits": 1, "misses": 3, "fills": 1}
+
+
+def test_expired_snapshot_is_not_used(tmp_path):
+    cache = SharedRoomCache(str(tmp_path / "cache.sqlite3"), ttl=-1)
+    cache.set_wait(1, 1, WaitRoomStatus.Waiting, [_room_user(10, True)])
+    assert cache.get_wait(1, 10) == (0, None)
+
+
+def _create_user(name: str) -> dict:
+    response = client.post(
+        "/user/create", json={"user_name": name, "leader_card_id": 1}
+    )
+    return {"Authorization": f"bearer {response.json()['user_token']}"}
+
+
+@pytest.mark.skipif(
+    config.STORAGE == "memory" or room_registry is not None,
+    reason="shared cache is only used with an SQL storage",
+)
+def test_other_workers_changes_are_seen_without_invalidation(tmp_path, monkeypatch):
+    cache = SharedRoomCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    monkeypatch.setattr(model, "shared_cache", cache)
+    live_id = int(time.time() * 1000) % 1_000_000_000 + 7
+    host, guest = _create_user("cache_host"), _create_user("cache_guest")
+    room_id = client.post(
+        "/room/create",
+        headers=host,
+        json={"live_id": live_id, "select_difficulty": 1},
+    ).json()["room_id"]
+
+    def wait() -> list[int]:
+        response = client.post("/room/wait", headers=host, json={"room_id": room_id})
+        return [user["user_id"] for user in response.json()["room_user_list"]]
+
+    def listed() -> list[int]:
+        response = client.post("/room/list", json={"live_id": live_id})
+        return [room["joined_user_count"] for room in response.json()["room_info_list"]]
+
+    assert len(wait()) == 1 and listed() == [1]
+    assert len(wait()) == 1 and listed() == [1]
+    assert cache.stats()["fills"] == 2
+    # 変更はキャッシュに書かない. DB の version が進むので次に読んだ時に入れ直される
+    client.post(
+        "/room/join",
+        headers=guest,
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+    assert cache.stats()["fills"] == 2
+    assert len(wait()) == 2 and listed() == [2]
+    assert cache.stats()["fills"] == 4
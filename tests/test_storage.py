@@ -0,0 +1,48 @@
+from app.config import MAX_USER_COUNT
+from app.memory_storage import MemoryStorage
+from app.ResReqModel import JoinRoomResult, LiveDifficulty, WaitRoomStatus
+
+
+def test_memory_storage_lifecycle():
+    storage = MemoryStorage()
+    users = [storage.create_user(f"storage_user_{i}", 1000)[1] for i in range(5)]
+    token, user = storage.create_user("storage_user_x", 1000)
+    assert storage.get_user_by_token(token) == user
+    assert storage.get_user_by_token("unknown") is None
+
+    room_id = storage.create_room(users[0].id, 1001, LiveDifficulty.Normal)
+    other_room_id = storage.create_room(users[4].id, 1002, LiveDifficulty.Normal)
+    results = [
+        storage.join_room(room_id, u.id, LiveDifficulty.Hard)
+        for u in users[1:][:MAX_USER_COUNT]
+    ]
+    assert results[-1] == JoinRoomResult.RoomFull
+    assert storage.join_room(room_id, users[1].id, LiveDifficulty.Hard) == (
+        JoinRoomResult.Ok
+    )
+    # 満員のルームは一覧に出ない
+    assert storage.list_room(1001, 0, 10) == ([], None)
+    assert [r.room_id for r in storage.list_room(0, 0, 10)[0]] == [other_room_id]
+
+    storage.start_room(room_id, users[1].id)
+    assert storage.wait_room(room_id, users[0].id)[0] == WaitRoomStatus.Waiting
+    storage.start_room(room_id, users[0].id)
+    assert storage.join_room(room_id, users[4].id, LiveDifficulty.Hard) == (
+        JoinRoomResult.OtherError
+    )
+
+    for i, u in enumerate(users[:MAX_USER_COUNT]):
+        assert storage.result_room(room_id) == []
+        storage.end_room(room_id, u.id, 100 + i, [i, 0, 0, 0, 0])
+    assert [r.score for r in storage.result_room(room_id)] == [100, 101, 102, 103]
+
+    # オーナーが抜けると次に入った人がオーナーになり, 全員抜けると解散
+    storage.leave_room(room_id, users[0].id)
+    status, room_user_list = storage.wait_room(room_id, users[1].id)
+    assert [u.is_host for u in room_user_list] == [True, False, False]
+    for u in users[1:MAX_USER_COUNT]:
+        storage.leave_room(room_id, u.id)
+    assert storage.wait_room(room_id, users[1].id) == (WaitRoomStatus.Dissolution, [])
+    assert storage.join_room(room_id, users[1].id, LiveDifficulty.Hard) == (
+        JoinRoomResult.Disbanded
+    )